@@ -13,6 +13,10 @@ import sys
 import logging
 import threading
 import uuid
+import heapq
+import zlib
+import base64
+from collections import deque
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
 from typing import Any, Dict, Optional, Tuple
@@ -20,9 +24,14 @@ from flask import Flask, request, jsonify, Response, stream_with_context, send_f
 from flask_cors import CORS
 from flask_sock import Sock
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from urllib.parse import urlparse
-from gevent import spawn, joinall
+from gevent import spawn, spawn_later, joinall
+from gevent.event import Event
+try:
+    import orjson  # 可选：安装后广播序列化更快
+except ImportError:
+    orjson = None
 # endregion
 
 # region [APP INIT]
@@ -186,6 +195,7 @@ _DB_READY = False
 _DB_INIT_LOCK = threading.Lock()
 _frontend_clients = {}  # sid -> {"ws": ws, "user_id": str, "subscribed_tasks": set, "connected_at": time}
 _task_subscribers = {}  # task_id -> set(sid)
+_user_clients = {}  # user_id -> set(sid)：subscribe_user 时登记，断开时移除（按用户推送只遍历该用户的连接）
 _worker_clients = {}  # server_id -> {"ws": ws, "meta": {}, "ready": False, "connected_at": time}
 _worker_lock = threading.Lock()
 _frontend_lock = threading.Lock()
@@ -201,6 +211,22 @@ _frontend_lock = threading.Lock()
 # }
 _task_tracker = {}
 _task_tracker_lock = threading.Lock()
+# shard_id -> task_id：分片结果回报时 O(1) 定位所属任务（与 _task_tracker 共用锁；分片回报或任务结束时清除）
+_shard_task_index = {}
+
+# [NEW] 多租户公平调度器（按用户加权公平队列，替代“按任务先到先得”的整批推送）
+# _sched_tasks: task_id -> {"user_id", "message", "trace_id", "queue": deque(shard), "created_at"}
+# _sched_users: user_id -> {"vtime": float, "inflight": int, "weight": float, "max_inflight": int, "tasks": deque(task_id)}
+# _sched_inflight: shard_id -> {"task_id", "user_id", "worker_id", "phone_count", "started_at"}
+# _sched_worker_load: server_id -> 本进程已推送未回报的分片数
+# _sched_hedges: shard_id -> 备份执行（对冲）的分片记录，结构同 _sched_inflight
+_sched_tasks = {}
+_sched_users = {}
+_sched_inflight = {}
+_sched_hedges = {}
+_sched_worker_load = {}
+_sched_lock = threading.Lock()
+_sched_wakeup = Event()
 # endregion
 
 # region [DB & UTILS]
@@ -569,8 +595,39 @@ def init_db() -> None:
         except:
             pass
         cur.execute("""CREATE TABLE IF NOT EXISTS tasks(task_id VARCHAR PRIMARY KEY, user_id VARCHAR NOT NULL, message TEXT NOT NULL, total INT, count INT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP, status VARCHAR DEFAULT 'pending', FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)""")
+        try:
+            cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS rate_per_min INT")
+            cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS start_at TIMESTAMPTZ")
+            cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS send_window JSONB")
+            # 创建时冻结的单价（结算按任务单价，任务进行中修改费率不影响已提交任务）
+            cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS price_success NUMERIC")
+            cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS price_fail NUMERIC")
+        except:
+            pass
         cur.execute("""CREATE TABLE IF NOT EXISTS shards(shard_id VARCHAR PRIMARY KEY, task_id VARCHAR NOT NULL, server_id VARCHAR, phones JSONB NOT NULL, status VARCHAR DEFAULT 'pending', attempts INT DEFAULT 0, locked_at TIMESTAMP, updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP, result JSONB DEFAULT '{}'::jsonb, FOREIGN KEY(task_id) REFERENCES tasks(task_id) ON DELETE CASCADE, FOREIGN KEY(server_id) REFERENCES servers(server_id) ON DELETE SET NULL)""")
         cur.execute("""CREATE TABLE IF NOT EXISTS reports(report_id SERIAL PRIMARY KEY, shard_id VARCHAR, server_id VARCHAR, user_id VARCHAR, success INT, fail INT, sent INT, credits NUMERIC, detail JSONB, ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        # reports.shard_id 唯一：同一分片只结算一次（首次建索引前先去重，保留最早一条）
+        try:
+            cur.execute("SELECT 1 FROM pg_indexes WHERE tablename='reports' AND indexname='reports_shard_id_key'")
+            if not cur.fetchone():
+                cur.execute("DELETE FROM reports a USING reports b WHERE a.shard_id = b.shard_id AND a.report_id > b.report_id")
+                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS reports_shard_id_key ON reports(shard_id)")
+        except:
+            pass
+        # 任务累计计数（结果批量写入时按任务分组累加，不再每次 SUM reports）
+        try:
+            cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name='tasks' AND column_name='success_count'")
+            if not cur.fetchone():
+                cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS success_count INT DEFAULT 0")
+                cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS fail_count INT DEFAULT 0")
+                cur.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS sent_count INT DEFAULT 0")
+                # 首次加列时回填历史任务
+                cur.execute("""UPDATE tasks t SET success_count=r.s, fail_count=r.f, sent_count=r.n
+                               FROM (SELECT sh.task_id, COALESCE(SUM(rp.success),0) AS s, COALESCE(SUM(rp.fail),0) AS f, COALESCE(SUM(rp.sent),0) AS n
+                                     FROM reports rp JOIN shards sh ON sh.shard_id=rp.shard_id GROUP BY sh.task_id) r
+                               WHERE t.task_id=r.task_id""")
+        except:
+            pass
         cur.execute("""CREATE TABLE IF NOT EXISTS conversations(user_id VARCHAR NOT NULL, chat_id VARCHAR NOT NULL, meta JSONB DEFAULT '{}'::jsonb, messages JSONB DEFAULT '[]'::jsonb, updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY(user_id, chat_id), FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)""")
         cur.execute("""CREATE TABLE IF NOT EXISTS sent_records(id SERIAL PRIMARY KEY, user_id VARCHAR NOT NULL, phone_number VARCHAR, task_id VARCHAR, detail JSONB DEFAULT '{}'::jsonb, ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE)""")
         cur.execute("""CREATE TABLE IF NOT EXISTS id_library(apple_id VARCHAR PRIMARY KEY, password VARCHAR NOT NULL, status VARCHAR DEFAULT 'normal', usage_status VARCHAR DEFAULT 'new', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
@@ -694,6 +751,66 @@ def sys_log(level: str, module: str, message: str, detail: dict = None):
 from redis_manager import redis_manager
 # endregion
 
+# region [PERF METRICS]
+# 进程内性能指标：计数器 + 最近样本（用于 p50/p95 对比优化前后效果）
+_perf_counters = {}
+_perf_samples = {}  # name -> deque(最近样本)
+_perf_lock = threading.Lock()
+_PERF_SAMPLE_SIZE = int(os.environ.get("PERF_SAMPLE_SIZE", "2048"))
+
+def _perf_incr(name: str, amount: float = 1) -> None:
+    """累加计数器"""
+    with _perf_lock:
+        _perf_counters[name] = _perf_counters.get(name, 0) + amount
+
+def _perf_observe(name: str, value: float) -> None:
+    """记录一个样本（只保留最近 PERF_SAMPLE_SIZE 个）"""
+    with _perf_lock:
+        samples = _perf_samples.get(name)
+        if samples is None:
+            samples = _perf_samples[name] = deque(maxlen=_PERF_SAMPLE_SIZE)
+        samples.append(float(value))
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round((pct / 100.0) * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+def _perf_snapshot() -> dict:
+    """导出计数器和样本分位数"""
+    with _perf_lock:
+        counters = dict(_perf_counters)
+        samples = {k: sorted(v) for k, v in _perf_samples.items()}
+    summary = {}
+    for name, values in samples.items():
+        summary[name] = {
+            "count": len(values),
+            "avg": round(sum(values) / len(values), 4) if values else 0.0,
+            "p50": round(_percentile(values, 50), 4),
+            "p95": round(_percentile(values, 95), 4),
+            "max": round(values[-1], 4) if values else 0.0,
+        }
+    return {"counters": counters, "samples": summary}
+# endregion
+
+# region [BROADCAST ENCODE]
+def _encode_broadcast(message: dict) -> str:
+    """广播消息只序列化一次，所有接收方共享同一个字符串；装了 orjson 时优先使用"""
+    t0 = time.perf_counter()
+    payload = None
+    if orjson is not None:
+        try:
+            payload = orjson.dumps(message, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            payload = None
+    if payload is None:
+        payload = json.dumps(message, default=str)
+    _perf_observe("broadcast.encode_ms", (time.perf_counter() - t0) * 1000)
+    _perf_incr("broadcast.bytes", len(payload))
+    return payload
+# endregion
+
 # region [STARTUP INIT]
 # 应用启动时的初始化（数据库、Redis等）
 def startup_init():
@@ -896,12 +1013,13 @@ def debug_redis():
     })
 
 
-
-
-
-
-
-
+# 查看进程内性能指标（调度、写入、推送等）
+@app.route("/api/debug/perf", methods=["GET"])
+def debug_perf():
+    snap = _perf_snapshot()
+    snap["scheduler"] = _sched_stats()
+    snap["recovery"] = _recovery_report
+    return jsonify({"ok": True, "pid": os.getpid(), **snap})
 
 # endregion
 
@@ -1581,6 +1699,8 @@ def admin_account_item(admin_id: str):
                 cur.execute("UPDATE admin_configs SET user_groups=%s::jsonb, updated=NOW() WHERE admin_id=%s", (json.dumps(user_groups), admin_id))
             conn.commit()
             conn.close()
+            if selected_servers is not None:
+                _assign_index_invalidate("admin_selected_servers")
             return jsonify({"success": True})
         except Exception as e:
             conn.rollback()
@@ -1592,6 +1712,7 @@ def admin_account_item(admin_id: str):
     conn.commit()
     conn.close()
     if deleted:
+        _assign_index_invalidate("admin_delete")
         return jsonify({"success": True, "message": "管理员已删除"})
     else:
         return jsonify({"success": False, "message": "管理员不存在"}), 404
@@ -1671,6 +1792,7 @@ def admin_user_item(user_id: str):
     cur2.execute("DELETE FROM users WHERE user_id=%s", (user_id,))
     conn.commit()
     conn.close()
+    _assign_index_invalidate("user_delete")
     return jsonify({"success": True, "message": "用户已删除"})
 
 
@@ -2293,23 +2415,88 @@ def check_user_assignment():
     
     return jsonify({"success": True, "assigned": False})
 
+# 费率缓存：进程内缓存全局/用户费率，/api/admin/rates/* 写入时失效，并通过 Redis 发布/订阅通知其他进程
+# （列迁移只在 init_db 里做一次；RATES_CACHE_TTL 兜底，防止错过失效消息）
+RATES_CACHE_TTL = float(os.environ.get("RATES_CACHE_TTL", "300"))
+RATES_CHANNEL = "rates_invalidate"
+_rates_cache = {}  # "global" / "user:<user_id>" -> (过期时间, rates)
+_rates_cache_lock = threading.Lock()
+
+
+def _rates_cache_get(key: str):
+    with _rates_cache_lock:
+        hit = _rates_cache.get(key)
+    if hit and hit[0] > time.time():
+        _perf_incr("rates_cache.hit")
+        return dict(hit[1])
+    _perf_incr("rates_cache.miss")
+    return None
+
+
+def _rates_cache_put(key: str, rates: dict) -> None:
+    with _rates_cache_lock:
+        _rates_cache[key] = (time.time() + RATES_CACHE_TTL, dict(rates or {}))
+
+
+def _rates_invalidate(user_id: str = None, publish: bool = True) -> None:
+    """失效费率缓存：user_id 为空表示全局费率（全局变化会影响所有用户的最终单价，整体清空）"""
+    with _rates_cache_lock:
+        if user_id:
+            _rates_cache.pop(f"user:{user_id}", None)
+        else:
+            _rates_cache.clear()
+    if publish:
+        redis_manager.publish(RATES_CHANNEL, {"user_id": user_id})
+
+
+def _rates_listen_loop():
+    """订阅其他进程的费率失效通知（内存模式只有单进程，无需订阅）"""
+    LOCATION = "[API][_rates_listen_loop]"
+    while redis_manager.use_redis:
+        pubsub = redis_manager.subscribe(RATES_CHANNEL)
+        if pubsub is None:
+            time.sleep(5)
+            continue
+        # 重新订阅期间可能漏掉消息，清空一次
+        _rates_invalidate(publish=False)
+        try:
+            while True:
+                msg = pubsub.get_message(timeout=1.0)
+                if not msg or msg.get("type") != "message":
+                    continue
+                try:
+                    data = json.loads(msg.get("data") or "{}")
+                except Exception:
+                    data = {}
+                _rates_invalidate(data.get("user_id"), publish=False)
+        except Exception as e:
+            logger.warning(f"{LOCATION} 订阅中断，稍后重连: {e}")
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+            time.sleep(2)
+
+spawn(_rates_listen_loop)
+
+
 #  获取全局费率
 def _get_global_rates(conn):
+    cached = _rates_cache_get("global")
+    if cached is not None:
+        return cached
     try:
-        # 确保 rates 列存在（运行时迁移）
-        try:
-            cur_check = conn.cursor()
-            cur_check.execute("ALTER TABLE admin_configs ADD COLUMN IF NOT EXISTS rates JSONB")
-            conn.commit()
-        except:
-            conn.rollback()
-        
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("SELECT rates FROM admin_configs WHERE admin_id='server_manager'")
         row = cur.fetchone()
-        if row and row.get("rates"):
-            return row.get("rates")
-    except: pass
+        rates = (row.get("rates") if row else None) or {}
+        _rates_cache_put("global", rates)
+        return rates
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
     return {}
 
 # - 获取用户费率（实现优先级：超级管理员设置 > 管理员设置 > 全局费率）
@@ -2320,22 +2507,17 @@ def _get_user_rates(conn, user_id):
     2. 管理员设置（admin_rate_set_by=admin_id）
     3. 全局费率（admin_rate_set_by为NULL）
     """
+    cached = _rates_cache_get(f"user:{user_id}")
+    if cached is not None:
+        return cached
     try:
-        # 运行时兜底迁移：避免历史数据库缺列导致事务进入 INERROR 状态
-        try:
-            cur_m = conn.cursor()
-            cur_m.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS rates JSONB")
-            cur_m.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS admin_rate_set_by VARCHAR")
-            conn.commit()
-        except Exception:
-            conn.rollback()
-
         cur = conn.cursor(cursor_factory=RealDictCursor)
         # 获取用户费率设置
-        cur.execute("SELECT rates, admin_rate_set_by FROM user_data WHERE user_id=%s", (user_id,))
+        cur.execute("SELECT rates FROM user_data WHERE user_id=%s", (user_id,))
         row = cur.fetchone()
-        if row and row.get("rates"):
-            return row.get("rates")
+        rates = (row.get("rates") if row else None) or {}
+        _rates_cache_put(f"user:{user_id}", rates)
+        return rates
     except Exception:
         try:
             conn.rollback()
@@ -2391,17 +2573,11 @@ def admin_rates_global():
         if not rates: return jsonify({"success": False, "message": "missing rates"}), 400
         
         cur = conn.cursor()
-        # 确保 rates 列存在（运行时迁移）
-        try:
-            cur.execute("ALTER TABLE admin_configs ADD COLUMN IF NOT EXISTS rates JSONB")
-            conn.commit()
-        except:
-            conn.rollback()
-        
         # 确保 server_manager 配置存在
         cur.execute("INSERT INTO admin_configs(admin_id, rates) VALUES('server_manager', %s) ON CONFLICT (admin_id) DO UPDATE SET rates=%s", (json.dumps(rates), json.dumps(rates)))
         conn.commit()
         conn.close()
+        _rates_invalidate()
         return jsonify({"success": True})
 
 @app.route("/api/admin/rates/user", methods=["POST", "OPTIONS"])
@@ -2430,13 +2606,6 @@ def admin_rates_user():
     
     cur = conn.cursor()
     
-    # 确保列存在
-    try:
-        cur.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS rates JSONB")
-        cur.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS admin_rate_set_by VARCHAR")
-        conn.commit()
-    except: conn.rollback()
-    
     # 如果 rates 为空或None，则视为删除/重置用户费率
     if rates is None:
         cur.execute("UPDATE user_data SET rates=NULL, admin_rate_set_by=NULL WHERE user_id=%s", (user_id,))
@@ -2446,6 +2615,7 @@ def admin_rates_user():
     
     conn.commit()
     conn.close()
+    _rates_invalidate(user_id)
     return jsonify({"success": True})
 
 @app.route("/api/admin/rates/admin-range", methods=["GET", "POST", "OPTIONS"])
@@ -2468,12 +2638,6 @@ def admin_rates_admin_range():
     
     cur = conn.cursor()
     
-    # 确保列存在
-    try:
-        cur.execute("ALTER TABLE admin_configs ADD COLUMN IF NOT EXISTS rate_range JSONB")
-        conn.commit()
-    except: conn.rollback()
-    
     if request.method == "GET":
         target_admin_id = request.args.get("admin_id")
         if not target_admin_id:
@@ -2546,13 +2710,6 @@ def admin_rates_user_by_admin():
     
     cur = conn.cursor()
     
-    # 确保列存在
-    try:
-        cur.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS rates JSONB")
-        cur.execute("ALTER TABLE user_data ADD COLUMN IF NOT EXISTS admin_rate_set_by VARCHAR")
-        conn.commit()
-    except: conn.rollback()
-    
     # 检查用户是否由该管理员创建
     cur.execute("SELECT created_by_admin FROM users WHERE user_id=%s", (user_id,))
     user_row = cur.fetchone()
@@ -2597,6 +2754,7 @@ def admin_rates_user_by_admin():
     
     conn.commit()
     conn.close()
+    _rates_invalidate(user_id)
     return jsonify({"success": True})
 # endregion
 
@@ -3101,6 +3259,8 @@ def servers_item(server_id: str):
     cur2.execute("DELETE FROM servers WHERE server_id=%s", (server_id,))
     conn.commit()
     conn.close()
+    _assign_index_invalidate("server_delete")
+    broadcast_server_delta(server_id)
     return jsonify({"success": True})
 
 
@@ -3127,6 +3287,8 @@ def cleanup_invalid_servers():
             deleted_count += 1
     conn.commit()
     conn.close()
+    if deleted_count:
+        _assign_index_invalidate("server_cleanup")
     return jsonify({"success": True, "deleted_count": deleted_count})
 
 
@@ -3139,6 +3301,7 @@ def server_disconnect(server_id: str):
     cur.execute("UPDATE servers SET last_seen = NOW() - INTERVAL '1 day', status = 'disconnected' WHERE server_id=%s", (server_id,))
     conn.commit()
     conn.close()
+    broadcast_server_delta(server_id)
     return jsonify({"success": True})
 
 # 服务器分配
@@ -3169,6 +3332,8 @@ def server_assign(server_id: str):
     cur2.execute("UPDATE servers SET assigned_user=%s, assigned_by_admin=%s WHERE server_id=%s", (user_id, admin_id, server_id))
     conn.commit()
     conn.close()
+    _assign_index_invalidate("server_assign")
+    broadcast_server_delta(server_id)
     return jsonify({"success": True})
 
 
@@ -3196,6 +3361,8 @@ def server_unassign(server_id: str):
     cur2.execute("UPDATE servers SET assigned_user=NULL, assigned_by_admin=NULL WHERE server_id=%s", (server_id,))
     conn.commit()
     conn.close()
+    _assign_index_invalidate("server_unassign")
+    broadcast_server_delta(server_id)
     return jsonify({"success": True, "message": f"服务器 {server_id} 已取消分配，现为公共服务器", "server_id": server_id, "previous_user": current_assigned})
 
 
@@ -3600,6 +3767,41 @@ def user_deduct(user_id: str):
     return jsonify({"success": True, "credits": new_credits})
 
 
+@app.route("/api/user/<user_id>/usage", methods=["GET", "OPTIONS"])
+def user_usage_page(user_id: str):
+    # 分页读取 usage 记录：?since=<seq> 返回序号大于 since 的记录；缺口超过 limit 或不带 since 时返回最新一页（reset=true）
+    if request.method == "OPTIONS":
+        return jsonify({"ok": True})
+    try:
+        limit = max(1, min(int(request.args.get("limit", "200")), 1000))
+        since = request.args.get("since")
+        since = int(since) if since not in (None, "") else None
+    except ValueError:
+        return jsonify({"success": False, "message": "invalid since/limit"}), 400
+
+    conn = db()
+    token = _bearer_token()
+    if not token or not (_verify_user_token(conn, user_id, token) or _verify_admin_token(conn, token)):
+        conn.close()
+        return jsonify({"success": False, "message": "invalid_token"}), 401
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT credits, jsonb_array_length(COALESCE(usage,'[]'::jsonb)) AS total FROM user_data WHERE user_id=%s", (user_id,))
+    row = cur.fetchone()
+    if not row:
+        conn.close()
+        return jsonify({"success": False, "message": "user_not_found"}), 404
+    total = int(row["total"] or 0)
+    reset = since is None or since > total or total - since > limit
+    start = max(0, total - limit) if reset else since
+    cur.execute("""SELECT COALESCE(jsonb_agg(x.e ORDER BY x.n), '[]'::jsonb) AS entries
+                   FROM user_data d, jsonb_array_elements(COALESCE(d.usage,'[]'::jsonb)) WITH ORDINALITY AS x(e, n)
+                   WHERE d.user_id=%s AND x.n > %s AND x.n <= %s""", (user_id, start, start + limit))
+    entries = (cur.fetchone() or {}).get("entries") or []
+    conn.close()
+    credits = float(row["credits"]) if row.get("credits") is not None else None
+    return jsonify({"success": True, "user_id": user_id, "from_seq": start, "seq": start + len(entries), "total": total, "reset": reset, "entries": entries, "credits": credits})
+
+
 @app.route("/api/user/<user_id>/statistics", methods=["GET", "POST", "OPTIONS"])
 def user_statistics(user_id: str):
     # 用户统计（支持user_id或username查询）
@@ -3757,6 +3959,82 @@ def shards_collection(user_id: str, task_id: str):
 # endregion
 
 # region [TASK]
+# 积分预占（存于 redis_manager，多进程共享、重启不丢）：创建任务时按预估成本预占，分片结算时扣减，任务完成/取消时释放
+# 同一用户并发创建多个任务时，可用积分 = 余额 - 已预占
+def _credit_held(user_id: str) -> float:
+    return redis_manager.credit_held(user_id)
+
+
+def _credit_hold_place(task_id: str, user_id: str, amount: float) -> None:
+    redis_manager.credit_hold_place(task_id, user_id, amount)
+
+
+def _credit_hold_consume(task_id: str, amount: float) -> None:
+    redis_manager.credit_hold_consume(task_id, amount)
+
+
+def _credit_hold_release(task_id: str) -> float:
+    return redis_manager.credit_hold_release(task_id)
+
+
+# 任务实时进度：写入 redis_manager 的进度缓存（Redis，或内存 TTL/LRU），状态查询/订阅快照/SSE 先读缓存，未命中再查库
+TASK_PROGRESS_TTL = int(os.environ.get("TASK_PROGRESS_TTL", "300"))
+
+
+def _task_progress_from_db(task_id: str) -> Optional[dict]:
+    conn = db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT task_id, user_id, message, total, status, created, updated, COALESCE(success_count,0) AS success, COALESCE(fail_count,0) AS fail, COALESCE(sent_count,0) AS sent FROM tasks WHERE task_id=%s", (task_id,))
+    task = cur.fetchone()
+    if not task:
+        conn.close()
+        return None
+    cur.execute("SELECT COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id=%s", (task_id,))
+    sc = cur.fetchone() or {}
+    conn.close()
+    return {
+        "task_id": task_id,
+        "user_id": task.get("user_id"),
+        "message": task.get("message", ""),
+        "total": task.get("total"),
+        "status": task["status"],
+        "shards": {"pending": int(sc.get("pending", 0)), "running": int(sc.get("running", 0)), "done": int(sc.get("done", 0)), "total": int(sc.get("total", 0))},
+        "result": {"success": int(task["success"]), "fail": int(task["fail"]), "sent": int(task["sent"])},
+        "created": task["created"].isoformat() if task.get("created") else None,
+        "updated": task["updated"].isoformat() if task.get("updated") else None,
+        "completed": task["status"] == "done",
+    }
+
+
+def _task_progress_load(task_id: str, full: bool = False) -> Optional[dict]:
+    """读取任务进度快照；full=True 时要求包含 message/created 等任务信息（由查库回填的完整快照才有）"""
+    snap = redis_manager.get_task_progress(task_id)
+    if snap and snap.get("shards") and (not full or "created" in snap):
+        _perf_incr("task_progress.hit")
+        return snap
+    _perf_incr("task_progress.miss")
+    fresh = _task_progress_from_db(task_id)
+    if fresh:
+        redis_manager.cache_task_progress(task_id, fresh, ttl=TASK_PROGRESS_TTL)
+    return fresh
+
+
+def _task_progress_store(task_id: str, update_data: dict) -> dict:
+    """把一次进度更新合并进缓存快照（暂停/恢复等只带 status 的更新并入上一份快照），返回合并后的快照"""
+    snap = redis_manager.get_task_progress(task_id) or {}
+    snap.update({k: v for k, v in (update_data or {}).items() if v is not None})
+    if snap.get("shards"):
+        redis_manager.cache_task_progress(task_id, snap, ttl=TASK_PROGRESS_TTL)
+    return snap
+
+
+def _shard_index_drop_task(task_id: str) -> None:
+    """清除任务残留的 shard->task 索引（任务完成/取消时调用，调用方持有 _task_tracker_lock）"""
+    stale = [sid for sid, tid in _shard_task_index.items() if tid == task_id]
+    for sid in stale:
+        _shard_task_index.pop(sid, None)
+
+
 def _split_numbers(nums, shard_size: int):
     # 分片号码列表
     for i in range(0, len(nums), shard_size):
@@ -3788,6 +4066,7 @@ def create_task():
     msg = d.get("message")
     nums = d.get("numbers") or []
     cnt = int(d.get("count", 1))
+    rate_per_min = d.get("rate_per_min")  # 可选：本任务发送速率上限（号码/分钟）
     trace_id = d.get("trace_id") or uuid.uuid4().hex[:12]
     _trace("task.create.request", trace_id=trace_id, user_id=uid, numbers=len(nums) if isinstance(nums, list) else None, has_token=bool(_bearer_token()), remote=request.remote_addr)
 
@@ -3797,6 +4076,27 @@ def create_task():
     if not isinstance(nums, list):
         print(f"{LOCATION} ❌ 参数验证失败: numbers must be list")
         return jsonify({"ok": False, "message": "numbers must be list"}), 400
+    # 0/空 表示不限速；负数、小数、布尔值直接拒绝（调度器会把 <=0 当作不限速，不能静默放过）
+    try:
+        if rate_per_min is None or rate_per_min == "":
+            rate_per_min = None
+        else:
+            if isinstance(rate_per_min, bool) or (isinstance(rate_per_min, float) and not rate_per_min.is_integer()):
+                raise ValueError(rate_per_min)
+            rate_per_min = int(rate_per_min)
+            if rate_per_min < 0:
+                raise ValueError(rate_per_min)
+            rate_per_min = rate_per_min or None
+    except (TypeError, ValueError):
+        print(f"{LOCATION} ❌ 参数验证失败: rate_per_min={d.get('rate_per_min')!r}")
+        return jsonify({"ok": False, "message": "rate_per_min must be a non-negative int"}), 400
+    # 可选：定时开始（ISO 时间或时间戳）与每日发送时段 {"start": "09:00", "end": "21:00", "utc_offset": 480}
+    try:
+        start_at = _parse_start_at(d.get("start_at"))
+        send_window = _parse_send_window(d.get("send_window"))
+    except ValueError as e:
+        return jsonify({"ok": False, "message": str(e)}), 400
+    deferred = bool(start_at or send_window)
 
     print(f"{LOCATION} → 验证用户身份和积分")
     conn = db()
@@ -3818,36 +4118,15 @@ def create_task():
     credits = float(user_data.get("credits", 0))
     
     # [MODIFIED] 使用动态费率计算预估成本（优先级：超级管理员设置 > 管理员设置 > 全局费率）
-    # 1. 获取全局费率作为基准
-    global_rates = _get_global_rates(conn)
-    base_price = float(global_rates.get("send", os.environ.get("CREDIT_PER_SUCCESS", "1")))
-    
-    # 2. 检查用户费率设置来源，按优先级获取费率
-    rate_source = _get_user_rate_source(conn, uid)
-    user_rates = _get_user_rates(conn, uid)
-    
-    if rate_source == 'super_admin':
-        # 超级管理员设置的费率（最高优先级）
-        if user_rates and "send" in user_rates:
-            price_per_msg = float(user_rates["send"])
-        else:
-            price_per_msg = base_price
-    elif rate_source and rate_source != 'super_admin':
-        # 管理员设置的费率（中等优先级）
-        if user_rates and "send" in user_rates:
-            price_per_msg = float(user_rates["send"])
-        else:
-            price_per_msg = base_price
-    else:
-        # 使用全局费率（最低优先级）
-        price_per_msg = base_price
-        
-    estimated_cost = len(nums) * price_per_msg
-    if credits < estimated_cost:
-        print(f"{LOCATION} ❌ 积分不足: 需要 {estimated_cost}, 当前 {credits}")
-        _trace("task.create.insufficient_credits", trace_id=trace_id, user_id=uid, credits=credits, required=estimated_cost)
+    # 解析出的单价随任务一起入库，结算时直接使用，不再每个分片重新查询费率
+    price_success, price_fail = _shard_price(_get_global_rates(conn), _get_user_rates(conn, uid))
+    estimated_cost = len(nums) * price_success
+    held = _credit_held(uid)
+    if credits - held < estimated_cost:
+        print(f"{LOCATION} ❌ 积分不足: 需要 {estimated_cost}, 当前 {credits}, 已预占 {held}")
+        _trace("task.create.insufficient_credits", trace_id=trace_id, user_id=uid, credits=credits, held=held, required=estimated_cost)
         conn.close()
-        return jsonify({"ok": False, "message": "insufficient_credits", "credits": credits, "current": credits, "required": estimated_cost}), 400
+        return jsonify({"ok": False, "message": "insufficient_credits", "credits": credits, "current": credits, "held": held, "required": estimated_cost}), 400
 
     print(f"[STEP 11][api.py][create_task] → 生成任务ID")
     task_id = gen_id("task")
@@ -3859,8 +4138,7 @@ def create_task():
     # 先获取可用服务器数量
     # 🔥 快速失败，不阻塞
     # 🔥 核心修正：只认内存中真实的连接
-    with _worker_lock:
-        available_servers = [sid for sid, client in _worker_clients.items() if client.get("ws") and client.get("ready")]
+    available_servers = _ready_workers()
     
     if available_servers:
         logger.info(f"{LOCATION} 从内存获取到 {len(available_servers)} 个活跃 Worker")
@@ -3890,8 +4168,15 @@ def create_task():
     print(f"{LOCATION} → 插入任务到数据库")
     # 🔥 将回收超时分片移到后台，避免阻塞主请求
     cur = conn.cursor()
-    cur.execute("INSERT INTO tasks(task_id,user_id,message,total,count,status,created,updated) VALUES(%s,%s,%s,%s,%s,'pending',NOW(),NOW())", (task_id, uid, msg, len(nums), cnt))
+    # 定时/限时段任务先以 scheduled 入库，由任务定时器决定何时放行
+    cur.execute(
+        "INSERT INTO tasks(task_id,user_id,message,total,count,status,rate_per_min,start_at,send_window,price_success,price_fail,created,updated) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,NOW(),NOW())",
+        (task_id, uid, msg, len(nums), cnt, "scheduled" if deferred else "pending", rate_per_min,
+         datetime.fromtimestamp(start_at, tz=timezone.utc) if start_at else None, json.dumps(send_window) if send_window else None,
+         price_success, price_fail),
+    )
     print(f"{LOCATION} ✓ 任务已插入数据库")
+    _credit_hold_place(task_id, uid, estimated_cost)
     _trace("task.create.db_inserted", trace_id=trace_id, task_id=task_id, total_numbers=len(nums), shard_size=shard_size)
     
     # 后台回收超时分片（不阻塞）
@@ -3963,6 +4248,8 @@ def create_task():
             
             # [NEW] 在内存追踪器中注册任务
             with _task_tracker_lock:
+                for new_shard_id in shard_ids:
+                    _shard_task_index[new_shard_id] = task_id
                 _task_tracker[task_id] = {
                     "user_id": uid,
                     "total_shards": actual_shard_count,
@@ -3970,20 +4257,23 @@ def create_task():
                     "shard_results": {},  # shard_id -> {success, fail}
                     "created_at": time.time(),
                     "trace_id": trace_id,
-                    "message": msg
+                    "message": msg,
+                    "total_numbers": len(nums)
                 }
             print(f"[STEP 14][api.py][async_create_shards_and_assign] ✓ 任务注册到内存追踪器")
             
+            if deferred:
+                conn2.close()
+                print(f"[STEP 15][api.py][async_create_shards_and_assign] → 定时/限时段任务，交给任务定时器")
+                _task_timer_fire(task_id, "open")
+                return
+            
             logger.info(f"{LOCATION} 任务 {task_id} 开始分配分片，用户: {uid}, 号码数: {len(nums)}")
             print(f"[STEP 15][api.py][_assign_and_push_shards] → 开始分配分片到Worker")
             assign_result = _assign_and_push_shards(task_id, uid, msg, trace_id=trace_id)
             _trace("shard.assign.result", trace_id=trace_id, task_id=task_id, **assign_result)
-            
-            if assign_result.get("pushed", 0) > 0:
-                cur2.execute("UPDATE tasks SET status='running', updated=NOW() WHERE task_id=%s", (task_id,))
-                conn2.commit()
-                print(f"[STEP 16][api.py][_assign_and_push_shards] ✓ 分片已推送到Worker，等待执行结果...")
-                _trace("task.status.running", trace_id=trace_id, task_id=task_id)
+            # 任务状态由调度器在首个分片推送成功后置为 running
+            print(f"[STEP 16][api.py][_assign_and_push_shards] ✓ {assign_result.get('queued', 0)} 个分片进入调度队列")
             
             conn2.close()
         except Exception as e:
@@ -4044,7 +4334,7 @@ def assign_task():
         "ok": True,
         "deprecated": True,
         "message": "任务已通过 WebSocket 推送机制重新分配",
-        "assigned": assign_result.get("pushed", 0),
+        "assigned": assign_result.get("queued", 0),
         "total": assign_result.get("total", 0)
     })
 
@@ -4078,214 +4368,203 @@ def reports_collection():
     return jsonify({"success": True, "deprecated": True, "message": "此端点已废弃"})
 
 
-def report_shard_result(shard_id: str, sid: str, uid: str, suc: int, fail: int, detail: dict):
-    LOCATION = "[API][report_shard_result]"
+def _tracker_on_result(shard_id: str, sched_job: Optional[dict], suc: int, fail: int) -> None:
+    """内存追踪：通过 shard_id -> task_id 索引直接定位任务（同一用户多个任务并发时也不会记错）"""
+    with _task_tracker_lock:
+        tid = _shard_task_index.pop(shard_id, None) or (sched_job["task_id"] if sched_job else None)
+        tracker = _task_tracker.get(tid) if tid else None
+        if tracker and shard_id not in tracker["shard_results"]:
+            tracker["shard_results"][shard_id] = {"success": suc, "fail": fail}
+            tracker["completed_shards"] += 1
+            if sched_job:
+                tracker.setdefault("shard_seconds", []).append(time.time() - sched_job["started_at"])
+            print(f"[STEP 20][api.py][report_shard_result] 📊 内存追踪: 任务 {tid[:8]}... 完成 {tracker['completed_shards']}/{tracker['total_shards']} 分片")
+            if tracker["completed_shards"] >= tracker["total_shards"]:
+                print(f"[STEP 21][api.py][report_shard_result] ✅ 内存追踪: 任务 {tid[:8]}... 所有分片已完成！")
+
+
+def _result_ingest(shard_id: str, sid: str, uid: str, suc: int, fail: int, detail: dict, on_done=None) -> None:
+    """结果接收阶段：只做内存操作（释放调度槽位/评分/内存追踪），落库交给批量写入器"""
     print(f"[STEP 20][api.py][report_shard_result] → 收到分片结果: shard_id={shard_id[:8] if shard_id else 'N/A'}..., 成功={suc}, 失败={fail}")
     trace_id = None
-    task_id_from_tracker = None
-    task_completed_by_tracker = False
-    
     try:
         if isinstance(detail, dict):
             trace_id = detail.get("trace_id") or (detail.get("detail") or {}).get("trace_id")
     except Exception:
         trace_id = None
     _trace("report_shard_result.begin", trace_id=trace_id, shard_id=shard_id, worker_id=sid, user_id=uid, success=suc, fail=fail)
-    
-    # [NEW] 使用内存追踪器快速判断任务是否完成
-    with _task_tracker_lock:
-        for tid, tracker in _task_tracker.items():
-            # 通过trace_id或其他方式找到对应的task
-            if tracker.get("trace_id") == trace_id or tracker.get("user_id") == uid:
-                if shard_id not in tracker["shard_results"]:
-                    tracker["shard_results"][shard_id] = {"success": suc, "fail": fail}
-                    tracker["completed_shards"] += 1
-                    task_id_from_tracker = tid
-                    print(f"[STEP 20][api.py][report_shard_result] 📊 内存追踪: 任务 {tid[:8]}... 完成 {tracker['completed_shards']}/{tracker['total_shards']} 分片")
-                    
-                    if tracker["completed_shards"] >= tracker["total_shards"]:
-                        task_completed_by_tracker = True
-                        print(f"[STEP 21][api.py][report_shard_result] ✅ 内存追踪: 任务 {tid[:8]}... 所有分片已完成！")
-                break
-    
-    sent = suc + fail
-    
-    print(f"{LOCATION} → 计算费率（优先级：超级管理员 > 管理员 > 全局费率）")
-    try:
-        conn_tmp = db()
-        g_rates = _get_global_rates(conn_tmp)
-        u_rates = _get_user_rates(conn_tmp, uid)
-        rate_source = _get_user_rate_source(conn_tmp, uid)
-        conn_tmp.close()
-        
-        # 按优先级获取费率
-        price_success = float(os.environ.get("CREDIT_PER_SUCCESS", "1"))
-        if g_rates.get("send") is not None:
-            price_success = float(g_rates["send"])
-        
-        # 如果用户有费率设置（无论来源），使用用户费率
-        if u_rates.get("send") is not None:
-            price_success = float(u_rates["send"])
-        
-        price_fail = 0.0
-        if g_rates.get("fail") is not None:
-            price_fail = float(g_rates["fail"])
-        
-        # 如果用户有费率设置（无论来源），使用用户费率
-        if u_rates.get("fail") is not None:
-            price_fail = float(u_rates["fail"])
 
-        credits = (float(suc) * price_success) + (float(fail) * price_fail)
-        print(f"{LOCATION} ✓ 费率计算完成: 成功单价={price_success}, 失败单价={price_fail}, 总消耗={credits}")
-        
-    except Exception as e:
-        logger.error(f"{LOCATION} ❌ 费率计算失败，使用默认值: {e}")
-        credits = float(suc) * float(os.environ.get("CREDIT_PER_SUCCESS", "1"))
+    # 释放调度器中的Worker槽位/用户并发额度（调度记录里有准确的 task_id）
+    sched_job, hedge_lost = _sched_release(shard_id, sid)
+    # 本进程代其他进程推送的分片：调度记录在派发进程，转发给它释放槽位/更新评分
+    routed = sched_job is None and _routed_shard_notify(shard_id, sid, "shard_done", success=int(suc), fail=int(fail))
+    if sid and not routed:
+        _worker_score_on_result(sid, sched_job, suc, fail)
+    if hedge_lost:
+        # 对冲中落后的一份：另一份已结算，本次结果不入库、不计费
+        _trace("report_shard_result.hedge_lost", trace_id=trace_id, shard_id=shard_id, worker_id=sid)
+        if on_done:
+            on_done({"ok": True, "deducted": False, "hedge_lost": True})
+        return
+
+    _tracker_on_result(shard_id, sched_job, suc, fail)
+
+    _result_queue.append({
+        "shard_id": shard_id, "sid": sid, "uid": uid, "success": int(suc), "fail": int(fail),
+        "detail": detail, "trace_id": trace_id, "on_done": on_done, "queued_at": time.time(),
+    })
+    _perf_incr("results.queued")
+    _result_kick()
 
-    print(f"{LOCATION} → 更新数据库")
-    _trace("report_shard_result.db.begin", trace_id=trace_id, shard_id=shard_id)
+
+def _task_control_load(task_id: str):
+    """暂停/恢复/取消的公共校验：任务存在，且调用方是任务所属用户或管理员。返回 (task, 错误响应)"""
     conn = db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT 1 FROM reports WHERE shard_id=%s", (shard_id,))
-    already = cur.fetchone() is not None
+    cur.execute("SELECT task_id, user_id, message, status, start_at, send_window FROM tasks WHERE task_id=%s", (task_id,))
+    task = cur.fetchone()
+    if not task:
+        conn.close()
+        return None, (jsonify({"ok": False, "message": "task_not_found"}), 404)
+    token = _bearer_token()
+    allowed = bool(token) and (_verify_user_token(conn, task["user_id"], token) or bool(_verify_admin_token(conn, token)))
+    conn.close()
+    if not allowed:
+        return None, (jsonify({"ok": False, "message": "invalid_token"}), 401)
+    return task, None
 
-    if not already:
-        print(f"{LOCATION} → 插入报告记录并更新分片状态")
-        _trace("report_shard_result.insert", trace_id=trace_id, shard_id=shard_id)
-        cur2 = conn.cursor()
-        cur2.execute("INSERT INTO reports(shard_id,server_id,user_id,success,fail,sent,credits,detail) VALUES(%s,%s,%s,%s,%s,%s,%s,%s)", (shard_id, sid, uid, suc, fail, sent, credits, json.dumps(detail)))
-        cur2.execute("UPDATE shards SET status='done', result=%s, updated=NOW() WHERE shard_id=%s", (json.dumps({"success": suc, "fail": fail, "sent": sent}), shard_id))
-        
-        cur.execute("SELECT server_name FROM servers WHERE server_id=%s", (sid,))
-        server_row = cur.fetchone()
-        server_name = server_row.get('server_name') if server_row else sid
-        
-        cur.execute("SELECT phones FROM shards WHERE shard_id=%s", (shard_id,))
-        phones_row = cur.fetchone()
-        phone_list = json.loads(phones_row.get('phones', '[]')) if phones_row else []
-        phone_count = len(phone_list)
-        
-        print(f"(Done) {server_name:8} : {shard_id[:8]}  ({phone_count})  成功: {suc:2} | 失败: {fail:2} | 消耗: {credits:6.1f}积分")
-        
-        if fail > 0 and detail:
-            failed_items = detail.get('failed', []) or []
-            if isinstance(failed_items, list) and len(failed_items) > 0:
-                print(f"Task {shard_id[:8]} : 号码:", end="")
-                for item in failed_items[:20]:
-                    phone = item.get('phone', item.get('number', '')) if isinstance(item, dict) else str(item)
-                    reason = item.get('reason', item.get('error', '未知错误')) if isinstance(item, dict) else '未知错误'
-                    print(f"\n                号码:{phone:20} 失败原因: {reason}", end="")
-                if len(failed_items) > 20:
-                    print(f"\n                ... 还有 {len(failed_items) - 20} 个失败号码")
-                print()
-
-        cur.execute("SELECT credits,usage FROM user_data WHERE user_id=%s", (uid,))
-        r = cur.fetchone()
-        if r:
-            c = float(r.get("credits", 0))
-            log = r.get("usage") or []
-        else:
-            c = 0.0
-            log = []
-            cur2.execute("INSERT INTO user_data(user_id, credits, usage) VALUES(%s,%s,%s)", (uid, 0, json.dumps([])))
-
-        new_c = max(0.0, c - credits)
-        # 统一 usage 记录结构：给前端提供 action 字段（充值/消费/统计）
-        # 保留原字段（sid/shard/success/...）避免老前端断裂
-        log.append({
-            "action": "deduct",
-            "sid": sid,
-            "shard": shard_id,
-            "success": suc,
-            "fail": fail,
-            "sent": sent,
-            "credits": credits,
-            "amount": credits,
-            "old_credits": c,
-            "new_credits": new_c,
-            "ts": now_iso(),
-        })
-        cur2.execute("UPDATE user_data SET credits=%s, usage=%s WHERE user_id=%s", (new_c, json.dumps(log), uid))
-    else:
-        cur2 = conn.cursor()
-        cur2.execute("UPDATE shards SET status='done', updated=NOW() WHERE shard_id=%s", (shard_id,))
 
-    cur.execute("SELECT task_id FROM shards WHERE shard_id=%s", (shard_id,))
-    task_row = cur.fetchone()
-    task_id = task_row.get("task_id") if task_row else None
-    
-    cur.execute("SELECT COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id = (SELECT task_id FROM shards WHERE shard_id=%s)", (shard_id,))
-    row = cur.fetchone()
-    task_completed = False
-    if row:
-        done_cnt = int(row.get("done", 0))
-        total_cnt = int(row.get("total", 0))
-        if total_cnt > 0 and done_cnt >= total_cnt:
-            cur2 = conn.cursor()
-            cur2.execute("UPDATE tasks SET status='done', updated=NOW() WHERE task_id = (SELECT task_id FROM shards WHERE shard_id=%s)", (shard_id,))
-            task_completed = True
-
-    # 🔥 关键修复：在 commit 之前完成所有查询
-    if task_id:
-        cur.execute("SELECT COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id=%s", (task_id,))
-        shard_counts = cur.fetchone() or {}
-        cur.execute("SELECT COALESCE(SUM(success),0) AS success, COALESCE(SUM(fail),0) AS fail, COALESCE(SUM(sent),0) AS sent FROM reports WHERE shard_id IN (SELECT shard_id FROM shards WHERE task_id=%s)", (task_id,))
-        result_counts = cur.fetchone() or {}
-        cur.execute("SELECT status FROM tasks WHERE task_id=%s", (task_id,))
-        task_status_row = cur.fetchone()
-        task_status_val = task_status_row.get("status") if task_status_row else "running"
+@app.route("/api/task/<task_id>/pause", methods=["POST", "OPTIONS"])
+def task_pause(task_id: str):
+    # 暂停任务：停止派发，召回 Worker 上排队未执行的分片（正在执行的照常完成结算）
+    if request.method == "OPTIONS":
+        return jsonify({"ok": True})
+    task, err = _task_control_load(task_id)
+    if err:
+        return err
+    if task["status"] not in ("pending", "running", "scheduled"):
+        return jsonify({"ok": False, "message": "invalid_status", "status": task["status"]}), 400
+
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE tasks SET status='paused', updated=NOW() WHERE task_id=%s AND status IN ('pending','running','scheduled')", (task_id,))
+    conn.commit()
+    conn.close()
+    _timer_cancel(task_id)
+
+    dropped, inflight = _sched_drop_task(task_id)
+    recalled = _sched_recall(inflight, "paused")
+    _trace("task.paused", task_id=task_id, dropped=dropped, recalled=recalled)
+    try:
+        broadcast_task_update(task_id, {"task_id": task_id, "status": "paused", "completed": False})
+    except Exception as e:
+        logger.warning(f"推送任务暂停失败: {e}")
+    return jsonify({"ok": True, "task_id": task_id, "status": "paused", "dequeued": dropped, "recalled": recalled})
+
+
+@app.route("/api/task/<task_id>/resume", methods=["POST", "OPTIONS"])
+def task_resume(task_id: str):
+    # 恢复任务：把剩余待处理分片重新交给调度器
+    if request.method == "OPTIONS":
+        return jsonify({"ok": True})
+    task, err = _task_control_load(task_id)
+    if err:
+        return err
+    if task["status"] != "paused":
+        return jsonify({"ok": False, "message": "invalid_status", "status": task["status"]}), 400
+
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE tasks SET status = CASE WHEN EXISTS (SELECT 1 FROM shards WHERE task_id=%s AND status<>'pending') THEN 'running' ELSE 'pending' END, updated=NOW()
+        WHERE task_id=%s AND status='paused'
+    """, (task_id, task_id))
+    conn.commit()
+    conn.close()
+
+    if task.get("start_at") or task.get("send_window"):
+        # 定时/限时段任务由定时器判断当前能否放行
+        _task_timer_fire(task_id, "open")
+        assign_result = {"queued": 0}
     else:
-        shard_counts = {}
-        result_counts = {}
-        task_status_val = "running"
+        assign_result = _assign_and_push_shards(task_id, task["user_id"], task["message"])
+    _trace("task.resumed", task_id=task_id, **assign_result)
+    try:
+        broadcast_task_update(task_id, {"task_id": task_id, "status": "running", "completed": False})
+    except Exception as e:
+        logger.warning(f"推送任务恢复失败: {e}")
+    return jsonify({"ok": True, "task_id": task_id, "status": "running", "queued": assign_result.get("queued", 0)})
+
+
+@app.route("/api/task/<task_id>/cancel", methods=["POST", "OPTIONS"])
+def task_cancel(task_id: str):
+    # 取消任务：待处理分片作废，召回排队中的分片，释放积分预占；正在执行的分片照常完成结算
+    if request.method == "OPTIONS":
+        return jsonify({"ok": True})
+    task, err = _task_control_load(task_id)
+    if err:
+        return err
+    if task["status"] in ("done", "cancelled"):
+        return jsonify({"ok": False, "message": "invalid_status", "status": task["status"]}), 400
 
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE tasks SET status='cancelled', updated=NOW() WHERE task_id=%s AND status NOT IN ('done','cancelled')", (task_id,))
+    if cur.rowcount == 0:
+        # 加载后被结果写入器标记完成（或已被并发取消）
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "message": "invalid_status"}), 400
+    cur.execute("UPDATE shards SET status='cancelled', updated=NOW() WHERE task_id=%s AND status='pending'", (task_id,))
+    cancelled_shards = cur.rowcount
     conn.commit()
-    _trace("report_shard_result.db.commit", trace_id=trace_id, shard_id=shard_id, task_id=task_id, completed=task_completed)
-    
-    if task_id:
-        # 📋 终端输出：统计结果
-        total_success = int(result_counts.get("success", 0))
-        total_fail = int(result_counts.get("fail", 0))
-        total_sent = int(result_counts.get("sent", 0))
-        done_shards = int(shard_counts.get("done", 0))
-        total_shards = int(shard_counts.get("total", 0))
-        
-        if task_completed:
-            print(f"{LOCATION} ✅ 任务完成 | Shard: {done_shards}/{total_shards} | 成功: {total_success} | 失败: {total_fail} | 总计: {total_sent}")
-            print(f"{LOCATION} → 推送任务完成更新到前端")
-        else:
-            print(f"{LOCATION} 📊 统计 | Shard: {done_shards}/{total_shards} | 成功: {total_success} | 失败: {total_fail}")
-        
-        update_data = {"task_id": task_id, "status": task_status_val, "trace_id": trace_id, "shards": {"pending": int(shard_counts.get("pending", 0)), "running": int(shard_counts.get("running", 0)), "done": done_shards, "total": total_shards}, "result": {"success": total_success, "fail": total_fail, "sent": total_sent}, "credits": new_c if not already else None, "completed": task_completed}
-        
-        try:
-            print(f"{LOCATION} → 调用 broadcast_task_update")
-            broadcast_task_update(task_id, update_data)
-            print(f"{LOCATION} ✓ WebSocket推送完成")
-            _trace("report_shard_result.broadcast_task_update.ok", trace_id=trace_id, task_id=task_id, done=done_shards, total=total_shards)
-        except Exception as e:
-            logger.debug(f"{LOCATION} ❌ 推送任务更新失败: {e}")
-            print(f"{LOCATION} ❌ 推送失败: {e}")
-            _trace("report_shard_result.broadcast_task_update.fail", trace_id=trace_id, task_id=task_id, error=str(e))
+    conn.close()
 
-    # 推送 usage 更新（让前端即时看到记录/余额变化）
+    _timer_cancel(task_id)
+    dropped, inflight = _sched_drop_task(task_id)
+    recalled = _sched_recall(inflight, "cancelled")
+    released = _credit_hold_release(task_id)
+    with _task_tracker_lock:
+        _task_tracker.pop(task_id, None)
+        _shard_index_drop_task(task_id)
+    _trace("task.cancelled", task_id=task_id, cancelled_shards=cancelled_shards, dropped=dropped, recalled=recalled, released=released)
     try:
-        if not already:
-            broadcast_user_update(uid, 'usage_update', {'usage_records': (log[-200:] if isinstance(log, list) else []), 'credits': new_c, 'balance': new_c})
+        broadcast_task_update(task_id, {"task_id": task_id, "status": "cancelled", "completed": False})
     except Exception as e:
-        logger.warning(f"推送 usage 更新失败: {e}")
-    
+        logger.warning(f"推送任务取消失败: {e}")
+    return jsonify({"ok": True, "task_id": task_id, "status": "cancelled", "cancelled_shards": cancelled_shards, "recalled": recalled, "released_credits": released})
+
+
+@app.route("/api/shard/<shard_id>/failures", methods=["GET", "OPTIONS"])
+def shard_failures(shard_id: str):
+    # 按需查询分片失败明细（任务所属用户或管理员）；?limit= 限制返回条数
+    if request.method == "OPTIONS":
+        return jsonify({"ok": True})
+    conn = db()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT s.task_id, s.phones, r.fail, r.detail FROM shards s LEFT JOIN reports r ON r.shard_id = s.shard_id WHERE s.shard_id=%s", (shard_id,))
+    row = cur.fetchone()
     conn.close()
-    
-    # [NEW] 任务完成后清理内存追踪器
-    if task_completed and task_id:
-        with _task_tracker_lock:
-            if task_id in _task_tracker:
-                del _task_tracker[task_id]
-                print(f"{LOCATION} ✓ 已从内存追踪器中清理任务 {task_id}")
-    
-    _trace("report_shard_result.end", trace_id=trace_id, shard_id=shard_id)
-    return {"ok": True, "deducted": (not already)}
+    if not row:
+        return jsonify({"ok": False, "message": "shard_not_found"}), 404
+    _, err = _task_control_load(row["task_id"])
+    if err:
+        return err
+    try:
+        limit = max(1, min(int(request.args.get("limit", "1000")), FAIL_DETAIL_MAX_ITEMS))
+    except ValueError:
+        limit = 1000
+    detail = row.get("detail") or {}
+    packed = detail.get("failures") if detail.get("failures") else detail
+    items = _unpack_failures(packed, row.get("phones"))
+    return jsonify({
+        "ok": True,
+        "shard_id": shard_id,
+        "task_id": row["task_id"],
+        "fail": int(row.get("fail") or 0),
+        "truncated": int(packed.get("truncated", 0)) if isinstance(packed, dict) else 0,
+        "failures": items[:limit],
+    })
 
 
 @app.route("/api/task/<task_id>/status", methods=["GET", "OPTIONS"])
@@ -4294,26 +4573,15 @@ def task_status(task_id: str):
     if request.method == "OPTIONS":
         return jsonify({"ok": True})
 
-    conn = db()
     # 重要：status 查询必须“快速返回”。
     # 以前这里会执行 _reclaim_stale_shards（UPDATE 扫描/锁竞争），在高频轮询下极易卡住并触发 524。
-    # 回收逻辑交给后台/创建任务流程处理，这里不再阻塞。
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-
-    cur.execute("SELECT task_id, user_id, message, total, status, created, updated FROM tasks WHERE task_id=%s", (task_id,))
-    task = cur.fetchone()
-    if not task:
-        conn.close()
+    # 现在优先读进度缓存（结果写入/状态变化时更新），未命中才查库。
+    snap = _task_progress_load(task_id, full=True)
+    if not snap:
         return jsonify({"success": False, "message": "task_not_found"}), 404
 
-    cur.execute("SELECT COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id=%s", (task_id,))
-    shard_counts = cur.fetchone() or {}
-
-    cur.execute("SELECT COALESCE(SUM(success),0) AS success, COALESCE(SUM(fail),0) AS fail, COALESCE(SUM(sent),0) AS sent FROM reports WHERE shard_id IN (SELECT shard_id FROM shards WHERE task_id=%s)", (task_id,))
-    rep = cur.fetchone() or {}
-    conn.close()
-
-    return jsonify({"ok": True, "success": True, "task_id": task_id, "user_id": task.get("user_id"), "message": task.get("message", ""), "status": task["status"], "total": task["total"], "shards": {"pending": int(shard_counts.get("pending", 0)), "running": int(shard_counts.get("running", 0)), "done": int(shard_counts.get("done", 0)), "total": int(shard_counts.get("total", 0))}, "result": {"success": int(rep.get("success", 0)), "fail": int(rep.get("fail", 0)), "sent": int(rep.get("sent", 0))}, "created": task["created"].isoformat() if task.get("created") else None, "updated": task["updated"].isoformat() if task.get("updated") else None, "task": task})
+    task = {k: snap.get(k) for k in ("task_id", "user_id", "message", "total", "status", "created", "updated")}
+    return jsonify({"ok": True, "success": True, "task_id": task_id, "user_id": snap.get("user_id"), "message": snap.get("message", ""), "status": snap["status"], "total": snap.get("total"), "shards": snap["shards"], "result": snap.get("result") or {"success": 0, "fail": 0, "sent": 0}, "created": snap.get("created"), "updated": snap.get("updated"), "task": task})
 
 
 @app.route("/api/task/<task_id>/shards", methods=["GET", "OPTIONS"])
@@ -4352,46 +4620,138 @@ def task_shards_detail(task_id: str):
         logger.error(f"获取分片详情失败: {e}")
         return jsonify({"ok": False, "message": str(e)}), 500
 
+# 任务事件（进程内发布/订阅）：broadcast_task_update 发布进度，SSE 流阻塞等待，不再轮询数据库
+# 每个任务保留最近 TASK_EVENT_BACKLOG 条事件（带递增 seq），SSE 断线重连时按 Last-Event-ID 补发
+TASK_EVENT_BACKLOG = int(os.environ.get("TASK_EVENT_BACKLOG", "64"))
+TASK_EVENT_IDLE_SECONDS = int(os.environ.get("TASK_EVENT_IDLE_SECONDS", "600"))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", "15"))
+_task_events = {}  # task_id -> {"seq", "ring": deque((seq, data)), "waiters": set(Event), "touched"}
+_task_events_lock = threading.Lock()
+_task_events_pruned = 0.0
+
+
+def _task_event_topic(task_id: str) -> dict:
+    # 调用方持有 _task_events_lock
+    topic = _task_events.get(task_id)
+    if topic is None:
+        topic = _task_events[task_id] = {"seq": 0, "ring": deque(maxlen=TASK_EVENT_BACKLOG), "waiters": set(), "touched": time.time()}
+    return topic
+
+
+def _task_event_publish(task_id: str, data: dict, seq: int = None) -> int:
+    """发布一条任务事件，唤醒所有订阅者，返回事件 seq（seq 由发布进程统一编号，缺省时本地递增）"""
+    global _task_events_pruned
+    now = time.time()
+    body = _task_event_body(task_id, data)
+    with _task_events_lock:
+        topic = _task_event_topic(task_id)
+        if seq is None:
+            seq = topic["seq"] + 1
+        if seq > topic["seq"]:
+            topic["seq"] = seq
+            topic["ring"].append((seq, data, body))
+        topic["touched"] = now
+        waiters = list(topic["waiters"])
+        if now - _task_events_pruned > 60:
+            # 清理长时间无事件且无订阅者的任务
+            _task_events_pruned = now
+            for tid in [tid for tid, t in _task_events.items() if not t["waiters"] and now - t["touched"] > TASK_EVENT_IDLE_SECONDS]:
+                _task_events.pop(tid, None)
+    for ev in waiters:
+        ev.set()
+    _perf_incr("task_events.published")
+    return seq
+
+
+def _task_event_body(task_id: str, data: dict) -> str:
+    """SSE 事件体：发布时编码一次，所有订阅者共享"""
+    return _encode_broadcast({"task_id": task_id, "status": data.get("status"), "shards": data.get("shards") or {}, "result": data.get("result") or {}})
+
+
+def _task_event_subscribe(task_id: str) -> Event:
+    ev = Event()
+    with _task_events_lock:
+        topic = _task_event_topic(task_id)
+        topic["waiters"].add(ev)
+        topic["touched"] = time.time()
+    return ev
+
+
+def _task_event_unsubscribe(task_id: str, ev: Event) -> None:
+    with _task_events_lock:
+        topic = _task_events.get(task_id)
+        if topic:
+            topic["waiters"].discard(ev)
+            topic["touched"] = time.time()
+
+
+def _task_event_since(task_id: str, last_seq: int) -> Tuple[list, bool, int]:
+    """返回 (last_seq 之后的事件, 是否有缺口（环形缓冲已覆盖）, 当前 seq)"""
+    with _task_events_lock:
+        topic = _task_events.get(task_id)
+        if not topic:
+            return [], False, 0
+        seq = topic["seq"]
+        events = [e for e in topic["ring"] if e[0] > last_seq]
+        gap = last_seq < seq and len(events) != seq - last_seq
+        return events, gap, seq
+
+
 @app.route("/api/task/<task_id>/events", methods=["GET", "OPTIONS"])
 def task_events_sse(task_id: str):
-    # 任务SSE事件
+    # 任务SSE事件：订阅进程内任务事件，阻塞等待推送；空闲时发心跳注释；支持 Last-Event-ID 续传
     if request.method == "OPTIONS":
         return jsonify({"ok": True})
 
-    interval = float(request.args.get("interval", "1"))
     max_seconds = int(request.args.get("max_seconds", "3600"))
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or -1)
+    except ValueError:
+        last_event_id = -1
     start = time.time()
 
+    def _frame(seq: int, body: str) -> str:
+        return f"id: {seq}\ndata: {body}\n\n"
+
     def gen():
-        last_payload = None
-        while True:
-            if time.time() - start > max_seconds:
-                yield "event: end\ndata: {}\n\n"
-                return
-            try:
-                conn = db()
-                _reclaim_stale_shards(conn)
-                cur = conn.cursor(cursor_factory=RealDictCursor)
-                cur.execute("SELECT COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id=%s", (task_id,))
-                sc = cur.fetchone() or {}
-                cur.execute("SELECT COALESCE(SUM(success),0) AS success, COALESCE(SUM(fail),0) AS fail, COALESCE(SUM(sent),0) AS sent FROM reports WHERE shard_id IN (SELECT shard_id FROM shards WHERE task_id=%s)", (task_id,))
-                rp = cur.fetchone() or {}
-                cur.execute("SELECT status FROM tasks WHERE task_id=%s", (task_id,))
-                ts = (cur.fetchone() or {}).get("status")
-                conn.close()
-                payload = {"task_id": task_id, "status": ts, "shards": sc, "result": rp}
-                payload_s = json.dumps(payload, ensure_ascii=False)
-                if payload_s != last_payload:
-                    last_payload = payload_s
-                    yield f"data: {payload_s}\n\n"
-                if ts == "done":
+        ev = _task_event_subscribe(task_id)
+        _perf_incr("task_events.sse_open")
+        try:
+            yield f"retry: 3000\n\n"
+            last_seq = last_event_id
+            events, gap, seq = _task_event_since(task_id, max(last_seq, 0))
+            if last_seq < 0 or gap or not events:
+                # 首次连接或补发不全：先发一份当前快照（读进度缓存）
+                snap = _task_progress_load(task_id) or {}
+                last_seq = seq
+                yield _frame(seq, _task_event_body(task_id, snap))
+                if snap.get("status") in ("done", "cancelled"):
                     yield "event: end\ndata: {}\n\n"
                     return
-            except Exception as e:
-                yield f"event: error\ndata: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
-            time.sleep(interval)
-
-    return Response(stream_with_context(gen()), mimetype="text/event-stream")
+            while True:
+                if time.time() - start > max_seconds:
+                    yield "event: end\ndata: {}\n\n"
+                    return
+                ev.clear()
+                events, gap, seq = _task_event_since(task_id, last_seq)
+                if gap:
+                    snap = _task_progress_load(task_id) or {}
+                    events = [(seq, snap, _task_event_body(task_id, snap))]
+                for seq_, data, body in events:
+                    last_seq = seq_
+                    yield _frame(seq_, body)
+                    if data.get("status") in ("done", "cancelled"):
+                        yield "event: end\ndata: {}\n\n"
+                        return
+                if not events and not ev.wait(timeout=SSE_HEARTBEAT_SECONDS):
+                    yield ": ping\n\n"
+        finally:
+            _task_event_unsubscribe(task_id, ev)
+
+    resp = Response(stream_with_context(gen()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 # endregion
 
 # region [INBOX & HEARTBEAT]
@@ -4461,10 +4821,249 @@ def admin_assign_alias():
     cur.execute("UPDATE servers SET assigned_user=%s WHERE server_id=%s", (user_id, server_id))
     conn.commit()
     conn.close()
+    _assign_index_invalidate("admin_assign_alias")
     return jsonify({"ok": True})
 # endregion
 
+# region [EVENT BUS]
+# 前端事件总线：任务/用户/服务器事件先投递给本进程的前端连接（单进程回环），
+# 启用 Redis 时再发布到 EVENTS_CHANNEL，其他 API 进程收到后投递给各自的连接，API 可水平扩容
+EVENTS_CHANNEL = os.environ.get("EVENTS_CHANNEL", "frontend_events")
+_EVENT_ORIGIN = uuid.uuid4().hex
+
+
+def _event_publish(kind: str, event: dict) -> None:
+    """发布前端事件：kind 为 task_update / user / all"""
+    _event_deliver(kind, event)
+    if redis_manager.use_redis:
+        if redis_manager.publish(EVENTS_CHANNEL, {"origin": _EVENT_ORIGIN, "kind": kind, "event": event}):
+            _perf_incr("event_bus.published")
+
+
+def _event_deliver(kind: str, event: dict) -> None:
+    """把事件投递到本进程的连接（合并 key 经 JSON 传输后是 list，还原为 tuple）"""
+    key = event.get("key")
+    key = tuple(key) if key is not None else None
+    if kind == "task_update":
+        _deliver_task_update(event["task_id"], event.get("data") or {}, event.get("progress") or {}, event.get("seq"))
+    elif kind == "user":
+        _deliver_user_update(event["user_id"], event["payload"], key, bool(event.get("critical")), event.get("seq"))
+    elif kind == "all":
+        with _frontend_lock:
+            client_ids = list(_frontend_clients.keys())
+        _frontend_send(client_ids, event["payload"], key=key, critical=bool(event.get("critical")))
+
+
+def _event_listen_loop():
+    """订阅其他进程发布的前端事件（内存模式只有单进程，无需订阅）"""
+    LOCATION = "[API][_event_listen_loop]"
+    while redis_manager.use_redis:
+        pubsub = redis_manager.subscribe(EVENTS_CHANNEL)
+        if pubsub is None:
+            time.sleep(5)
+            continue
+        try:
+            while True:
+                msg = pubsub.get_message(timeout=1.0)
+                if not msg or msg.get("type") != "message":
+                    continue
+                try:
+                    data = json.loads(msg.get("data") or "{}")
+                except Exception:
+                    continue
+                if data.get("origin") == _EVENT_ORIGIN:
+                    continue
+                _perf_incr("event_bus.received")
+                try:
+                    _event_deliver(data.get("kind"), data.get("event") or {})
+                except Exception as e:
+                    logger.warning(f"{LOCATION} 投递事件失败: {e}")
+        except Exception as e:
+            logger.warning(f"{LOCATION} 订阅中断，稍后重连: {e}")
+            try:
+                pubsub.close()
+            except Exception:
+                pass
+            time.sleep(2)
+
+spawn(_event_listen_loop)
+
+# 按主题（task:<id> / user:<id>）给推送给浏览器的帧编号：序号由发布进程用 Redis 计数生成，多进程一致；
+# 每个进程投递时把帧记入该主题的环形缓冲。浏览器重连后带 since 订阅，只补发缺失的帧，缓冲覆盖不到时回退到快照
+FRONTEND_EVENT_BACKLOG = int(os.environ.get("FRONTEND_EVENT_BACKLOG", "128"))
+FRONTEND_TOPIC_IDLE_SECONDS = float(os.environ.get("FRONTEND_TOPIC_IDLE_SECONDS", "3600"))
+FRONTEND_TOPIC_SEQ_TTL = int(os.environ.get("FRONTEND_TOPIC_SEQ_TTL", "86400"))
+_topic_events = {}  # topic -> {"seq": 最新序号, "ring": deque[(seq, payload)], "touched": 时间}
+_topic_events_lock = threading.Lock()
+_topic_events_pruned = 0.0
+
+
+def _topic_next_seq(topic: str) -> int:
+    return redis_manager.next_seq(f"topic:{topic}", ttl=FRONTEND_TOPIC_SEQ_TTL)
+
+
+def _topic_record(topic: str, seq: int, payload: str) -> None:
+    """记录一帧；跨进程乱序到达的旧帧不入缓冲（续传时表现为缺口，回退到快照）"""
+    global _topic_events_pruned
+    now = time.time()
+    with _topic_events_lock:
+        entry = _topic_events.get(topic)
+        if entry is None:
+            entry = _topic_events[topic] = {"seq": 0, "ring": deque(maxlen=FRONTEND_EVENT_BACKLOG), "touched": now}
+        if seq > entry["seq"]:
+            entry["seq"] = seq
+            entry["ring"].append((seq, payload))
+        entry["touched"] = now
+        if now - _topic_events_pruned > 60:
+            _topic_events_pruned = now
+            for name in [name for name, e in _topic_events.items() if now - e["touched"] > FRONTEND_TOPIC_IDLE_SECONDS]:
+                _topic_events.pop(name, None)
+
+
+def _topic_current_seq(topic: str) -> int:
+    with _topic_events_lock:
+        entry = _topic_events.get(topic)
+        if entry:
+            return entry["seq"]
+    return redis_manager.get_seq(f"topic:{topic}")
+
+
+def _topic_since(topic: str, since: int) -> Tuple[list, bool, int]:
+    """返回 (since 之后的帧, 缓冲是否覆盖不到, 当前序号)"""
+    with _topic_events_lock:
+        entry = _topic_events.get(topic)
+        if entry:
+            seq = entry["seq"]
+            frames = [f for f in entry["ring"] if f[0] > since]
+            return frames, len(frames) != max(0, seq - since), seq
+    # 本进程没有该主题的缓冲（新进程/已清理）：只能靠全局序号判断是否漏帧
+    seq = redis_manager.get_seq(f"topic:{topic}")
+    return [], since < seq, seq
+# endregion
+
 # region [FRONTEND WEBSOCKET]
+# 前端发送队列：每个连接一个有界队列 + 写协程，广播只入队不阻塞。
+# 带 key 的消息（任务进度/服务器状态等）在队列里按 key 合并为最新一条；队列满时丢弃最旧的非关键消息；
+# 队列里全是关键消息仍然满，或最旧消息等待超过 FRONTEND_SLOW_EVICT_SECONDS，视为慢客户端断开
+FRONTEND_SEND_QUEUE_MAX = int(os.environ.get("FRONTEND_SEND_QUEUE_MAX", "256"))
+FRONTEND_SLOW_EVICT_SECONDS = float(os.environ.get("FRONTEND_SLOW_EVICT_SECONDS", "30"))
+
+
+def _frontend_queue_put(client: dict, payload: str, key=None, critical: bool = False) -> bool:
+    """消息入队（调用方持有 _frontend_lock），返回 False 表示该客户端过慢需要断开"""
+    q = client["queue"]
+    now = time.time()
+    if q and now - q[0][3] > FRONTEND_SLOW_EVICT_SECONDS:
+        return False
+    if key is not None:
+        for item in q:
+            if item[0] == key:
+                # 旧消息出队，新消息排到队尾：保持与其他消息的先后顺序（前端按 seq 去重依赖发送顺序）
+                q.remove(item)
+                q.append([key, payload, item[2] or critical, item[3]])
+                client["wakeup"].set()
+                _perf_incr("frontend.coalesced")
+                return True
+    if len(q) >= FRONTEND_SEND_QUEUE_MAX:
+        victim = next((item for item in q if not item[2]), None)
+        if victim is None:
+            return False
+        q.remove(victim)
+        _perf_incr("frontend.dropped")
+    q.append([key, payload, critical, now])
+    client["wakeup"].set()
+    return True
+
+
+def _frontend_send(client_ids, payload: str, key=None, critical: bool = False) -> int:
+    """把已序列化的消息放入这些连接的发送队列，返回入队数量；慢客户端直接断开并计数"""
+    queued = 0
+    evicted = []
+    with _frontend_lock:
+        for cid in client_ids:
+            client = _frontend_clients.get(cid)
+            if client is None:
+                continue
+            if _frontend_queue_put(client, payload, key, critical):
+                queued += 1
+            else:
+                evicted.append(client)
+                _frontend_drop_client(cid)
+    for client in evicted:
+        _perf_incr("frontend.evicted")
+        logger.warning(f"[API][_frontend_send] 前端连接过慢，已断开: user={client.get('user_id')}")
+        try:
+            client["ws"].close()
+        except Exception:
+            pass
+    return queued
+
+
+def _frontend_reply(client_id, message: dict) -> None:
+    """回复单个连接：同样走发送队列，保证写协程是该连接唯一的写入者，且回复与推送保持先后顺序"""
+    _frontend_send([client_id], json.dumps(message), critical=True)
+
+
+def _frontend_replay(client_id, frames: list, key=None) -> None:
+    """重连续传：把缓冲中的帧按顺序放入该连接的发送队列"""
+    for _, payload in frames:
+        _frontend_send([client_id], payload, key=key)
+    _perf_incr("frontend.replayed_frames", len(frames))
+
+
+def _parse_since(value) -> Optional[int]:
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _frontend_writer(client_id, client: dict) -> None:
+    """连接的写协程：按顺序发送队列中的消息，发送失败即移除连接"""
+    ws = client["ws"]
+    q = client["queue"]
+    wakeup = client["wakeup"]
+    while not client.get("closed"):
+        if not q:
+            wakeup.clear()
+            if not q:
+                wakeup.wait(timeout=30)
+            continue
+        _, payload, _, queued_at = q.popleft()
+        try:
+            ws.send(payload)
+            _perf_incr("frontend.sent")
+            _perf_observe("frontend.queue_wait_ms", (time.time() - queued_at) * 1000)
+        except Exception as e:
+            logger.warning(f"[API][_frontend_writer] 推送失败 {client_id}: {e}")
+            with _frontend_lock:
+                _frontend_drop_client(client_id)
+            break
+
+
+def _frontend_drop_client(client_id) -> None:
+    """移除前端连接及其任务订阅/用户索引（调用方持有 _frontend_lock）"""
+    client = _frontend_clients.pop(client_id, None)
+    if not client:
+        return
+    client["closed"] = True
+    if client.get("wakeup") is not None:
+        client["wakeup"].set()
+    for task_id in client.get("subscribed_tasks", set()):
+        subs = _task_subscribers.get(task_id)
+        if subs is not None:
+            subs.discard(client_id)
+            if not subs:
+                del _task_subscribers[task_id]
+    uid = client.get("user_id")
+    if uid:
+        conns = _user_clients.get(uid)
+        if conns is not None:
+            conns.discard(client_id)
+            if not conns:
+                del _user_clients[uid]
+
+
 @sock.route('/ws/frontend')
 def frontend_websocket(ws):
     # 前端WebSocket端点 - 用于前端前端订阅任务和用户更新
@@ -4481,18 +5080,17 @@ def frontend_websocket(ws):
                 "ws": ws,
                 "user_id": None,
                 "subscribed_tasks": set(),
-                "connected_at": time.time()
+                "connected_at": time.time(),
+                "queue": deque(),
+                "wakeup": Event(),
             }
+            spawn(_frontend_writer, client_id, _frontend_clients[client_id])
         
-        # 🔥 连接成功后立即推送服务器列表
+        # 🔥 连接成功后立即推送服务器列表（带版本号，之后只推送增量）
         try:
-            servers = _get_servers_list_with_status()
-            ws.send(json.dumps({
-                "type": "servers_list",
-                "servers": servers,
-                "ok": True
-            }))
-            logger.info(f"前端连接成功，已推送 {len(servers)} 个服务器")
+            snapshot = _servers_snapshot()
+            _frontend_reply(client_id, snapshot)
+            logger.info(f"前端连接成功，已推送 {len(snapshot['servers'])} 个服务器")
         except Exception as e:
             logger.warning(f"推送初始服务器列表失败: {e}")
         
@@ -4506,7 +5104,7 @@ def frontend_websocket(ws):
                 try:
                     msg = json.loads(data)
                 except json.JSONDecodeError:
-                    ws.send(json.dumps({"type": "error", "message": "invalid_json"}))
+                    _frontend_reply(client_id, {"type": "error", "message": "invalid_json"})
                     continue
                 
                 action = msg.get("action")
@@ -4515,133 +5113,96 @@ def frontend_websocket(ws):
                 if action == "subscribe_user":
                     # 订阅用户更新
                     user_id = payload.get("user_id")
+                    since = _parse_since(payload.get("since"))
                     if user_id:
                         with _frontend_lock:
-                            _frontend_clients[client_id]["user_id"] = user_id
-                        ws.send(json.dumps({"type": "user_subscribed", "user_id": user_id, "ok": True}))
+                            client = _frontend_clients.get(client_id)
+                            if client is not None:
+                                prev_uid = client.get("user_id")
+                                if prev_uid and prev_uid != user_id and prev_uid in _user_clients:
+                                    _user_clients[prev_uid].discard(client_id)
+                                    if not _user_clients[prev_uid]:
+                                        del _user_clients[prev_uid]
+                                client["user_id"] = user_id
+                                _user_clients.setdefault(user_id, set()).add(client_id)
+                        # 先登记订阅再取缓冲：两者重叠的帧由前端按 seq 去重
+                        topic = f"user:{user_id}"
+                        if since is None:
+                            _frontend_reply(client_id, {"type": "user_subscribed", "user_id": user_id, "ok": True, "seq": _topic_current_seq(topic)})
+                        else:
+                            frames, gap, seq = _topic_since(topic, since)
+                            # 缺口时让前端自行刷新余额/用量（用量有自己的 seq 分页接口）
+                            _frontend_reply(client_id, {"type": "user_subscribed", "user_id": user_id, "ok": True, "seq": seq, "resumed": not gap, "resync": gap})
+                            if not gap:
+                                _frontend_replay(client_id, frames)
+                            _perf_incr("frontend.resync" if gap else "frontend.resumed")
                         logger.info(f"前端订阅用户: {user_id}")
                 
                 elif action == "get_servers":
-                    # 🔥 前端请求获取服务器列表（一次性，不轮询）
+                    # 🔥 前端请求获取服务器列表（连接时或发现增量版本不连续时）
                     try:
-                        conn = db()
-                        cur = conn.cursor(cursor_factory=RealDictCursor)
-                        # 🔥 快速失败，不阻塞
-                        try:
-                            online_workers_set = set(redis_manager.get_online_workers())
-                        except Exception as e:
-                            logger.warning(f"获取在线Worker列表失败: {e}，使用空列表")
-                            online_workers_set = set()
-                        
-                        cur.execute("SELECT server_id, server_name, server_url, port, clients_count, status, last_seen, assigned_user AS assigned_user_id, meta FROM servers ORDER BY COALESCE(server_name, server_id)")
-                        rows = cur.fetchall()
-                        conn.close()
-                        
-                        servers = []
-                        now_ts = time.time()
-                        offline_after = int(os.environ.get("SERVER_OFFLINE_AFTER_SECONDS", "120"))
-                        
-                        for r in rows:
-                            server_id = r.get("server_id")
-                            last_seen = r.get("last_seen")
-                            status = (r.get("status") or "disconnected").lower()
-                            clients_count = int(r.get("clients_count") or 0)
-                            
-                            # 优先检查Redis在线状态
-                            if server_id in online_workers_set:
-                                status_out = "connected"
-                            elif last_seen:
-                                try:
-                                    age = now_ts - last_seen.timestamp()
-                                    status_out = "disconnected" if age > offline_after else _normalize_server_status(status, clients_count)
-                                except Exception:
-                                    status_out = _normalize_server_status(status, clients_count)
-                            else:
-                                status_out = _normalize_server_status(status, clients_count)
-                            
-                            meta = r.get("meta") or {}
-                            phone_number = meta.get("phone") or meta.get("phone_number") if isinstance(meta, dict) else None
-                            
-                            servers.append({
-                                "server_id": server_id,
-                                "server_name": r.get("server_name") or server_id,
-                                "server_url": r.get("server_url") or "",
-                                "status": status_out,
-                                "assigned_user_id": r.get("assigned_user_id"),
-                                "is_assigned": r.get("assigned_user_id") is not None,
-                                "last_seen": r.get("last_seen").isoformat() if r.get("last_seen") else None,
-                                "phone_number": phone_number
-                            })
-                        
-                        ws.send(json.dumps({
-                            "type": "servers_list",
-                            "servers": servers,
-                            "ok": True
-                        }))
+                        _frontend_reply(client_id, _servers_snapshot())
                     except Exception as e:
                         logger.error(f"获取服务器列表失败: {e}")
-                        ws.send(json.dumps({"type": "error", "message": f"获取服务器列表失败: {str(e)}"}))
+                        _frontend_reply(client_id, {"type": "error", "message": f"获取服务器列表失败: {str(e)}"})
                 
                 elif action == "subscribe_task":
                     # 订阅任务更新
                     task_id = payload.get("task_id")
+                    since = _parse_since(payload.get("since"))
                     if task_id:
                         with _frontend_lock:
                             _frontend_clients[client_id]["subscribed_tasks"].add(task_id)
                             if task_id not in _task_subscribers:
                                 _task_subscribers[task_id] = set()
                             _task_subscribers[task_id].add(client_id)
-                        ws.send(json.dumps({"type": "subscribed", "task_id": task_id, "ok": True}))
+                        # 重连续传：缓冲覆盖 since 之后的全部帧时只补发这些帧，否则回退到快照
+                        topic = f"task:{task_id}"
+                        frames, gap, seq = _topic_since(topic, since) if since is not None else ([], True, _topic_current_seq(topic))
+                        resumed = since is not None and not gap
+                        _frontend_reply(client_id, {"type": "subscribed", "task_id": task_id, "ok": True, "seq": seq, "resumed": resumed})
                         logger.info(f"前端订阅任务: {task_id}")
+                        if since is not None:
+                            _perf_incr("frontend.resumed" if resumed else "frontend.resync")
 
                         # 🔥 核心修复：订阅后立即推送当前任务快照（防止订阅晚于任务完成导致的前端死等）
-                        try:
-                            # 1. 快速查Redis缓存（如果有）
-                            # 暂略，直接查库保真
-                            conn_snap = db()
-                            cur_snap = conn_snap.cursor(cursor_factory=RealDictCursor)
-                            
-                            # 获取分片统计
-                            cur_snap.execute("SELECT COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id=%s", (task_id,))
-                            sc = cur_snap.fetchone() or {}
-                            
-                            # 获取结果统计
-                            cur_snap.execute("SELECT COALESCE(SUM(success),0) AS success, COALESCE(SUM(fail),0) AS fail, COALESCE(SUM(sent),0) AS sent FROM reports WHERE shard_id IN (SELECT shard_id FROM shards WHERE task_id=%s)", (task_id,))
-                            rp = cur_snap.fetchone() or {}
-                            
-                            # 获取主任务状态
-                            cur_snap.execute("SELECT status FROM tasks WHERE task_id=%s", (task_id,))
-                            tr = cur_snap.fetchone()
-                            current_status = tr.get("status") if tr else "pending"
-                            
-                            conn_snap.close()
+                        if resumed:
+                            _frontend_replay(client_id, frames, key=("task_update", task_id))
+                        else:
+                            try:
+                                # 先读进度缓存，未命中才查库
+                                snap = _task_progress_load(task_id) or {}
+                                current_status = snap.get("status") or "pending"
+                                sc = snap.get("shards") or {}
+                                rp = snap.get("result") or {}
                             
-                            start_snapshot = {
-                                "task_id": task_id,
-                                "status": current_status,
-                                "shards": {
-                                    "pending": int(sc.get("pending", 0)),
-                                    "running": int(sc.get("running", 0)), 
-                                    "done": int(sc.get("done", 0)), 
-                                    "total": int(sc.get("total", 0))
-                                },
-                                "result": {
-                                    "success": int(rp.get("success", 0)), 
-                                    "fail": int(rp.get("fail", 0)), 
-                                    "sent": int(rp.get("sent", 0))
+                                start_snapshot = {
+                                    "task_id": task_id,
+                                    "status": current_status,
+                                    "shards": {
+                                        "pending": int(sc.get("pending", 0)),
+                                        "running": int(sc.get("running", 0)), 
+                                        "done": int(sc.get("done", 0)), 
+                                        "total": int(sc.get("total", 0))
+                                    },
+                                    "result": {
+                                        "success": int(rp.get("success", 0)), 
+                                        "fail": int(rp.get("fail", 0)), 
+                                        "sent": int(rp.get("sent", 0))
+                                    }
                                 }
-                            }
                             
-                            ws.send(json.dumps({
-                                'type': 'task_update', 
-                                'task_id': task_id, 
-                                'data': start_snapshot,
-                                'is_snapshot': True
-                            }))
-                            logger.info(f"已推送任务 {task_id} 初始快照给前端")
+                                _frontend_reply(client_id, {
+                                    'type': 'task_update', 
+                                    'task_id': task_id, 
+                                    'data': start_snapshot,
+                                    'seq': seq,
+                                    'is_snapshot': True
+                                })
+                                logger.info(f"已推送任务 {task_id} 初始快照给前端")
                             
-                        except Exception as e:
-                            logger.error(f"推送任务初始快照失败: {e}")
+                            except Exception as e:
+                                logger.error(f"推送任务初始快照失败: {e}")
                 
                 elif action == "unsubscribe_task":
                     # 取消订阅任务
@@ -4654,11 +5215,11 @@ def frontend_websocket(ws):
                                 _task_subscribers[task_id].discard(client_id)
                                 if not _task_subscribers[task_id]:
                                     del _task_subscribers[task_id]
-                        ws.send(json.dumps({"type": "unsubscribed", "task_id": task_id, "ok": True}))
+                        _frontend_reply(client_id, {"type": "unsubscribed", "task_id": task_id, "ok": True})
                 
                 elif action == "ping":
                     # 心跳响应 - 保持连接活跃
-                    ws.send(json.dumps({"type": "pong", "ts": now_iso()}))
+                    _frontend_reply(client_id, {"type": "pong", "ts": now_iso()})
                 
             except Exception as e:
                 # 超时不是错误，继续循环等待
@@ -4674,125 +5235,138 @@ def frontend_websocket(ws):
     finally:
         # 清理连接
         with _frontend_lock:
-            if client_id in _frontend_clients:
-                client = _frontend_clients[client_id]
-                # 清理任务订阅
-                for task_id in client.get("subscribed_tasks", set()):
-                    if task_id in _task_subscribers:
-                        _task_subscribers[task_id].discard(client_id)
-                        if not _task_subscribers[task_id]:
-                            del _task_subscribers[task_id]
-                del _frontend_clients[client_id]
+            _frontend_drop_client(client_id)
         logger.info(f"前端WS断开: {client_id}")
 
 
+# task_update 合并节流：进度缓存立即更新；推送给前端（WS/SSE）的帧每个任务每 TASK_UPDATE_INTERVAL_MS 最多一帧，
+# 期间的更新合并成最新状态；完成/暂停/取消等状态变化立即推送。TASK_UPDATE_INTERVAL_MS=0 关闭合并
+TASK_UPDATE_INTERVAL_MS = float(os.environ.get("TASK_UPDATE_INTERVAL_MS", "250"))
+_task_update_pending = {}  # task_id -> 合并中的更新
+_task_update_last = {}  # task_id -> 上次推送时间（超过一个窗口的记录不再影响节流，定期清掉）
+_task_update_prune_at = 0.0
+_task_update_lock = threading.Lock()
+
+
+def _task_update_is_final(update_data: dict) -> bool:
+    """完成/暂停/取消：立即推送，且作为关键消息不会因队列满被丢弃"""
+    return bool(update_data.get("completed")) or update_data.get("status") in ("done", "cancelled", "paused", "completed")
+
+
 def broadcast_task_update(task_id: str, update_data: dict):
+    global _task_update_prune_at
+    LOCATION = "[API][broadcast_task_update]"
+    try:
+        progress = _task_progress_store(task_id, update_data)
+    except Exception as e:
+        logger.warning(f"{LOCATION} 写入进度缓存失败: {e}")
+        progress = {}
+    _perf_incr("task_update.in")
+    final = _task_update_is_final(update_data)
+    now = time.time()
+    with _task_update_lock:
+        if now >= _task_update_prune_at:
+            # 在其他进程完成/中途崩溃的任务不会走到 final 分支，按时间清理
+            window = TASK_UPDATE_INTERVAL_MS / 1000.0
+            for tid in [t for t, ts in _task_update_last.items() if now - ts >= window]:
+                _task_update_last.pop(tid, None)
+            _task_update_prune_at = now + 60
+        merged = _task_update_pending.pop(task_id, None) or {}
+        merged.update({k: v for k, v in update_data.items() if v is not None})
+        wait = TASK_UPDATE_INTERVAL_MS / 1000.0 - (now - _task_update_last.get(task_id, 0))
+        if final or wait <= 0:
+            if final:
+                _task_update_last.pop(task_id, None)
+            else:
+                _task_update_last[task_id] = now
+        else:
+            # 窗口内：先攒着，窗口结束时由定时器推送最新合并结果
+            if not merged.get("_scheduled"):
+                merged["_scheduled"] = True
+                spawn_later(wait, _task_update_flush, task_id)
+            _task_update_pending[task_id] = merged
+            return
+    merged.pop("_scheduled", None)
+    _task_update_emit(task_id, merged, progress)
+
+
+def _task_update_flush(task_id: str) -> None:
+    with _task_update_lock:
+        merged = _task_update_pending.pop(task_id, None)
+        if merged:
+            _task_update_last[task_id] = time.time()
+    if merged:
+        merged.pop("_scheduled", None)
+        _task_update_emit(task_id, merged, None)
+
+
+def _task_update_emit(task_id: str, update_data: dict, progress: Optional[dict]):
+    _perf_incr("task_update.out")
+    if progress is None:
+        progress = redis_manager.get_task_progress(task_id) or {}
+    seq = _topic_next_seq(f"task:{task_id}")
+    _event_publish("task_update", {"task_id": task_id, "data": update_data, "progress": progress, "seq": seq})
+
+
+def _deliver_task_update(task_id: str, update_data: dict, progress: dict, seq: int = None):
+    # 投递到本进程：SSE 订阅者 + 订阅该任务的前端连接；发给浏览器的帧记入任务主题的环形缓冲，供重连续传
     LOCATION = "[API][broadcast_task_update]"
+    _task_event_publish(task_id, progress or update_data, seq)
+    payload = _encode_broadcast({'type': 'task_update', 'task_id': task_id, 'data': update_data, 'seq': seq})
+    if seq is not None:
+        _topic_record(f"task:{task_id}", seq, payload)
     # 推送任务更新到所有订阅的前端客户端
     if task_id not in _task_subscribers:
         # 关键兜底：前端如果 WS 断线/订阅丢了，会导致“任务已完成但前端永远卡死”。
         # 这里在没有 task 订阅者时，退化为按 user_id 广播 task_update（前端已 subscribe_user 时仍能收到）。
         print(f"{LOCATION} ⚠️ 任务 {task_id} 无订阅者，启用按用户广播兜底")
         try:
-            conn = db()
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("SELECT user_id FROM tasks WHERE task_id=%s", (task_id,))
-            row = cur.fetchone() or {}
-            conn.close()
-            uid = row.get("user_id")
+            uid = progress.get("user_id")
+            if not uid:
+                conn = db()
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                cur.execute("SELECT user_id FROM tasks WHERE task_id=%s", (task_id,))
+                uid = (cur.fetchone() or {}).get("user_id")
+                conn.close()
             if uid:
-                # broadcast_user_update 会生成 {"type":"task_update","user_id":...,"data":update_data,...}
+                # 生成与 broadcast_user_update 相同的结构 {"type":"task_update","user_id":...,"data":update_data,...}
                 # 前端 handleServerMessage 已兼容这种结构（data.type==='task_update' && data.data）
-                broadcast_user_update(uid, "task_update", update_data)
+                # 只投递本进程：其他进程收到同一事件会各自判断兜底
+                # 带上 task_id/seq，前端按任务主题去重
+                payload = _encode_broadcast({'type': 'task_update', 'user_id': uid, 'task_id': task_id, 'data': update_data, 'seq': seq, 'ts': now_iso()})
+                _deliver_user_update(uid, payload, ("task_update", task_id), _task_update_is_final(update_data))
                 _trace("task_update.fallback_user_broadcast", trace_id=(update_data or {}).get("trace_id"), task_id=task_id, user_id=uid)
         except Exception as e:
             logger.warning(f"{LOCATION} 兜底按用户广播失败: {e}")
         return
     
-    payload = json.dumps({'type': 'task_update', 'task_id': task_id, 'data': update_data})
-    
     with _frontend_lock:
         subscribers = list(_task_subscribers.get(task_id, []))
     
-    print(f"{LOCATION} → 推送到 {len(subscribers)} 个订阅客户端")
-    failed_clients = []
-    for client_id in subscribers:
-        with _frontend_lock:
-            client = _frontend_clients.get(client_id)
-        if client:
-            try:
-                client["ws"].send(payload)
-            except Exception as e:
-                print(f"{LOCATION} ❌ 推送失败到客户端 {client_id}: {e}")
-                logger.warning(f"{LOCATION} 推送任务更新失败 {client_id}: {e}")
-                failed_clients.append(client_id)
-    
-    if len(subscribers) > 0 and len(failed_clients) == 0:
-        print(f"{LOCATION} ✓ 成功推送到所有 {len(subscribers)} 个客户端")
-    
-    # 清理失败的连接
-    if failed_clients:
-        print(f"{LOCATION} → 清理 {len(failed_clients)} 个失败连接")
-        with _frontend_lock:
-            for client_id in failed_clients:
-                if client_id in _frontend_clients:
-                    del _frontend_clients[client_id]
+    queued = _frontend_send(subscribers, payload, key=("task_update", task_id), critical=_task_update_is_final(update_data))
+    _perf_incr("task_update.frames", queued)
+    print(f"{LOCATION} → 已推送到 {queued}/{len(subscribers)} 个订阅客户端队列")
 
 
-def broadcast_user_update(user_id: str, update_type: str, data: dict):
-    # 推送用户更新到所有订阅该用户的前端客户端
-    payload = json.dumps({'type': update_type, 'user_id': user_id, 'data': data, 'ts': now_iso()})
-    
-    failed_clients = []
-    with _frontend_lock:
-        clients_to_notify = [(cid, c) for cid, c in _frontend_clients.items() if c.get("user_id") == user_id]
-    
-    for client_id, client in clients_to_notify:
-        try:
-            client["ws"].send(payload)
-        except Exception as e:
-            logger.warning(f"推送用户更新失败 {client_id}: {e}")
-            failed_clients.append(client_id)
-    
-    # 清理失败的连接
-    if failed_clients:
-        with _frontend_lock:
-            for client_id in failed_clients:
-                if client_id in _frontend_clients:
-                    del _frontend_clients[client_id]
-
-
-def broadcast_server_update(server_id: str, update_type: str, server_data: dict):
-    # 推送服务器状态更新到所有前端客户端（无需订阅，所有前端都接收）
-    payload = json.dumps({
-        'type': 'server_update',
-        'update_type': update_type,  # 'registered', 'disconnected', 'ready', 'status_changed'
-        'server_id': server_id,
-        'data': server_data,
-        'ts': now_iso()
-    })
-    
-    failed_clients = []
+def broadcast_user_update(user_id: str, update_type: str, data: dict, coalesce_key=None, critical: bool = False):
+    # 推送用户更新到所有订阅该用户的前端客户端（余额更新只保留最新一条）
+    seq = _topic_next_seq(f"user:{user_id}")
+    payload = _encode_broadcast({'type': update_type, 'user_id': user_id, 'data': data, 'seq': seq, 'ts': now_iso()})
+    if coalesce_key is None and update_type == "balance_update":
+        coalesce_key = ("balance_update",)
+    _event_publish("user", {"user_id": user_id, "payload": payload, "key": coalesce_key, "critical": critical, "seq": seq})
+
+
+def _deliver_user_update(user_id: str, payload: str, key=None, critical: bool = False, seq: int = None):
+    if seq is not None:
+        _topic_record(f"user:{user_id}", seq, payload)
     with _frontend_lock:
-        clients_to_notify = list(_frontend_clients.items())
-    
-    for client_id, client in clients_to_notify:
-        try:
-            client["ws"].send(payload)
-        except Exception as e:
-            logger.warning(f"推送服务器更新失败 {client_id}: {e}")
-            failed_clients.append(client_id)
-    
-    # 清理失败的连接
-    if failed_clients:
-        with _frontend_lock:
-            for client_id in failed_clients:
-                if client_id in _frontend_clients:
-                    del _frontend_clients[client_id]
+        client_ids = list(_user_clients.get(user_id, ()))
+    _frontend_send(client_ids, payload, key=key, critical=critical)
 
 
-def _get_servers_list_with_status() -> list:
-    # 获取完整的服务器列表（包含Redis实时状态）
+def _get_servers_list_with_status(server_ids: list = None) -> list:
+    # 获取服务器列表（包含Redis实时状态）；server_ids 为空表示全部
     conn = db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
@@ -4803,8 +5377,11 @@ def _get_servers_list_with_status() -> list:
         logger.warning(f"获取在线Worker列表失败: {e}，使用空列表")
         online_workers_set = set()
     
-    # 从数据库获取所有服务器
-    cur.execute("SELECT server_id, server_name, server_url, port, clients_count, status, last_seen, assigned_user AS assigned_user_id, meta FROM servers ORDER BY COALESCE(server_name, server_id)")
+    # 从数据库获取服务器
+    if server_ids is None:
+        cur.execute("SELECT server_id, server_name, server_url, port, clients_count, status, last_seen, assigned_user AS assigned_user_id, meta FROM servers ORDER BY COALESCE(server_name, server_id)")
+    else:
+        cur.execute("SELECT server_id, server_name, server_url, port, clients_count, status, last_seen, assigned_user AS assigned_user_id, meta FROM servers WHERE server_id = ANY(%s)", (list(server_ids),))
     rows = cur.fetchall()
     conn.close()
     
@@ -4871,49 +5448,47 @@ def _get_servers_list_with_status() -> list:
     return servers
 
 
-def broadcast_servers_list_update():
-    # 🔥 获取最新服务器列表并推送给所有前端
+# 服务器列表版本号：每次服务器状态变化 +1（Redis 计数，多进程共享）。
+# 前端连接时拿一份带版本号的快照，之后只收 servers_delta；版本不连续（丢消息/慢客户端被丢弃）时再请求快照
+SERVERS_VERSION_KEY = "servers_list"
+
+
+def _servers_snapshot() -> dict:
+    """完整服务器列表快照；先读版本号再查列表，快照之后的增量都能正确叠加。
+    版本号读不到（Redis 异常）时 version 为 None，前端收到下一条增量会重新请求快照"""
+    version = redis_manager.get_seq(SERVERS_VERSION_KEY, fallback=False)
+    servers = _get_servers_list_with_status()
+    _perf_incr("servers.snapshot")
+    return {"type": "servers_list", "servers": servers, "version": version, "ok": True}
+
+
+def broadcast_server_delta(server_id: str):
+    # 推送单个服务器的最新状态（已删除的放在 removed 里），不再整表重建
     try:
-        servers = _get_servers_list_with_status()
-        payload = json.dumps({
-            'type': 'servers_list_update',
+        # 先取版本号再读状态：版本号更大的增量读到的状态一定不旧
+        version = redis_manager.next_seq(SERVERS_VERSION_KEY, fallback=False)
+        if version is None:
+            # 拿不到全局版本号时不能用本地计数（会与其他进程冲突/倒退），改推一份不带版本号的完整快照
+            _event_publish("all", {"payload": _encode_broadcast(_servers_snapshot()), "key": ("servers_list",)})
+            _perf_incr("servers.delta_fallback_snapshot")
+            return
+        servers = _get_servers_list_with_status([server_id])
+        payload = _encode_broadcast({
+            'type': 'servers_delta',
+            'version': version,
             'servers': servers,
+            'removed': [] if servers else [server_id],
             'ts': now_iso()
         })
-        
-        failed_clients = []
-        with _frontend_lock:
-            clients_to_notify = list(_frontend_clients.items())
-        
-        for client_id, client in clients_to_notify:
-            try:
-                client["ws"].send(payload)
-            except Exception as e:
-                logger.warning(f"推送服务器列表更新失败 {client_id}: {e}")
-                failed_clients.append(client_id)
-        
-        # 清理失败的连接
-        if failed_clients:
-            with _frontend_lock:
-                for client_id in failed_clients:
-                    if client_id in _frontend_clients:
-                        del _frontend_clients[client_id]
+        _event_publish("all", {"payload": payload})
+        _perf_incr("servers.delta")
     except Exception as e:
-        logger.error(f"推送服务器列表更新失败: {e}")
+        logger.error(f"推送服务器状态增量失败: {e}")
 
 
 def _broadcast_to_frontend(payload: dict):
     # 向所有前端 WebSocket 广播消息
-    dead = []
-    with _frontend_lock:
-        for sid, info in _frontend_clients.items():
-            ws = info["ws"]
-            try:
-                ws.send(json.dumps(payload))
-            except:
-                dead.append(sid)
-        for sid in dead:
-            _frontend_clients.pop(sid, None)
+    _event_publish("all", {"payload": _encode_broadcast(payload)})
 # endregion
 
 # region [WORKER WEBSOCKET]
@@ -4971,26 +5546,10 @@ def worker_websocket(ws):
                         "message": msg.get("message", ""),
                         "logs": msg.get("logs", [])
                     }
-                    payload = json.dumps(response_data)
-                    
-                    # 广播到所有前端连接
-                    failed_clients = []
-                    with _frontend_lock:
-                        clients_to_notify = list(_frontend_clients.items())
+                    payload = _encode_broadcast(response_data)
                     
-                    for client_id, client in clients_to_notify:
-                        try:
-                            client["ws"].send(payload)
-                        except Exception as e:
-                            logger.warning(f"转发超级管理员响应失败 {client_id}: {e}")
-                            failed_clients.append(client_id)
-                    
-                    # 清理失败的连接
-                    if failed_clients:
-                        with _frontend_lock:
-                            for client_id in failed_clients:
-                                if client_id in _frontend_clients:
-                                    del _frontend_clients[client_id]
+                    # 广播到所有前端连接（命令响应不可丢弃）
+                    _event_publish("all", {"payload": payload, "critical": True})
                     continue  # 处理完super_admin_response后继续循环
                 
                 action = msg.get("action")
@@ -5015,6 +5574,7 @@ def worker_websocket(ws):
                                 "ready": is_ready,
                                 "connected_at": time.time()
                             }
+                        _worker_owner_claim(server_id)
                         
                         # [OK] 2. 使用Redis/内存标记在线状态
                         redis_manager.worker_online(server_id, {
@@ -5044,14 +5604,14 @@ def worker_websocket(ws):
                         except Exception as e:
                             # 数据库更新失败不影响连接
                             logger.warning(f"更新服务器数据库状态失败: {e}")
+                        # 新Worker或改名后的Worker需要重新计算归属
+                        _assign_index_invalidate("worker_register")
+                        _worker_score_load(server_id)
                         
                         ws.send(json.dumps({"type": "registered", "server_id": server_id, "ok": True}))
                         
-                        # 🔥 推送服务器注册事件到所有前端（推送完整列表）
-                        try:
-                            broadcast_servers_list_update()
-                        except Exception as e:
-                            logger.warning(f"推送服务器列表更新失败: {e}")
+                        # 🔥 推送服务器注册事件到所有前端（只推送该服务器的增量）
+                        broadcast_server_delta(server_id)
                         
                         # 记录注册状态
                         _server_status["registered"] = True
@@ -5064,6 +5624,7 @@ def worker_websocket(ws):
                             print(f"[OK] {server_id}: Ready")
                             print("===============================================")
                             _server_status["logged"] = True  # 标记已打印
+                            _sched_kick()
                         # 如果注册时未ready，先不打印，等ready时一起打印
                     else:
                         # 注册失败时显示详细日志
@@ -5109,11 +5670,11 @@ def worker_websocket(ws):
                             except Exception:
                                 pass  # 发送失败不影响连接
                             
-                            # 🔥 推送服务器就绪状态变化到所有前端（推送完整列表）
-                            try:
-                                broadcast_servers_list_update()
-                            except Exception as e:
-                                logger.warning(f"推送服务器列表更新失败: {e}")
+                            # 🔥 推送服务器就绪状态变化到所有前端（只推送该服务器的增量）
+                            broadcast_server_delta(server_id)
+                            
+                            if ready:
+                                _sched_kick()
                             
                             # 更新ready状态
                             _server_status["ready"] = True
@@ -5146,6 +5707,7 @@ def worker_websocket(ws):
                 elif action == "heartbeat":
                     if server_id:
                         heartbeat_count += 1
+                        _worker_owner_claim(server_id)
                         last_heartbeat_ms = int(time.time() * 1000)
                         # [OK] 更新心跳（包含clients_count等信息）
                         clients_count = payload.get("clients_count", 0)
@@ -5186,14 +5748,28 @@ def worker_websocket(ws):
                     if shard_id and uid and server_id:
                         print(f"📨 Shard结果 | Worker: {server_id} | 成功: {success} | 失败: {fail}")
                         _trace("worker.shard_result.recv", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=server_id, user_id=uid, success=success, fail=fail)
-                        # [OK] 减少该Worker的负载
-                        current_load = redis_manager.get_worker_load(server_id)
-                        new_load = max(0, current_load - 1)
-                        redis_manager.set_worker_load(server_id, new_load)
+                        # [OK] 减少该Worker的负载（原子递减：多个 API 进程共用同一个计数）
+                        redis_manager.decr_worker_load(server_id, 1)
                         
-                        # 原有的结果处理逻辑
-                        result = report_shard_result(shard_id, server_id, uid, success, fail, payload)
-                        ws.send(json.dumps({"type": "shard_result_ack", "shard_id": shard_id, **result}))
+                        # 结果入队，由批量写入器提交后再回 ack（不阻塞当前 Worker 连接）
+                        def _ack_result(result, ws=ws, shard_id=shard_id):
+                            from gevent import Timeout
+                            try:
+                                with Timeout(3):
+                                    ws.send(json.dumps({"type": "shard_result_ack", "shard_id": shard_id, **result}))
+                            except Timeout:
+                                logger.warning(f"[API][worker_ws] shard_result_ack 发送超时(3s): worker={server_id}, shard={shard_id}")
+                            except Exception as e:
+                                logger.debug(f"[API][worker_ws] shard_result_ack 发送失败: {e}")
+                        _result_ingest(shard_id, server_id, uid, success, fail, payload, _ack_result)
+
+                elif action == "shard_cancel_ack":
+                    # Worker 对 shard_cancel 的回复：cancelled=true 表示分片尚未执行，已从Worker队列移除
+                    shard_id = payload.get("shard_id")
+                    if shard_id and server_id and payload.get("cancelled"):
+                        _trace("worker.shard_cancel_ack", task_id=payload.get("task_id"), shard_id=shard_id, worker_id=server_id)
+                        _sched_on_shard_recalled(shard_id, server_id)
+                        _routed_shard_notify(shard_id, server_id, "shard_recalled")
 
                 elif action == "shard_run_ack":
                     # Worker确认已收到分片（用于定位：推送成功但worker没收到/没动作）
@@ -5203,6 +5779,9 @@ def worker_websocket(ws):
                     trace_id = payload.get("trace_id")
                     if shard_id and server_id:
                         _trace("worker.shard_run_ack", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=server_id, user_id=uid)
+                        sched_job = _sched_inflight.get(shard_id)
+                        if sched_job and sched_job["worker_id"] == server_id:
+                            _worker_score_on_ack(server_id, (time.time() - sched_job["started_at"]) * 1000)
                         try:
                             ws.send(json.dumps({"type": "shard_run_ack_ack", "shard_id": shard_id, "ok": True}))
                         except Exception:
@@ -5230,6 +5809,8 @@ def worker_websocket(ws):
         if server_id:
             with _worker_lock:
                 _worker_clients.pop(server_id, None)
+            _worker_owner_release(server_id)
+            _worker_score_on_disconnect(server_id, _sched_on_worker_gone(server_id))
             
             redis_manager.remove_worker(server_id)
             
@@ -5244,14 +5825,7 @@ def worker_websocket(ws):
                 logger.warning(f"更新服务器断开状态失败: {e}")
             
             # 🔥 推送服务器断开事件到所有前端
-            try:
-                broadcast_server_update(server_id, "disconnected", {
-                    "server_id": server_id,
-                    "reason": close_reason,
-                    "status": "disconnected"
-                })
-            except Exception as e:
-                logger.warning(f"推送服务器断开事件失败: {e}")
+            broadcast_server_delta(server_id)
             
             # 统一断开连接日志格式，放在分隔线内，包含诊断信息
             if server_id:
@@ -5297,32 +5871,11 @@ def worker_websocket(ws):
 
 def _assign_and_push_shards(task_id: str, user_id: str, message: str, trace_id: str = None) -> dict:
     LOCATION = "[API][_assign_and_push_shards]"
+    # 不再整批推送：把待处理分片交给公平调度器，由调度器按用户权重/并发上限逐个派发给空闲Worker
     conn = db()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
     try:
-        print(f"{LOCATION} → 获取可用Worker服务器")
-        with _worker_lock:
-            available_servers = [sid for sid, c in _worker_clients.items() if c.get("ws") and c.get("ready")]
-
-        print(f"{LOCATION} ✓ 找到 {len(available_servers)} 个可用Worker")
-        _trace("shard.assign.start", trace_id=trace_id, task_id=task_id, user_id=user_id, ready_workers=len(available_servers))
-        # 稳定排序，便于复现与排查
-        try:
-            available_servers = sorted(available_servers)
-        except Exception:
-            pass
-        
-        try:
-            broadcast_servers_list_update()
-        except Exception as e:
-            logger.debug(f"推送服务器列表更新失败: {e}")
-        
-        if not available_servers:
-            print(f"{LOCATION} ❌ 无可用Worker，任务将卡在pending状态")
-            conn.close()
-            return {"total": 0, "pushed": 0, "failed": 0}
-        
         print(f"{LOCATION} → 查询待处理分片")
         cur.execute("""
             SELECT shard_id, phones 
@@ -5332,197 +5885,1971 @@ def _assign_and_push_shards(task_id: str, user_id: str, message: str, trace_id:
         """, (task_id,))
         pending_shards = cur.fetchall()
         
-        if not pending_shards:
-            conn.close()
-            return {"total": 0, "pushed": 0, "failed": 0}
+        cur.execute("SELECT created_by_admin FROM users WHERE user_id=%s", (user_id,))
+        user_row = cur.fetchone()
+        admin_id = user_row.get("created_by_admin") if user_row else None
+        cur.execute("SELECT status, rate_per_min FROM tasks WHERE task_id=%s", (task_id,))
+        task_row = cur.fetchone()
+        conn.close()
+        
+        # 已暂停/已取消/等待开始的任务不再入队（恢复或定时器放行时会重新调用本函数）
+        if task_row and task_row.get("status") in ("paused", "cancelled", "scheduled"):
+            return {"total": 0, "queued": 0, "pushed": 0, "failed": 0}
         
-        print(f"{LOCATION} ✓ 找到 {len(pending_shards)} 个待处理分片")
+        if not pending_shards:
+            return {"total": 0, "queued": 0, "pushed": 0, "failed": 0}
         
         total_shards = len(pending_shards)
-        cur.execute("SELECT server_id, server_name FROM servers WHERE server_id = ANY(%s)", (available_servers,))
-        server_names = {row['server_id']: row.get('server_name') or row['server_id'] for row in cur.fetchall()}
+        queued = _sched_enqueue(task_id, user_id, message, trace_id, pending_shards, admin_id=admin_id, rate_per_min=(task_row or {}).get("rate_per_min"))
         
-        print(f"✓ 任务分配：{total_shards}/{len(available_servers)}（并行推送模式）")
-
-        # 注意：不要持有同一个DB事务跨越 ws.send。这里先释放当前连接，后续每个分片独立提交。
+        print(f"{LOCATION} ✓ {total_shards} 个待处理分片已进入调度队列（新入队 {queued}，策略 {SCHED_POLICY}）")
+        _trace("shard.assign.queued", trace_id=trace_id, task_id=task_id, user_id=user_id, total=total_shards, queued=queued)
+        
+        return {"total": total_shards, "queued": queued, "pushed": 0, "failed": 0}
+    
+    except Exception as e:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
         try:
             conn.close()
         except Exception:
             pass
+        print(f"[ERROR] 分配任务 {task_id} 失败: {e}")
+        return {"total": 0, "queued": 0, "pushed": 0, "failed": 0}
 
-        def _safe_phone_count(phones_val) -> int:
-            try:
-                if isinstance(phones_val, str):
-                    return len(json.loads(phones_val) or [])
-                return len(phones_val or [])
-            except Exception:
-                return 0
+def get_ready_workers() -> list:
+    """获取所有就绪的worker"""
+    with _worker_lock:
+        return [
+            {"server_id": sid, "server_name": c.get("server_name", ""), "ready": c.get("ready", False)}
+            for sid, c in _worker_clients.items()
+            if c.get("ready")
+        ]
+# endregion
 
+# region [WORKER ROUTING]
+# Worker WebSocket 只能由接受它的 API 进程写入。多进程部署时：
+# - worker_owner:<server_id> 记录持有连接的进程（注册/心跳续期，断开时清除）
+# - 每个进程订阅自己的 worker_route:<进程ID> 频道，代其他进程写 shard_run / shard_cancel / super_admin_command 并回 ack
+# - 代发分片的结果/撤回确认转发给派发进程，由它释放调度槽位
+# - Worker 负载（worker:<id>:load）是所有进程共用的在途分片数，调度按它计算空闲槽位
+WORKER_OWNER_TTL = int(os.environ.get("WORKER_OWNER_TTL", "60"))
+WORKER_ROUTE_ACK_TIMEOUT = float(os.environ.get("WORKER_ROUTE_ACK_TIMEOUT", "3"))
+WORKER_REMOTE_CACHE_SECONDS = float(os.environ.get("WORKER_REMOTE_CACHE_SECONDS", "1"))
+WORKER_ROUTE_SHARD_TTL = float(os.environ.get("WORKER_ROUTE_SHARD_TTL", "3600"))
 
+_worker_route_pending = {}  # cmd_id -> {"event": Event, "result": (ok, reason)}
+_routed_shards = {}  # (shard_id, server_id) -> (派发进程ID, 转发时间)
+_routed_shards_pruned = 0.0
+_worker_remote_cache = {"at": 0.0, "ready": []}
+_worker_route_lock = threading.Lock()
 
-        def _push_one(idx0: int, shard_row: dict, worker_id: str):
-            LOCATION = "[API][_assign_and_push_shards][_push_one]"
-            shard_id = shard_row.get("shard_id")
-            phones = shard_row.get("phones")
-            phone_count = _safe_phone_count(phones)
-            display = server_names.get(worker_id, worker_id)
 
-            print(f"{LOCATION} → 推送[{idx0+1}/{total_shards}] {shard_id[:8]} ({phone_count}) -> {display}")
-            _trace("shard.push.begin", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=worker_id, phone_count=phone_count)
+def _worker_route_channel(owner: str) -> str:
+    return f"worker_route:{owner}"
 
-            # 负载 +1（失败则回滚负载）
-            try:
-                redis_manager.incr_worker_load(worker_id, 1)
-            except Exception:
-                pass
 
-            shard_data = {
-                "shard_id": shard_id,
-                "task_id": task_id,
-                "user_id": user_id,
-                "phones": phones,
-                "message": message,
-                "trace_id": trace_id,
-            }
+def _worker_owner_claim(server_id: str) -> None:
+    redis_manager.set_worker_owner(server_id, _EVENT_ORIGIN, WORKER_OWNER_TTL)
 
-            ok = False
-            conn_u = None # 初始化连接变量，以便在 finally 中使用
 
-            try:
-                # 🔧 关键修复：防止 ws.send 卡死拖垮整个进程
-                # 设置 3 秒超时，避免网络慢导致阻塞
-                from gevent import Timeout
-                with Timeout(3):
-                    # 重要：不要在持有 _worker_lock 的情况下执行 ws.send（可能阻塞，影响其他worker状态更新）
-                    with _worker_lock:
-                        client = _worker_clients.get(worker_id)
-                        if not client:
-                            logger.warning(f"{LOCATION} Worker {worker_id} 未连接")
-                            return False
-                        if not client.get("ready"):
-                            logger.warning(f"{LOCATION} Worker {worker_id} 未就绪")
-                            return False
-                        ws = client.get("ws")
-                    
-                    ws.send(json.dumps({"type": "shard_run", "shard": shard_data}))
-                
-                print(f"{LOCATION} ✓ 分片 {shard_id}... 已推送到 Worker {worker_id}")
-                print(f"→ {display:8} : {shard_id}  ({phone_count})")
-                ok = True
-                
-            except Timeout:
-                logger.error(f"{LOCATION} 发送超时(3s): worker={worker_id}, shard={shard_id}")
-                # 超时的 ws 很可能已不健康，尝试从内存里剔除
-                try:
-                    with _worker_lock:
-                        _worker_clients.pop(worker_id, None)
-                except Exception:
-                    pass
-                ok = False
-                
-            except Exception as e:
-                logger.error(f"{LOCATION} 发送失败: {e}")
-                ok = False
+def _worker_owner_release(server_id: str) -> None:
+    redis_manager.clear_worker_owner(server_id, _EVENT_ORIGIN)
+
+
+def _ready_workers() -> list:
+    """就绪的 Worker：本进程持有的 + 其他进程持有的（后者读 Redis，短时缓存）"""
+    with _worker_lock:
+        local = [sid for sid, c in _worker_clients.items() if c.get("ws") and c.get("ready")]
+    if not redis_manager.use_redis:
+        return local
+    now = time.time()
+    if now - _worker_remote_cache["at"] > WORKER_REMOTE_CACHE_SECONDS:
+        online = redis_manager.get_online_workers(only_ready=True)
+        owners = redis_manager.get_worker_owners(online)
+        _worker_remote_cache["ready"] = [sid for sid in online if owners.get(sid) not in (None, _EVENT_ORIGIN)]
+        _worker_remote_cache["at"] = now
+    local_set = set(local)
+    return local + [sid for sid in _worker_remote_cache["ready"] if sid not in local_set]
+
+
+def _worker_global_loads(server_ids: list) -> dict:
+    """所有 API 进程推送到这些 Worker 的在途分片数（单进程时本地计数已足够）"""
+    if not redis_manager.use_redis:
+        return {}
+    return redis_manager.get_worker_loads(server_ids)
 
-            finally:
-                if ok:
-                    # ✅ 推送成功，更新数据库状态
-                    try:
-                        conn_u = db()
-                        cur_u = conn_u.cursor()
-                        cur_u.execute("""
-                            UPDATE shards
-                            SET server_id=%s, status='running', locked_at=NOW(), updated=NOW()
-                            WHERE shard_id=%s AND status='pending'
-                        """, (worker_id, shard_id))
-                        conn_u.commit()
-                    except Exception as e:
-                        logger.warning(f"{LOCATION} 更新分片状态失败 {shard_id}: {e}")
-                        _trace("shard.push.db_update_fail", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=worker_id, error=str(e))
-                    finally:
-                        # 🔧 [CRITICAL FIX] 核心修复：确保连接关闭，防止连接泄漏导致后续请求卡死
-                        if conn_u:
-                            try:
-                                conn_u.close()
-                            except Exception:
-                                pass
-                else:
-                    # ✅ 推送失败，回滚负载
-                    try:
-                        redis_manager.decr_worker_load(worker_id, 1)
-                    except Exception:
-                        pass
 
-            _trace("shard.push.end", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=worker_id, ok=ok)
-            return (shard_id, worker_id, ok)
+def _worker_local_send(server_id: str, message: dict, require_ready: bool = False) -> Tuple[Optional[bool], str]:
+    """写本进程持有的 Worker 连接（3秒超时）；返回 (None, ...) 表示该 Worker 不在本进程"""
+    LOCATION = "[API][_worker_local_send]"
+    from gevent import Timeout
+    # 重要：不要在持有 _worker_lock 的情况下执行 ws.send（可能阻塞，影响其他worker状态更新）
+    with _worker_lock:
+        client = _worker_clients.get(server_id)
+        ws = client.get("ws") if client else None
+        ready = bool(client and client.get("ready"))
+    if not ws:
+        return None, "not_connected"
+    if require_ready and not ready:
+        return False, "not_ready"
+    try:
+        with Timeout(3):
+            ws.send(json.dumps(message))
+        return True, ""
+    except Timeout:
+        logger.error(f"{LOCATION} 发送超时(3s): worker={server_id}, type={message.get('type')}")
+        # 超时的 ws 很可能已不健康，从内存里剔除
+        with _worker_lock:
+            if (_worker_clients.get(server_id) or {}).get("ws") is ws:
+                _worker_clients.pop(server_id, None)
+        return False, "timeout"
+    except Exception as e:
+        logger.error(f"{LOCATION} 发送失败 worker={server_id}: {e}")
+        return False, "send_failed"
 
 
-        # round-robin 分配：优先保证“同一批分片尽量同时推送到不同worker”
-        assignments = []
-        for i, shard_row in enumerate(pending_shards):
-            worker_id = available_servers[i % len(available_servers)]
-            assignments.append((i, shard_row, worker_id))
+def _worker_send(server_id: str, message: dict, require_ready: bool = False) -> Tuple[bool, str]:
+    """向 Worker 发送消息：本进程持有则直接写，否则转发给持有连接的进程并等待 ack。返回 (是否送达, 原因)"""
+    ok, reason = _worker_local_send(server_id, message, require_ready)
+    if ok is not None:
+        return ok, reason
+    if not redis_manager.use_redis:
+        return False, "not_connected"
+    owner = redis_manager.get_worker_owners([server_id]).get(server_id)
+    if not owner or owner == _EVENT_ORIGIN:
+        return False, "not_connected"
+    cmd_id = uuid.uuid4().hex
+    pending = {"event": Event(), "result": (False, "ack_timeout")}
+    with _worker_route_lock:
+        _worker_route_pending[cmd_id] = pending
+    try:
+        cmd = {"type": "cmd", "cmd_id": cmd_id, "reply_to": _EVENT_ORIGIN, "server_id": server_id, "require_ready": require_ready, "message": message}
+        if not redis_manager.publish(_worker_route_channel(owner), cmd):
+            _perf_incr("worker_route.unreachable")
+            return False, "owner_unreachable"
+        _perf_incr("worker_route.forwarded")
+        t0 = time.time()
+        if pending["event"].wait(timeout=WORKER_ROUTE_ACK_TIMEOUT):
+            _perf_observe("worker_route.ack_ms", (time.time() - t0) * 1000)
+        else:
+            _perf_incr("worker_route.ack_timeout")
+        return pending["result"]
+    finally:
+        with _worker_route_lock:
+            _worker_route_pending.pop(cmd_id, None)
 
-        greenlets = [spawn(_push_one, i, sr, wid) for (i, sr, wid) in assignments]
-        
-        # 等待所有greenlet完成，设置5秒总超时避免永久等待
-        from gevent import joinall
-        joinall(greenlets, timeout=30)
-        
-        # 清理仍未结束的 greenlet（超时后）
-        for g in greenlets:
-            try:
-                if not g.ready():
-                    g.kill(block=False)
-            except Exception:
-                pass
 
-        results = []
-        for g in greenlets:
+def _routed_shard_remember(shard_id: str, server_id: str, dispatcher: str) -> None:
+    global _routed_shards_pruned
+    if not shard_id or not dispatcher:
+        return
+    now = time.time()
+    with _worker_route_lock:
+        _routed_shards[(shard_id, server_id)] = (dispatcher, now)
+        if now - _routed_shards_pruned > 60:
+            # 清理一直没有回报的记录（Worker 断开/结果丢失，派发进程会自行超时回收）
+            _routed_shards_pruned = now
+            for key in [k for k, v in _routed_shards.items() if now - v[1] > WORKER_ROUTE_SHARD_TTL]:
+                _routed_shards.pop(key, None)
+
+
+def _routed_shard_notify(shard_id: str, server_id: str, kind: str, **fields) -> bool:
+    """代发的分片有回报时通知派发进程；返回该分片是否为代发"""
+    with _worker_route_lock:
+        entry = _routed_shards.pop((shard_id, server_id), None)
+    if not entry:
+        return False
+    redis_manager.publish(_worker_route_channel(entry[0]), {"type": kind, "shard_id": shard_id, "worker_id": server_id, **fields})
+    _perf_incr("worker_route.shard_notified")
+    return True
+
+
+def _sched_on_remote_result(shard_id: str, worker_id: str, suc: int, fail: int) -> None:
+    """其他进程代收的分片结果（落库已在该进程完成）：释放本进程的调度槽位，更新评分和内存追踪"""
+    sched_job, hedge_lost = _sched_release(shard_id, worker_id)
+    if worker_id:
+        _worker_score_on_result(worker_id, sched_job, suc, fail)
+    if not hedge_lost:
+        _tracker_on_result(shard_id, sched_job, suc, fail)
+
+
+def _worker_route_handle(msg: dict) -> None:
+    kind = msg.get("type")
+    if kind == "cmd":
+        message = msg.get("message") or {}
+        server_id = msg.get("server_id")
+        ok, reason = _worker_local_send(server_id, message, bool(msg.get("require_ready")))
+        if ok and message.get("type") == "shard_run":
+            _routed_shard_remember((message.get("shard") or {}).get("shard_id"), server_id, msg.get("reply_to"))
+        redis_manager.publish(_worker_route_channel(msg.get("reply_to")), {"type": "ack", "cmd_id": msg.get("cmd_id"), "ok": bool(ok), "reason": reason})
+    elif kind == "ack":
+        with _worker_route_lock:
+            pending = _worker_route_pending.get(msg.get("cmd_id"))
+        if pending:
+            pending["result"] = (bool(msg.get("ok")), msg.get("reason") or "")
+            pending["event"].set()
+    elif kind == "shard_done":
+        _sched_on_remote_result(msg.get("shard_id"), msg.get("worker_id"), int(msg.get("success") or 0), int(msg.get("fail") or 0))
+    elif kind == "shard_recalled":
+        _sched_on_shard_recalled(msg.get("shard_id"), msg.get("worker_id"))
+
+
+def _worker_route_loop():
+    """订阅本进程的路由频道（内存模式只有单进程，无需订阅）"""
+    LOCATION = "[API][_worker_route_loop]"
+    while redis_manager.use_redis:
+        pubsub = redis_manager.subscribe(_worker_route_channel(_EVENT_ORIGIN))
+        if pubsub is None:
+            time.sleep(5)
+            continue
+        try:
+            while True:
+                msg = pubsub.get_message(timeout=1.0)
+                if not msg or msg.get("type") != "message":
+                    continue
+                try:
+                    data = json.loads(msg.get("data") or "{}")
+                except Exception:
+                    continue
+                # 代发可能阻塞（ws.send 最多 3 秒），不占用订阅循环
+                spawn(_worker_route_handle, data)
+        except Exception as e:
+            logger.warning(f"{LOCATION} 订阅中断，稍后重连: {e}")
             try:
-                val = g.value
-                # 确保结果是元组格式 (shard_id, worker_id, ok)
-                if val and isinstance(val, tuple) and len(val) == 3:
-                    results.append(val)
+                pubsub.close()
             except Exception:
                 pass
+            time.sleep(2)
 
-        pushed_count = sum(1 for r in results if r[2])  # r[2] = ok
-        failed_count = total_shards - pushed_count
+spawn(_worker_route_loop)
+# endregion
 
-        print(f"{LOCATION} [分配完成] 总计: {total_shards} | 成功: {pushed_count} | 失败: {failed_count}")
-        _trace("shard.assign.done", trace_id=trace_id, task_id=task_id, total=total_shards, pushed=pushed_count, failed=failed_count)
+# region [ASSIGNMENT INDEX]
+# 服务器归属索引（内存）：独享服务器(servers.assigned_user)、管理员服务器池(admin_configs.selected_servers)
+# 调度时据此计算每个用户可用的 Worker；分配/取消分配/管理员配置/用户删除/Worker注册等事件触发失效，TTL 兜底重建
+ASSIGN_INDEX_TTL = float(os.environ.get("ASSIGN_INDEX_TTL", "60"))
 
-        return {"total": total_shards, "pushed": pushed_count, "failed": failed_count}
-    
-    except Exception as e:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        try:
-            conn.close()
-        except Exception:
-            pass
-        print(f"[ERROR] 分配任务 {task_id} 失败: {e}")
-        return {"total": 0, "pushed": 0, "failed": 0}
+_assign_index = {"built_at": 0.0, "owner": {}, "name": {}, "admin_pool": {}}
+_assign_index_dirty = True
+_assign_index_lock = threading.Lock()
 
-def get_ready_workers() -> list:
-    """获取所有就绪的worker"""
-    with _worker_lock:
-        return [
-            {"server_id": sid, "server_name": c.get("server_name", ""), "ready": c.get("ready", False)}
-            for sid, c in _worker_clients.items()
-            if c.get("ready")
-        ]
-# endregion
 
-# region [SUPER ADMIN]
+def _assign_index_invalidate(reason: str = "") -> None:
+    """归属关系变化：标记索引失效，下次调度时重建"""
+    global _assign_index_dirty
+    _assign_index_dirty = True
+    _perf_incr("assign_index.invalidated")
+    _trace("assign_index.invalidate", reason=reason)
+    try:
+        _sched_kick()
+    except Exception:
+        pass
 
 
-@app.route("/api/super-admin/worker/<server_id>/info", methods=["GET", "OPTIONS"])
-def super_admin_worker_info(server_id: str):
-    """获取worker详细信息"""
+def _assign_index_get() -> dict:
+    """返回当前索引；失效或超过 TTL 时从数据库重建（重建失败则继续使用旧索引）"""
+    global _assign_index, _assign_index_dirty
+    with _assign_index_lock:
+        if not _assign_index_dirty and time.time() - _assign_index["built_at"] < ASSIGN_INDEX_TTL:
+            return _assign_index
+        _assign_index_dirty = False
+        started = time.time()
+        try:
+            conn = db()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT server_id, server_name, assigned_user FROM servers")
+            rows = cur.fetchall()
+            cur.execute("SELECT admin_id, selected_servers FROM admin_configs")
+            configs = cur.fetchall()
+            conn.close()
+        except Exception as e:
+            _assign_index_dirty = True
+            logger.warning(f"[API][_assign_index_get] 重建服务器归属索引失败: {e}")
+            return _assign_index
+
+        admin_pool = {}
+        for r in configs:
+            selected = r.get("selected_servers")
+            # 与 user_available_servers 一致：空列表视为不限制
+            if isinstance(selected, list) and selected:
+                admin_pool[r["admin_id"]] = set(str(x) for x in selected)
+        _assign_index = {
+            "built_at": time.time(),
+            "owner": {r["server_id"]: r.get("assigned_user") for r in rows},
+            "name": {r["server_id"]: r.get("server_name") or r["server_id"] for r in rows},
+            "admin_pool": admin_pool,
+        }
+        _perf_observe("assign_index.rebuild_seconds", time.time() - started)
+        return _assign_index
+
+
+def _eligible_workers(user_id: str, admin_id: str, candidates) -> set:
+    """用户可用的 Worker：独享给该用户的 + 未分配的共享服务器，再按其管理员的服务器池过滤"""
+    idx = _assign_index_get()
+    pool = idx["admin_pool"].get(admin_id) if admin_id else None
+    out = set()
+    for sid in candidates:
+        owner = idx["owner"].get(sid)
+        if owner and owner != user_id:
+            continue
+        if pool is not None and sid not in pool and idx["name"].get(sid, sid) not in pool:
+            continue
+        out.add(sid)
+    return out
+# endregion
+
+# region [WORKER SCORE]
+# Worker 评分：速度(号码/秒 EWMA)、成功率 EWMA、确认延迟 EWMA、发送失败/断线 EWMA，合成 0~1 的分数
+# 调度优先选高分 Worker；连续失败达到阈值的 Worker 隔离一段时间。评分同时写入 Redis，重启/多进程可共享
+WORKER_SCORE_ALPHA = float(os.environ.get("WORKER_SCORE_ALPHA", "0.3"))
+WORKER_SCORE_RATE_REF = float(os.environ.get("WORKER_SCORE_RATE_REF", "5"))  # 号码/秒，达到该速度时速度因子为 0.5
+WORKER_QUARANTINE_FAILURES = int(os.environ.get("WORKER_QUARANTINE_FAILURES", "3"))
+WORKER_QUARANTINE_SECONDS = int(os.environ.get("WORKER_QUARANTINE_SECONDS", "300"))
+
+_worker_scores = {}  # server_id -> 评分记录
+_worker_score_lock = threading.Lock()
+
+
+def _worker_score_default() -> dict:
+    return {
+        "rate_ewma": None, "success_ewma": 1.0, "ack_ms_ewma": None, "fail_ewma": 0.0,
+        "shards": 0, "send_timeouts": 0, "send_failures": 0, "disconnects": 0,
+        "consecutive_failures": 0, "quarantined_until": 0, "score": 0.5, "updated": 0,
+    }
+
+
+def _ewma(old, value: float) -> float:
+    return value if old is None else old + WORKER_SCORE_ALPHA * (value - old)
+
+
+def _worker_score_compute(entry: dict) -> float:
+    rate = entry.get("rate_ewma")
+    speed = 0.5 if rate is None else rate / (rate + WORKER_SCORE_RATE_REF)
+    ack_ms = entry.get("ack_ms_ewma")
+    ack = 1.0 if ack_ms is None else 1.0 / (1.0 + ack_ms / 1000.0)
+    return round(entry["success_ewma"] * speed * ack * (1.0 - entry["fail_ewma"]), 4)
+
+
+def _worker_score_load(server_id: str) -> None:
+    """Worker 注册时从 Redis 恢复历史评分"""
+    saved = None
+    try:
+        saved = redis_manager.get_worker_score(server_id)
+    except Exception:
+        pass
+    with _worker_score_lock:
+        if server_id in _worker_scores:
+            return
+        entry = _worker_score_default()
+        if isinstance(saved, dict):
+            entry.update({k: v for k, v in saved.items() if k in entry})
+        _worker_scores[server_id] = entry
+
+
+def _worker_score_update(server_id: str, fn) -> dict:
+    """在锁内修改评分记录并重算分数，然后写回 Redis"""
+    with _worker_score_lock:
+        entry = _worker_scores.setdefault(server_id, _worker_score_default())
+        fn(entry)
+        entry["score"] = _worker_score_compute(entry)
+        entry["updated"] = time.time()
+        if entry["consecutive_failures"] >= WORKER_QUARANTINE_FAILURES and entry["quarantined_until"] <= time.time():
+            entry["quarantined_until"] = time.time() + WORKER_QUARANTINE_SECONDS
+            # 隔离期满后再失败一次即重新隔离
+            entry["consecutive_failures"] = WORKER_QUARANTINE_FAILURES - 1
+            logger.warning(f"[API][_worker_score_update] Worker {server_id} 连续失败，隔离 {WORKER_QUARANTINE_SECONDS}s")
+            _perf_incr("worker.quarantined")
+        snapshot = dict(entry)
+    try:
+        redis_manager.set_worker_score(server_id, snapshot)
+    except Exception:
+        pass
+    return snapshot
+
+
+def _worker_score_on_result(server_id: str, job: Optional[dict], success: int, fail: int) -> None:
+    def apply(entry):
+        entry["shards"] += 1
+        entry["consecutive_failures"] = 0
+        entry["fail_ewma"] = _ewma(entry["fail_ewma"], 0.0)
+        if success + fail > 0:
+            entry["success_ewma"] = _ewma(entry["success_ewma"], success / float(success + fail))
+        if job:
+            elapsed = time.time() - job["started_at"]
+            if elapsed > 0 and job.get("phone_count"):
+                entry["rate_ewma"] = _ewma(entry["rate_ewma"], job["phone_count"] / elapsed)
+    _worker_score_update(server_id, apply)
+
+
+def _worker_score_on_ack(server_id: str, latency_ms: float) -> None:
+    def apply(entry):
+        entry["ack_ms_ewma"] = _ewma(entry["ack_ms_ewma"], latency_ms)
+    _worker_score_update(server_id, apply)
+
+
+def _worker_score_on_send_fail(server_id: str, timeout: bool = False) -> None:
+    def apply(entry):
+        entry["send_timeouts" if timeout else "send_failures"] += 1
+        entry["consecutive_failures"] += 1
+        entry["fail_ewma"] = _ewma(entry["fail_ewma"], 1.0)
+    _worker_score_update(server_id, apply)
+
+
+def _worker_score_on_disconnect(server_id: str, lost_shards: int = 0) -> None:
+    """断线计入不稳定度；手上有未完成分片时才算一次失败"""
+    def apply(entry):
+        entry["disconnects"] += 1
+        entry["fail_ewma"] = _ewma(entry["fail_ewma"], 1.0)
+        if lost_shards:
+            entry["consecutive_failures"] += 1
+    _worker_score_update(server_id, apply)
+
+
+def _worker_scores_for(server_ids) -> dict:
+    """调度用：返回 {server_id: score}，隔离中的 Worker 不在结果中"""
+    now = time.time()
+    out = {}
+    with _worker_score_lock:
+        for sid in server_ids:
+            entry = _worker_scores.get(sid)
+            if entry is None:
+                out[sid] = 0.5
+            elif entry["quarantined_until"] <= now:
+                out[sid] = entry["score"]
+    return out
+
+
+def _worker_score_snapshot(server_id: str) -> Optional[dict]:
+    with _worker_score_lock:
+        entry = _worker_scores.get(server_id)
+        snapshot = dict(entry) if entry else None
+    if snapshot is None:
+        try:
+            snapshot = redis_manager.get_worker_score(server_id)
+        except Exception:
+            snapshot = None
+    if snapshot:
+        snapshot["quarantined"] = snapshot.get("quarantined_until", 0) > time.time()
+    return snapshot
+# endregion
+
+# region [DISPATCH SCHEDULER]
+# 多租户公平调度：每个用户一个虚拟时间（按已派发号码数/权重累加），每次从虚拟时间最小的用户取一个分片，
+# 同一用户的多个任务轮流出分片。Worker 同时只持有 WORKER_MAX_INFLIGHT 个未回报分片，用户可设并发上限。
+SCHED_POLICY = os.environ.get("SCHED_POLICY", "wfq").strip().lower()  # wfq: 加权公平；fifo: 旧的先到先得（用于对比）
+WORKER_MAX_INFLIGHT = max(1, int(os.environ.get("WORKER_MAX_INFLIGHT", "2")))
+SCHED_USER_MAX_INFLIGHT = int(os.environ.get("SCHED_USER_MAX_INFLIGHT", "0"))  # 0 = 不限制
+SCHED_TICK_SECONDS = float(os.environ.get("SCHED_TICK_SECONDS", "1"))
+SCHED_SMALL_TASK_NUMBERS = int(os.environ.get("SCHED_SMALL_TASK_NUMBERS", "1000"))
+SCHED_USER_RATE_PER_MIN = int(os.environ.get("SCHED_USER_RATE_PER_MIN", "0"))  # 每用户默认发送速率上限（号码/分钟），0 = 不限制
+RATE_BUCKET_BURST_SECONDS = float(os.environ.get("RATE_BUCKET_BURST_SECONDS", "10"))  # 令牌桶容量 = 速率 × 该秒数
+RATE_LEASE_SECONDS = float(os.environ.get("RATE_LEASE_SECONDS", "1"))  # 每次向 Redis 令牌桶租用约该秒数的令牌，本地扣减
+
+# 尾部分片对冲：任务完成度 >= HEDGE_PROGRESS 且某分片运行超过 max(HEDGE_MIN_SECONDS, HEDGE_MULTIPLIER × 该任务分片耗时中位数)
+# 时，复制一份到空闲 Worker；先回报者生效，后回报者不计费
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0").strip().lower() in ("1", "true", "yes", "on")
+HEDGE_PROGRESS = float(os.environ.get("HEDGE_PROGRESS", "0.8"))
+HEDGE_MULTIPLIER = float(os.environ.get("HEDGE_MULTIPLIER", "3"))
+HEDGE_MIN_SECONDS = float(os.environ.get("HEDGE_MIN_SECONDS", "30"))
+
+_sched_weight_cfg = None  # {"users": {user_id: {"weight", "max_inflight"}}, "admins": {admin_id: {...}}}
+_sched_vclock = 0.0
+_sched_greenlet = None
+_sched_throttled = {}  # 令牌桶 key -> 预计可放行时间（避免每轮反复访问 Redis）
+# 令牌租约：_sched_lock 内只扣本地租到的令牌，不足时登记到 _sched_token_wants，由 _sched_refill_tokens 在锁外向 Redis 补租
+_sched_token_lease = {}  # 令牌桶 key -> 本进程已租到、尚未使用的令牌数
+_sched_token_wants = {}  # 令牌桶 key -> (每秒速率, 容量, 至少需要的令牌数)
+
+
+def _phone_count(phones_val) -> int:
+    try:
+        if isinstance(phones_val, str):
+            return len(json.loads(phones_val) or [])
+        return len(phones_val or [])
+    except Exception:
+        return 0
+
+
+def _sched_load_weight_cfg(force: bool = False) -> dict:
+    """读取调度权重配置（settings.sched_weights，进程内缓存）"""
+    global _sched_weight_cfg
+    if _sched_weight_cfg is not None and not force:
+        return _sched_weight_cfg
+    cfg = {"users": {}, "admins": {}}
+    try:
+        conn = db()
+        cur = conn.cursor()
+        raw = _get_setting(cur, "sched_weights")
+        conn.close()
+        if raw:
+            loaded = json.loads(raw)
+            if isinstance(loaded, dict):
+                cfg["users"] = loaded.get("users") or {}
+                cfg["admins"] = loaded.get("admins") or {}
+    except Exception as e:
+        logger.warning(f"读取调度权重配置失败: {e}")
+    _sched_weight_cfg = cfg
+    return cfg
+
+
+def _sched_user_policy(user_id: str, admin_id: str = None) -> tuple:
+    """用户的 (权重, 并发上限, 速率上限)：用户配置覆盖其管理员配置，未配置时权重1、上限取环境变量默认值"""
+    cfg = _sched_load_weight_cfg()
+    entry = dict(cfg["admins"].get(str(admin_id)) or {}) if admin_id else {}
+    entry.update(cfg["users"].get(str(user_id)) or {})
+    try:
+        weight = max(0.01, float(entry.get("weight") or 1))
+    except (TypeError, ValueError):
+        weight = 1.0
+    try:
+        max_inflight = int(entry.get("max_inflight") if entry.get("max_inflight") is not None else SCHED_USER_MAX_INFLIGHT)
+    except (TypeError, ValueError):
+        max_inflight = SCHED_USER_MAX_INFLIGHT
+    try:
+        rate_per_min = int(entry.get("rate_per_min") if entry.get("rate_per_min") is not None else SCHED_USER_RATE_PER_MIN)
+    except (TypeError, ValueError):
+        rate_per_min = SCHED_USER_RATE_PER_MIN
+    return weight, max(0, max_inflight), max(0, rate_per_min)
+
+
+def _sched_kick() -> None:
+    """唤醒调度循环（有新分片/有空闲Worker/有结果回报时调用）"""
+    _ensure_dispatcher()
+    _sched_wakeup.set()
+
+
+def _ensure_dispatcher() -> None:
+    global _sched_greenlet
+    if _sched_greenlet is None or _sched_greenlet.dead:
+        _sched_greenlet = spawn(_dispatcher_loop)
+
+
+def _dispatcher_loop():
+    LOCATION = "[API][_dispatcher_loop]"
+    while True:
+        _sched_wakeup.wait(timeout=SCHED_TICK_SECONDS)
+        _sched_wakeup.clear()
+        try:
+            _sched_expire_stale()
+            _dispatch_round()
+            _sched_hedge_round()
+        except Exception as e:
+            logger.error(f"{LOCATION} 调度循环异常: {e}")
+
+
+def _sched_enqueue(task_id: str, user_id: str, message: str, trace_id: str, shards: list, admin_id: str = None, rate_per_min: int = None) -> int:
+    """把任务的待处理分片放入调度队列（已在队列或已派发的分片会被跳过），返回新入队数量"""
+    weight, max_inflight, user_rate = _sched_user_policy(user_id, admin_id)
+    added = 0
+    with _sched_lock:
+        task = _sched_tasks.get(task_id)
+        if task is None:
+            task = {"user_id": user_id, "message": message, "trace_id": trace_id, "queue": deque(), "created_at": time.time(), "started": False}
+        task["rate_per_min"] = rate_per_min or 0
+        queued_ids = {s["shard_id"] for s in task["queue"]}
+        for row in shards:
+            shard_id = row.get("shard_id")
+            if not shard_id or shard_id in queued_ids or shard_id in _sched_inflight:
+                continue
+            phones = row.get("phones")
+            task["queue"].append({"shard_id": shard_id, "phones": phones, "phone_count": _phone_count(phones)})
+            queued_ids.add(shard_id)
+            added += 1
+        if not task["queue"]:
+            return 0
+        _sched_tasks[task_id] = task
+
+        user = _sched_users.get(user_id)
+        if user is None:
+            user = _sched_users[user_id] = {"vtime": _sched_vclock, "inflight": 0, "tasks": deque()}
+        elif not user["tasks"]:
+            # 空闲后重新变为活跃：不允许“攒”虚拟时间，从当前虚拟时钟起步
+            user["vtime"] = max(user["vtime"], _sched_vclock)
+        user["weight"], user["max_inflight"], user["rate_per_min"], user["admin_id"] = weight, max_inflight, user_rate, admin_id
+        if task_id not in user["tasks"]:
+            user["tasks"].append(task_id)
+
+    _perf_incr("sched.shards_enqueued", added)
+    _sched_kick()
+    return added
+
+
+def _sched_choose_worker(user_id: str, free_slots: dict, eligible: set, scores: dict) -> Optional[str]:
+    """在用户可用且有空闲槽位的Worker中选择一个（评分高者优先，其次空闲槽位多者）"""
+    best = None
+    best_key = None
+    for worker_id in sorted(free_slots):
+        if free_slots[worker_id] <= 0 or worker_id not in eligible or worker_id not in scores:
+            continue
+        key = (scores[worker_id], free_slots[worker_id])
+        if best is None or key > best_key:
+            best, best_key = worker_id, key
+    return best
+
+
+def _sched_admit(user_id: str, user: dict, task_id: str, task: dict, amount: int) -> Optional[list]:
+    """按用户/任务令牌桶判断该分片能否放行；放行返回已扣令牌的桶列表（失败推送时归还），否则返回 None。
+    调用方持有 _sched_lock，这里只扣本地租约，不访问 Redis"""
+    now = time.time()
+    keys = []
+    short = False
+    for key, per_min in (("user:" + str(user_id), user.get("rate_per_min") or 0), ("task:" + str(task_id), task.get("rate_per_min") or 0)):
+        if per_min <= 0:
+            continue
+        if _sched_throttled.get(key, 0) > now:
+            return None
+        rate = per_min / 60.0
+        if _sched_token_lease.get(key, 0) < amount:
+            want = _sched_token_wants.get(key)
+            _sched_token_wants[key] = (rate, max(1.0, rate * RATE_BUCKET_BURST_SECONDS), max(amount, want[2] if want else 0))
+            short = True
+            continue
+        keys.append(key)
+    if short:
+        return None
+    for key in keys:
+        _sched_token_lease[key] -= amount
+    return keys
+
+
+def _sched_return_tokens(taken: list, amount: int) -> None:
+    """推送失败：令牌退回本地租约。调用方持有 _sched_lock"""
+    for key in taken or []:
+        _sched_token_lease[key] = _sched_token_lease.get(key, 0) + amount
+
+
+def _sched_refill_tokens() -> bool:
+    """在锁外向 Redis 令牌桶补租本地不足的令牌；有补到的返回 True"""
+    with _sched_lock:
+        wants = dict(_sched_token_wants)
+        _sched_token_wants.clear()
+    refilled = False
+    for key, (rate, capacity, amount) in wants.items():
+        lease = max(amount, min(capacity, rate * RATE_LEASE_SECONDS))
+        allowed, wait = redis_manager.take_tokens(key, rate, capacity, lease)
+        if not allowed and lease > amount:
+            lease = amount
+            allowed, wait = redis_manager.take_tokens(key, rate, capacity, lease)
+        with _sched_lock:
+            if allowed:
+                _sched_token_lease[key] = _sched_token_lease.get(key, 0) + lease
+                refilled = True
+            else:
+                _sched_throttled[key] = time.time() + wait
+        if not allowed:
+            _perf_incr("sched.rate_limited")
+    return refilled
+
+
+def _sched_pick(free_slots: dict, eligible: dict, scores: dict) -> Optional[dict]:
+    """选出下一个待派发分片并记账；无可派发时返回 None。调用方必须持有 _sched_lock"""
+    global _sched_vclock
+    if not any(n > 0 for n in free_slots.values()):
+        return None
+
+    options = []  # [(user_id, task_id)] 按调度策略排好序
+    for uid, user in _sched_users.items():
+        if not user["tasks"]:
+            continue
+        cap = user.get("max_inflight") or 0
+        if cap > 0 and user["inflight"] >= cap:
+            continue
+        if SCHED_POLICY == "fifo":
+            options.extend((uid, tid) for tid in user["tasks"])
+        else:
+            options.append((uid, user["tasks"][0]))
+    if not options:
+        return None
+    if SCHED_POLICY == "fifo":
+        options.sort(key=lambda o: _sched_tasks[o[1]]["created_at"])
+    else:
+        options.sort(key=lambda o: (_sched_users[o[0]]["vtime"], _sched_tasks[o[1]]["created_at"]))
+
+    for uid, task_id in options:
+        worker_id = _sched_choose_worker(uid, free_slots, eligible.get(uid) or set(), scores)
+        if worker_id is None:
+            continue
+        user = _sched_users[uid]
+        task = _sched_tasks[task_id]
+        tokens = _sched_admit(uid, user, task_id, task, max(1, task["queue"][0]["phone_count"]))
+        if tokens is None:
+            continue
+        shard = task["queue"].popleft()
+
+        job = {
+            "shard_id": shard["shard_id"],
+            "task_id": task_id,
+            "user_id": uid,
+            "admin_id": user.get("admin_id"),
+            "worker_id": worker_id,
+            "phones": shard["phones"],
+            "phone_count": shard["phone_count"],
+            "message": task["message"],
+            "trace_id": task["trace_id"],
+            "mark_running": not task["started"],
+            "started_at": time.time(),
+            "tokens": tokens,
+        }
+        task["started"] = True
+        _sched_inflight[shard["shard_id"]] = job
+        _sched_worker_load[worker_id] = _sched_worker_load.get(worker_id, 0) + 1
+        free_slots[worker_id] -= 1
+        user["inflight"] += 1
+
+        # 虚拟时间按号码数/权重推进；同一用户的多个任务轮流出分片
+        _sched_vclock = max(_sched_vclock, user["vtime"])
+        user["vtime"] += max(1, shard["phone_count"]) / user.get("weight", 1.0)
+        if not task["queue"]:
+            user["tasks"].remove(task_id)
+            _sched_tasks.pop(task_id, None)
+        elif SCHED_POLICY != "fifo":
+            user["tasks"].rotate(-1)
+        return job
+    return None
+
+
+def _dispatch_round() -> int:
+    """一轮调度：在空闲Worker槽位用完或队列为空前持续挑选分片，并发推送"""
+    ready = _ready_workers()
+    if not ready:
+        return 0
+    # 先在锁外算好每个活跃用户可用的 Worker（索引重建可能访问数据库）
+    with _sched_lock:
+        active = {uid: u.get("admin_id") for uid, u in _sched_users.items() if u["tasks"]}
+    if not active:
+        return 0
+    eligible = {uid: _eligible_workers(uid, admin_id, ready) for uid, admin_id in active.items()}
+    scores = _worker_scores_for(ready)
+    global_load = _worker_global_loads(ready)
+    jobs = []
+    with _sched_lock:
+        free_slots = {sid: WORKER_MAX_INFLIGHT - max(_sched_worker_load.get(sid, 0), global_load.get(sid, 0)) for sid in ready}
+    # 第一遍挑选时登记的令牌缺口在锁外补租，补到后再挑一遍
+    for _ in range(2):
+        with _sched_lock:
+            while True:
+                job = _sched_pick(free_slots, eligible, scores)
+                if job is None:
+                    break
+                jobs.append(job)
+        if not _sched_refill_tokens():
+            break
+    for job in jobs:
+        spawn(_sched_push, job)
+    return len(jobs)
+
+
+def _push_shard_to_worker(worker_id: str, shard_data: dict, phone_count: int = 0) -> bool:
+    """通过Worker WebSocket推送一个分片（3秒超时，超时的连接会被剔除）"""
+    LOCATION = "[API][_push_shard_to_worker]"
+    shard_id = shard_data.get("shard_id")
+    trace_id = shard_data.get("trace_id")
+    task_id = shard_data.get("task_id")
+    _trace("shard.push.begin", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=worker_id, phone_count=phone_count)
+
+    # 负载 +1（失败则回滚负载）
+    try:
+        redis_manager.incr_worker_load(worker_id, 1)
+    except Exception:
+        pass
+
+    ok = False
+    with _worker_lock:
+        display = (_worker_clients.get(worker_id) or {}).get("server_name") or worker_id
+    try:
+        # 本进程持有连接则直接写（3秒超时），否则转发给持有连接的进程
+        ok, reason = _worker_send(worker_id, {"type": "shard_run", "shard": shard_data}, require_ready=True)
+        if reason == "ack_timeout":
+            # 已转发但未等到确认：Worker 可能已收到，按已推送处理，避免重复执行；真丢失由超时回收处理
+            logger.warning(f"{LOCATION} 转发未确认，按已推送处理: worker={worker_id}, shard={shard_id}")
+            ok = True
+        if ok:
+            print(f"→ {display:8} : {shard_id}  ({phone_count})")
+        elif reason == "timeout":
+            _worker_score_on_send_fail(worker_id, timeout=True)
+        elif reason in ("send_failed", "owner_unreachable"):
+            _worker_score_on_send_fail(worker_id)
+        else:
+            logger.warning(f"{LOCATION} Worker {worker_id} 不可用: {reason}")
+
+    finally:
+        if not ok:
+            # ✅ 推送失败，回滚负载
+            try:
+                redis_manager.decr_worker_load(worker_id, 1)
+            except Exception:
+                pass
+
+    _trace("shard.push.end", trace_id=trace_id, task_id=task_id, shard_id=shard_id, worker_id=worker_id, ok=ok)
+    return ok
+
+
+def _sched_claim(job: dict) -> Optional[bool]:
+    """推送前在库里把分片从 pending 认领为 running；返回 True=认领成功，False=已被其他进程认领/不再是 pending，None=数据库异常"""
+    LOCATION = "[API][_sched_claim]"
+    conn_u = None
+    try:
+        conn_u = db()
+        cur_u = conn_u.cursor()
+        cur_u.execute("""
+            UPDATE shards
+            SET server_id=%s, status='running', locked_at=NOW(), updated=NOW()
+            WHERE shard_id=%s AND status='pending'
+            RETURNING shard_id
+        """, (job["worker_id"], job["shard_id"]))
+        claimed = cur_u.fetchone() is not None
+        started = False
+        if claimed and job.get("mark_running"):
+            cur_u.execute("UPDATE tasks SET status='running', updated=NOW() WHERE task_id=%s AND status='pending'", (job["task_id"],))
+            started = cur_u.rowcount > 0
+            _trace("task.status.running", trace_id=job["trace_id"], task_id=job["task_id"])
+        conn_u.commit()
+        if started:
+            # 状态查询读的是进度缓存，状态变化要同步进去
+            _task_progress_store(job["task_id"], {"status": "running"})
+        return claimed
+    except Exception as e:
+        logger.warning(f"{LOCATION} 认领分片失败 {job['shard_id']}: {e}")
+        _trace("shard.push.db_update_fail", trace_id=job["trace_id"], task_id=job["task_id"], shard_id=job["shard_id"], worker_id=job["worker_id"], error=str(e))
+        return None
+    finally:
+        if conn_u:
+            try:
+                conn_u.close()
+            except Exception:
+                pass
+
+
+def _sched_unclaim(job: dict) -> None:
+    """推送失败：把刚认领的分片放回 pending"""
+    conn_u = None
+    try:
+        conn_u = db()
+        cur_u = conn_u.cursor()
+        cur_u.execute("""
+            UPDATE shards SET server_id=NULL, status='pending', locked_at=NULL, updated=NOW()
+            WHERE shard_id=%s AND status='running' AND server_id=%s
+        """, (job["shard_id"], job["worker_id"]))
+        conn_u.commit()
+    except Exception as e:
+        logger.warning(f"[API][_sched_unclaim] 回退分片状态失败 {job['shard_id']}: {e}")
+    finally:
+        if conn_u:
+            try:
+                conn_u.close()
+            except Exception:
+                pass
+
+
+def _sched_abandon(job: dict) -> None:
+    """分片已被其他进程认领：撤销本进程的记账（槽位/并发/令牌），不再放回队列"""
+    with _sched_lock:
+        if _sched_inflight.get(job["shard_id"]) is not job:
+            return
+        _sched_release_locked(job["shard_id"], job["worker_id"])
+        _sched_return_tokens(job.get("tokens"), max(1, job["phone_count"]))
+    _sched_kick()
+
+
+def _sched_push(job: dict) -> bool:
+    """推送调度器选出的分片：先在库里认领（pending -> running），认领成功才推送；推送失败回退并放回队首等待下一轮"""
+    shard_id = job["shard_id"]
+    worker_id = job["worker_id"]
+    shard_data = {
+        "shard_id": shard_id,
+        "task_id": job["task_id"],
+        "user_id": job["user_id"],
+        "phones": job["phones"],
+        "message": job["message"],
+        "trace_id": job["trace_id"],
+    }
+    if job.get("hedge"):
+        shard_data["hedge"] = True
+    else:
+        # 多个进程可能同时持有同一分片（如重复的启动恢复），只有认领成功的一方推送
+        claimed = _sched_claim(job)
+        if claimed is None:
+            _perf_incr("sched.push_failed")
+            _sched_requeue(job)
+            return False
+        if not claimed:
+            _perf_incr("sched.claim_lost")
+            _sched_abandon(job)
+            return False
+    ok = _push_shard_to_worker(worker_id, shard_data, job["phone_count"])
+
+    if job.get("hedge"):
+        # 备份分片不改数据库状态；推送失败直接丢弃，原分片继续执行
+        if not ok:
+            with _sched_lock:
+                if _sched_hedges.get(shard_id) is job:
+                    _sched_hedges.pop(shard_id, None)
+                    _sched_free_job_locked(job)
+        _perf_incr("sched.hedge_pushed" if ok else "sched.hedge_push_failed")
+        return ok
+
+    if not ok:
+        _perf_incr("sched.push_failed")
+        _sched_unclaim(job)
+        _sched_requeue(job)
+        return False
+
+    _perf_incr("sched.shards_pushed")
+    return True
+
+
+def _sched_requeue(job: dict) -> None:
+    """推送失败：撤销记账，把分片放回任务队首（不立即唤醒，等下一个调度周期重试，避免空转）"""
+    with _sched_lock:
+        if _sched_inflight.get(job["shard_id"]) is not job:
+            return
+        _sched_release_locked(job["shard_id"], job["worker_id"])
+        _sched_return_tokens(job.get("tokens"), max(1, job["phone_count"]))
+        if job.get("dropped"):
+            # 任务已暂停/取消：分片仍是 pending（或已被标记 cancelled），不再放回队列
+            return
+        task = _sched_tasks.get(job["task_id"])
+        if task is None:
+            task = _sched_tasks[job["task_id"]] = {"user_id": job["user_id"], "message": job["message"], "trace_id": job["trace_id"], "queue": deque(), "created_at": job["started_at"], "started": False}
+        if job.get("mark_running"):
+            task["started"] = False
+        task["queue"].appendleft({"shard_id": job["shard_id"], "phones": job["phones"], "phone_count": job["phone_count"]})
+        user = _sched_users.get(job["user_id"])
+        if user is None:
+            user = _sched_users[job["user_id"]] = {"vtime": _sched_vclock, "inflight": 0, "tasks": deque(), "weight": 1.0, "max_inflight": SCHED_USER_MAX_INFLIGHT, "admin_id": job.get("admin_id")}
+        if job["task_id"] not in user["tasks"]:
+            user["tasks"].appendleft(job["task_id"])
+
+
+def _sched_free_job_locked(job: dict) -> None:
+    """释放一条派发记录占用的Worker槽位和用户并发额度（orphaned 的记录不占用户额度）"""
+    worker_id = job["worker_id"]
+    _sched_worker_load[worker_id] = max(0, _sched_worker_load.get(worker_id, 0) - 1)
+    user = _sched_users.get(job["user_id"])
+    if user and not job.get("orphaned"):
+        job["orphaned"] = True
+        user["inflight"] = max(0, user["inflight"] - 1)
+    if user and not user["tasks"] and user["inflight"] == 0:
+        _sched_users.pop(job["user_id"], None)
+
+
+def _sched_release_locked(shard_id: str, worker_id: str = None) -> Tuple[Optional[dict], bool]:
+    """释放 worker_id 上报的那一份分片，返回 (记录, 是否为对冲中落后的一方)"""
+    primary = _sched_inflight.get(shard_id)
+    hedge = _sched_hedges.get(shard_id)
+    if hedge and worker_id and hedge["worker_id"] == worker_id and not (primary and primary["worker_id"] == worker_id):
+        job, other = _sched_hedges.pop(shard_id), primary
+    else:
+        job, other = _sched_inflight.pop(shard_id, None), hedge
+        if job is None:
+            return None, False
+    _sched_free_job_locked(job)
+    if job.get("lost"):
+        return job, True
+    if other is not None:
+        # 先到者生效；另一份继续占着Worker槽位直到它回报或超时，但不再占用户并发额度
+        other["lost"] = True
+        if not other.get("orphaned"):
+            user = _sched_users.get(other["user_id"])
+            if user:
+                user["inflight"] = max(0, user["inflight"] - 1)
+            other["orphaned"] = True
+        _perf_incr("sched.hedge_won" if job.get("hedge") else "sched.hedge_wasted")
+    return job, False
+
+
+def _sched_release(shard_id: str, worker_id: str = None) -> Tuple[Optional[dict], bool]:
+    """分片已回报：释放Worker槽位和用户并发额度，并唤醒调度。返回 (记录, 是否为对冲中落后的一方)"""
+    with _sched_lock:
+        job, lost = _sched_release_locked(shard_id, worker_id)
+    if job:
+        if not lost:
+            _perf_observe("sched.shard_seconds", time.time() - job["started_at"])
+        _sched_kick()
+    return job, lost
+
+
+def _sched_hedge_round() -> int:
+    """对冲：为拖尾分片在空闲 Worker 上启动备份执行"""
+    if not HEDGE_ENABLED:
+        return 0
+    now = time.time()
+    with _task_tracker_lock:
+        progress = {
+            tid: (t["completed_shards"] / float(t["total_shards"]), sorted(t.get("shard_seconds") or []))
+            for tid, t in _task_tracker.items() if t.get("total_shards")
+        }
+    candidates = []
+    with _sched_lock:
+        for shard_id, job in _sched_inflight.items():
+            if shard_id in _sched_hedges or job.get("lost"):
+                continue
+            done_ratio, durations = progress.get(job["task_id"], (0, []))
+            if done_ratio < HEDGE_PROGRESS or not durations:
+                continue
+            if now - job["started_at"] >= max(HEDGE_MIN_SECONDS, HEDGE_MULTIPLIER * _percentile(durations, 50)):
+                candidates.append(job)
+    if not candidates:
+        return 0
+
+    ready = _ready_workers()
+    scores = _worker_scores_for(ready)
+    global_load = _worker_global_loads(ready)
+    eligible = {}
+    for job in candidates:
+        if job["user_id"] not in eligible:
+            eligible[job["user_id"]] = _eligible_workers(job["user_id"], job.get("admin_id"), ready)
+
+    hedges = []
+    candidates.sort(key=lambda j: j["started_at"])
+    with _sched_lock:
+        for job in candidates:
+            if _sched_inflight.get(job["shard_id"]) is not job or job["shard_id"] in _sched_hedges:
+                continue
+            # 只用完全空闲的 Worker，避免对冲挤占正常分片
+            idle = {sid: 1 for sid in ready if sid != job["worker_id"] and _sched_worker_load.get(sid, 0) == 0 and global_load.get(sid, 0) == 0}
+            worker_id = _sched_choose_worker(job["user_id"], idle, eligible.get(job["user_id"]) or set(), scores)
+            if worker_id is None:
+                continue
+            hedge = dict(job, worker_id=worker_id, started_at=now, hedge=True, orphaned=True, mark_running=False)
+            _sched_hedges[job["shard_id"]] = hedge
+            _sched_worker_load[worker_id] = _sched_worker_load.get(worker_id, 0) + 1
+            hedges.append(hedge)
+    for hedge in hedges:
+        _trace("shard.hedge", trace_id=hedge["trace_id"], task_id=hedge["task_id"], shard_id=hedge["shard_id"], worker_id=hedge["worker_id"])
+        spawn(_sched_push, hedge)
+    return len(hedges)
+
+
+def _sched_on_worker_gone(server_id: str) -> int:
+    """Worker断开：它手上的分片不再占用用户并发额度（结果若晚到仍会正常结算，超时由回收逻辑处理）。返回受影响分片数"""
+    lost = 0
+    with _sched_lock:
+        _sched_worker_load.pop(server_id, None)
+        for job in _sched_inflight.values():
+            if job["worker_id"] == server_id and not job.get("orphaned"):
+                job["orphaned"] = True
+                lost += 1
+                user = _sched_users.get(job["user_id"])
+                if user:
+                    user["inflight"] = max(0, user["inflight"] - 1)
+    return lost
+
+
+def _sched_drop_task(task_id: str) -> Tuple[int, list]:
+    """把任务移出调度队列（暂停/取消），返回 (移出的排队分片数, 仍在 Worker 上的派发记录)"""
+    with _sched_lock:
+        task = _sched_tasks.pop(task_id, None)
+        dropped = len(task["queue"]) if task else 0
+        for uid in list(_sched_users):
+            user = _sched_users[uid]
+            if task_id in user["tasks"]:
+                user["tasks"].remove(task_id)
+            if not user["tasks"] and user["inflight"] == 0:
+                _sched_users.pop(uid, None)
+        inflight = [j for j in list(_sched_inflight.values()) + list(_sched_hedges.values()) if j["task_id"] == task_id]
+        for job in inflight:
+            job["dropped"] = True
+    _perf_incr("sched.shards_dequeued", dropped)
+    return dropped, inflight
+
+
+def _sched_recall(jobs: list, reason: str) -> int:
+    """向持有分片的 Worker 发送 shard_cancel；Worker 回 shard_cancel_ack(cancelled=true) 表示分片未开始执行"""
+    sent = 0
+    for job in jobs:
+        ok, why = _worker_send(job["worker_id"], {"type": "shard_cancel", "shard_id": job["shard_id"], "task_id": job["task_id"], "reason": reason})
+        if ok:
+            sent += 1
+        elif why != "not_connected":
+            logger.warning(f"[API][_sched_recall] 发送 shard_cancel 失败 worker={job['worker_id']} shard={job['shard_id']}: {why}")
+    _perf_incr("sched.shards_recalled", sent)
+    return sent
+
+
+def _sched_on_shard_recalled(shard_id: str, worker_id: str) -> None:
+    """Worker 确认分片已撤回（未执行）：释放槽位，分片回到 pending（任务已取消则标记 cancelled）"""
+    with _sched_lock:
+        job = None
+        if _sched_hedges.get(shard_id, {}).get("worker_id") == worker_id:
+            job = _sched_hedges.pop(shard_id)
+        elif _sched_inflight.get(shard_id, {}).get("worker_id") == worker_id:
+            job = _sched_inflight.pop(shard_id)
+        if job:
+            _sched_free_job_locked(job)
+    if not job:
+        return
+    try:
+        redis_manager.decr_worker_load(worker_id, 1)
+    except Exception:
+        pass
+    if job.get("hedge"):
+        _sched_kick()
+        return
+
+    task_row = None
+    try:
+        conn = db()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            UPDATE shards s
+            SET status = CASE WHEN t.status='cancelled' THEN 'cancelled' ELSE 'pending' END, locked_at=NULL, updated=NOW()
+            FROM tasks t
+            WHERE s.shard_id=%s AND s.status='running' AND t.task_id=s.task_id
+            RETURNING t.task_id, t.user_id, t.message, t.status
+        """, (shard_id,))
+        task_row = cur.fetchone()
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.warning(f"[API][_sched_on_shard_recalled] 更新分片状态失败 {shard_id}: {e}")
+    # 撤回确认晚于恢复操作到达时，补一次入队
+    if task_row and task_row.get("status") in ("pending", "running"):
+        _assign_and_push_shards(task_row["task_id"], task_row["user_id"], task_row["message"])
+    _sched_kick()
+
+
+def _sched_expire_stale() -> None:
+    """超过 SHARD_STALE_SECONDS 未回报的分片不再计入并发（数据库侧由 _reclaim_stale_shards 回收）"""
+    stale_seconds = int(os.environ.get("SHARD_STALE_SECONDS", "600"))
+    cutoff = time.time() - stale_seconds
+    with _sched_lock:
+        stale = [sid for sid, job in _sched_inflight.items() if job["started_at"] < cutoff]
+        for shard_id in stale:
+            _sched_release_locked(shard_id)
+        for shard_id in [sid for sid, job in _sched_hedges.items() if job["started_at"] < cutoff]:
+            _sched_free_job_locked(_sched_hedges.pop(shard_id))
+        now = time.time()
+        for key in [k for k, until in _sched_throttled.items() if until <= now]:
+            _sched_throttled.pop(key, None)
+        # 已无排队分片的用户/任务，剩余租约作废（令牌桶会自行补满）
+        for key in list(_sched_token_lease):
+            kind, _, owner = key.partition(":")
+            if (kind == "user" and owner not in _sched_users) or (kind == "task" and owner not in _sched_tasks):
+                _sched_token_lease.pop(key, None)
+    if stale:
+        _perf_incr("sched.inflight_expired", len(stale))
+
+
+def _sched_observe_completion(tracker: dict) -> None:
+    """记录任务从创建到完成的耗时，按调度策略和任务大小分桶（对比 fifo / wfq 的 p50/p95）"""
+    created_at = tracker.get("created_at")
+    if not created_at:
+        return
+    size = "small" if int(tracker.get("total_numbers") or 0) <= SCHED_SMALL_TASK_NUMBERS else "large"
+    _perf_observe(f"task.completion_seconds.{SCHED_POLICY}.{size}", time.time() - created_at)
+
+
+def _sched_stats() -> dict:
+    with _sched_lock:
+        return {
+            "policy": SCHED_POLICY,
+            "worker_max_inflight": WORKER_MAX_INFLIGHT,
+            "queued_tasks": len(_sched_tasks),
+            "queued_shards": sum(len(t["queue"]) for t in _sched_tasks.values()),
+            "inflight_shards": len(_sched_inflight),
+            "hedged_shards": len(_sched_hedges),
+            "throttled": {k: round(until - time.time(), 2) for k, until in _sched_throttled.items()},
+            "token_lease": {k: round(v, 2) for k, v in _sched_token_lease.items()},
+            "worker_load": dict(_sched_worker_load),
+            "users": {
+                uid: {
+                    "vtime": round(u["vtime"], 3),
+                    "inflight": u["inflight"],
+                    "weight": u.get("weight", 1.0),
+                    "max_inflight": u.get("max_inflight", 0),
+                    "rate_per_min": u.get("rate_per_min", 0),
+                    "tasks": list(u["tasks"]),
+                }
+                for uid, u in _sched_users.items()
+            },
+        }
+
+
+def _sched_apply_weight_cfg(cfg: dict) -> None:
+    """权重配置变更后立即作用到活跃用户"""
+    global _sched_weight_cfg
+    _sched_weight_cfg = cfg
+    with _sched_lock:
+        active = [(uid, u.get("admin_id")) for uid, u in _sched_users.items()]
+    for uid, admin_id in active:
+        weight, max_inflight, rate_per_min = _sched_user_policy(uid, admin_id)
+        with _sched_lock:
+            if uid in _sched_users:
+                _sched_users[uid]["weight"] = weight
+                _sched_users[uid]["max_inflight"] = max_inflight
+                _sched_users[uid]["rate_per_min"] = rate_per_min
+    _sched_kick()
+
+
+@app.route("/api/admin/scheduler/weights", methods=["GET", "POST", "OPTIONS"])
+def admin_scheduler_weights():
+    """调度权重/并发上限/速率上限 - 超级管理员可配置管理员和任意用户，管理员只能配置自己创建的用户"""
+    if request.method == "OPTIONS": return jsonify({"ok": True})
+    
+    token = _bearer_token()
+    conn = db()
+    admin_id = _verify_admin_token(conn, token)
+    if not admin_id:
+        conn.close()
+        return jsonify({"success": False, "message": "Unauthorized: 需要管理员权限"}), 401
+    
+    if request.method == "GET":
+        conn.close()
+        cfg = _sched_load_weight_cfg(force=True)
+        return jsonify({"success": True, "policy": SCHED_POLICY, "weights": cfg, "scheduler": _sched_stats()})
+    
+    d = _json()
+    target_user = d.get("user_id")
+    target_admin = d.get("admin_id")
+    if not target_user and not target_admin:
+        conn.close()
+        return jsonify({"success": False, "message": "missing user_id/admin_id"}), 400
+    
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if admin_id != "server_manager":
+        if target_admin:
+            conn.close()
+            return jsonify({"success": False, "message": "Unauthorized: 仅限超级管理员"}), 403
+        cur.execute("SELECT created_by_admin FROM users WHERE user_id=%s", (target_user,))
+        user_row = cur.fetchone()
+        if not user_row or user_row.get("created_by_admin") != admin_id:
+            conn.close()
+            return jsonify({"success": False, "message": "只能设置自己创建的用户"}), 403
+    
+    weight = d.get("weight")
+    max_inflight = d.get("max_inflight")
+    rate_per_min = d.get("rate_per_min")
+    try:
+        weight = float(weight) if weight is not None else None
+        max_inflight = int(max_inflight) if max_inflight is not None else None
+        rate_per_min = int(rate_per_min) if rate_per_min is not None else None
+    except (TypeError, ValueError):
+        conn.close()
+        return jsonify({"success": False, "message": "weight/max_inflight/rate_per_min 格式错误"}), 400
+    if (weight is not None and weight <= 0) or (max_inflight is not None and max_inflight < 0) or (rate_per_min is not None and rate_per_min < 0):
+        conn.close()
+        return jsonify({"success": False, "message": "weight 必须大于0，max_inflight/rate_per_min 不能为负数"}), 400
+    
+    try:
+        cfg = json.loads(_get_setting(cur, "sched_weights") or "{}")
+    except Exception:
+        cfg = {}
+    cfg = {"users": dict(cfg.get("users") or {}), "admins": dict(cfg.get("admins") or {})}
+    bucket = cfg["users"] if target_user else cfg["admins"]
+    key = str(target_user or target_admin)
+    
+    # 三项都为空视为删除该配置
+    if weight is None and max_inflight is None and rate_per_min is None:
+        bucket.pop(key, None)
+    else:
+        entry = {}
+        if weight is not None:
+            entry["weight"] = weight
+        if max_inflight is not None:
+            entry["max_inflight"] = max_inflight
+        if rate_per_min is not None:
+            entry["rate_per_min"] = rate_per_min
+        bucket[key] = entry
+    
+    _set_setting(cur, "sched_weights", json.dumps(cfg))
+    conn.commit()
+    conn.close()
+    _sched_apply_weight_cfg(cfg)
+    return jsonify({"success": True, "weights": cfg})
+# endregion
+
+# region [TASK TIMERS]
+# 任务定时器：定时开始 / 每日发送时段。进程内一个最小堆 + 一个等待到最近到期时间的 greenlet，
+# 不轮询数据库；任务到点后才读一次库。启动时从数据库重新装载，保证重启后定时任务不丢
+TASK_WINDOW_UTC_OFFSET = int(os.environ.get("TASK_WINDOW_UTC_OFFSET", "480"))  # 发送时段默认时区（分钟）
+
+_timer_heap = []  # (到期时间, 序号, task_id, 动作)
+_timer_latest = {}  # task_id -> 序号；堆里序号不一致的条目视为已取消
+_timer_lock = threading.Lock()
+_timer_wakeup = Event()
+_timer_seq = 0
+_timer_greenlet = None
+
+
+def _parse_start_at(value) -> Optional[float]:
+    """start_at: 时间戳（秒/毫秒）或 ISO 时间（无时区按 UTC），返回时间戳；过去的时间视为立即开始"""
+    if value in (None, ""):
+        return None
+    try:
+        if isinstance(value, (int, float)) or str(value).replace(".", "", 1).isdigit():
+            ts = float(value)
+            ts = ts / 1000.0 if ts > 1e12 else ts
+        else:
+            dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+            ts = dt.timestamp()
+    except (TypeError, ValueError):
+        raise ValueError("invalid start_at")
+    return ts if ts > time.time() else None
+
+
+def _parse_send_window(value) -> Optional[dict]:
+    """send_window: {"start": "HH:MM", "end": "HH:MM", "utc_offset": 分钟}；start > end 表示跨零点"""
+    if not value:
+        return None
+    if not isinstance(value, dict):
+        raise ValueError("invalid send_window")
+    try:
+        out = {}
+        for key in ("start", "end"):
+            hh, mm = str(value.get(key)).split(":")
+            if not (0 <= int(hh) < 24 and 0 <= int(mm) < 60):
+                raise ValueError
+            out[key] = f"{int(hh):02d}:{int(mm):02d}"
+        out["utc_offset"] = int(value.get("utc_offset", TASK_WINDOW_UTC_OFFSET))
+    except (TypeError, ValueError):
+        raise ValueError("invalid send_window")
+    return None if out["start"] == out["end"] else out
+
+
+def _window_state(window: dict, now: float) -> Tuple[bool, float]:
+    """返回 (当前是否在发送时段内, 下一次状态切换的时间戳)"""
+    def secs(hhmm):
+        hh, mm = hhmm.split(":")
+        return int(hh) * 3600 + int(mm) * 60
+    start, end = secs(window["start"]), secs(window["end"])
+    day = (now + window.get("utc_offset", TASK_WINDOW_UTC_OFFSET) * 60) % 86400
+    if start < end:
+        inside = start <= day < end
+    else:
+        inside = day >= start or day < end
+    target = end if inside else start
+    return inside, now + ((target - day) % 86400 or 86400)
+
+
+def _timer_add(task_id: str, when: float, action: str) -> None:
+    """为任务设置（覆盖）一个定时动作：open = 尝试放行，close = 发送时段结束"""
+    global _timer_seq, _timer_greenlet
+    with _timer_lock:
+        _timer_seq += 1
+        _timer_latest[task_id] = _timer_seq
+        heapq.heappush(_timer_heap, (when, _timer_seq, task_id, action))
+    if _timer_greenlet is None or _timer_greenlet.dead:
+        _timer_greenlet = spawn(_timer_loop)
+    _timer_wakeup.set()
+
+
+def _timer_cancel(task_id: str) -> None:
+    with _timer_lock:
+        _timer_latest.pop(task_id, None)
+
+
+def _timer_loop():
+    LOCATION = "[API][_timer_loop]"
+    while True:
+        due = []
+        with _timer_lock:
+            now = time.time()
+            while _timer_heap and _timer_heap[0][0] <= now:
+                _, seq, task_id, action = heapq.heappop(_timer_heap)
+                if _timer_latest.get(task_id) == seq:
+                    _timer_latest.pop(task_id, None)
+                    due.append((task_id, action))
+            delay = (_timer_heap[0][0] - now) if _timer_heap else 3600
+        for task_id, action in due:
+            spawn(_task_timer_fire, task_id, action)
+        _timer_wakeup.clear()
+        try:
+            _timer_wakeup.wait(timeout=max(0.05, delay))
+        except Exception as e:
+            logger.error(f"{LOCATION} 定时器异常: {e}")
+
+
+def _task_timer_fire(task_id: str, action: str) -> None:
+    """定时动作到期：按 start_at / send_window 决定放行任务、收回任务或继续等待"""
+    LOCATION = "[API][_task_timer_fire]"
+    try:
+        conn = db()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT task_id, user_id, message, status, start_at, send_window FROM tasks WHERE task_id=%s", (task_id,))
+        task = cur.fetchone()
+        if not task or task["status"] not in ("scheduled", "pending", "running"):
+            conn.close()
+            return
+        now = time.time()
+        start_at = task["start_at"].timestamp() if task.get("start_at") else None
+        window = task.get("send_window")
+        if isinstance(window, str):
+            window = json.loads(window)
+
+        if start_at and start_at > now:
+            conn.close()
+            _timer_add(task_id, start_at, "open")
+            return
+        inside, next_change = _window_state(window, now) if window else (True, None)
+
+        if inside and action == "open":
+            cur.execute("""
+                UPDATE tasks SET status = CASE WHEN EXISTS (SELECT 1 FROM shards WHERE task_id=%s AND status<>'pending') THEN 'running' ELSE 'pending' END, updated=NOW()
+                WHERE task_id=%s AND status='scheduled'
+            """, (task_id, task_id))
+            conn.commit()
+            conn.close()
+            print(f"{LOCATION} ⏰ 任务 {task_id} 到达开始时间/发送时段，放行")
+            _assign_and_push_shards(task_id, task["user_id"], task["message"])
+            if next_change:
+                _timer_add(task_id, next_change, "close")
+            try:
+                broadcast_task_update(task_id, {"task_id": task_id, "status": "running", "completed": False})
+            except Exception:
+                pass
+            return
+
+        if not inside:
+            # 发送时段外：停止派发（已在Worker上的分片照常完成），等下一个时段
+            cur.execute("UPDATE tasks SET status='scheduled', updated=NOW() WHERE task_id=%s AND status IN ('pending','running')", (task_id,))
+            closed = cur.rowcount > 0
+            conn.commit()
+            conn.close()
+            if closed:
+                _task_progress_store(task_id, {"status": "scheduled"})
+            _, inflight = _sched_drop_task(task_id)
+            _sched_recall(inflight, "window_closed")
+            _timer_add(task_id, next_change, "open")
+            print(f"{LOCATION} ⏰ 任务 {task_id} 不在发送时段内，{int(next_change - now)}s 后继续")
+            return
+
+        # close 到期但仍在时段内（时段配置变化/时钟误差），重新计算下一次关闭时间
+        conn.close()
+        _timer_add(task_id, next_change, "close")
+    except Exception as e:
+        logger.error(f"{LOCATION} 处理任务定时失败 {task_id}: {e}")
+
+
+def _task_timers_reload() -> int:
+    """启动时装载定时任务和带发送时段的任务"""
+    try:
+        conn = db()
+        cur = conn.cursor()
+        cur.execute("SELECT task_id FROM tasks WHERE status='scheduled' OR (send_window IS NOT NULL AND status IN ('pending','running'))")
+        task_ids = [r[0] for r in cur.fetchall()]
+        conn.close()
+    except Exception as e:
+        logger.warning(f"[API][_task_timers_reload] 装载定时任务失败: {e}")
+        return 0
+    for task_id in task_ids:
+        _task_timer_fire(task_id, "open")
+    if task_ids:
+        print(f"[API][_task_timers_reload] ✓ 已装载 {len(task_ids)} 个定时/限时段任务")
+    return len(task_ids)
+
+
+# endregion
+
+# region [RESULT WRITER]
+# 分片结果批量写入（group commit）：WebSocket 收到 shard_result 只入队，写入器每 RESULT_BATCH_WAIT_MS 毫秒
+# 或攒满 RESULT_BATCH_MAX 条合并成一个事务提交，提交后再回 ack；批次大小/提交次数见 /api/debug/perf 的 results.*
+RESULT_BATCH_MAX = max(1, int(os.environ.get("RESULT_BATCH_MAX", "200")))
+RESULT_BATCH_WAIT_MS = max(0.0, float(os.environ.get("RESULT_BATCH_WAIT_MS", "5")))
+# 失败明细：原因字典 + 号码在分片 phones 中的下标，超过条数上限截断、超过字节阈值 zlib 压缩
+FAIL_DETAIL_MAX_ITEMS = int(os.environ.get("FAIL_DETAIL_MAX_ITEMS", "5000"))
+FAIL_DETAIL_COMPRESS_BYTES = int(os.environ.get("FAIL_DETAIL_COMPRESS_BYTES", "2048"))
+
+_result_queue = deque()
+_result_wakeup = Event()
+_result_greenlet = None
+
+
+def _result_kick() -> None:
+    global _result_greenlet
+    if _result_greenlet is None or _result_greenlet.dead:
+        _result_greenlet = spawn(_result_writer_loop)
+    _result_wakeup.set()
+
+
+def _result_writer_loop():
+    LOCATION = "[API][_result_writer_loop]"
+    while True:
+        _result_wakeup.wait()
+        _result_wakeup.clear()
+        while _result_queue:
+            if len(_result_queue) < RESULT_BATCH_MAX and RESULT_BATCH_WAIT_MS > 0:
+                # 短暂等待，让同一时间窗口内的结果进入同一批
+                time.sleep(RESULT_BATCH_WAIT_MS / 1000.0)
+            batch = []
+            while _result_queue and len(batch) < RESULT_BATCH_MAX:
+                batch.append(_result_queue.popleft())
+            try:
+                _result_flush(batch)
+            except Exception as e:
+                logger.error(f"{LOCATION} 批量写入异常: {e}")
+
+
+def _result_done(rec: dict, result: dict) -> None:
+    # 回调（回 ack 等）在独立协程里执行：单个卡住的 Worker 连接不能拖住全局写入器
+    cb = rec.get("on_done")
+    if cb:
+        spawn(_result_callback, cb, result)
+
+
+def _result_callback(cb, result: dict) -> None:
+    try:
+        cb(result)
+    except Exception as e:
+        logger.debug(f"[API][_result_done] 回调失败: {e}")
+
+
+def _result_flush(batch: list) -> None:
+    LOCATION = "[API][_result_flush]"
+    t0 = time.time()
+    try:
+        outcome = _result_write_batch(batch)
+    except Exception as e:
+        logger.error(f"{LOCATION} ❌ 批量写入失败({len(batch)}条): {e}")
+        _perf_incr("results.batch_errors")
+        if len(batch) > 1:
+            # 逐条重试，避免一条坏数据拖垮整批
+            for rec in batch:
+                _result_flush([rec])
+        else:
+            _result_done(batch[0], {"ok": False, "error": str(e)})
+        return
+    flush_ms = (time.time() - t0) * 1000
+    _perf_incr("results.commits")
+    _perf_incr("results.rows", len(batch))
+    _perf_observe("results.batch_size", len(batch))
+    _perf_observe("results.flush_ms", flush_ms)
+    _perf_observe("results.ack_wait_ms", (time.time() - min(r["queued_at"] for r in batch)) * 1000)
+    _result_after_commit(batch, outcome)
+
+
+def _pack_failures(failed: list, phones: list) -> Optional[dict]:
+    """压缩失败明细：{"v":1, "n":总数, "r":[原因], "i":[[下标...] 按原因分组], "x":[[号码, 原因序号]] 不在分片里的号码}"""
+    if not isinstance(failed, list) or not failed:
+        return None
+    pos = {}
+    for idx, p in enumerate(phones or []):
+        pos.setdefault(str(p), idx)
+    reasons, reason_idx, groups, extra = [], {}, [], []
+    for item in failed[:FAIL_DETAIL_MAX_ITEMS]:
+        if isinstance(item, dict):
+            phone = str(item.get('phone', item.get('number', '')))
+            reason = str(item.get('reason', item.get('error', '未知错误')))
+        else:
+            phone, reason = str(item), '未知错误'
+        k = reason_idx.get(reason)
+        if k is None:
+            k = reason_idx[reason] = len(reasons)
+            reasons.append(reason)
+            groups.append([])
+        i = pos.get(phone)
+        if i is None:
+            extra.append([phone, k])
+        else:
+            groups[k].append(i)
+    packed = {"v": 1, "n": len(failed), "r": reasons, "i": [sorted(g) for g in groups]}
+    if extra:
+        packed["x"] = extra
+    if len(failed) > FAIL_DETAIL_MAX_ITEMS:
+        packed["truncated"] = len(failed) - FAIL_DETAIL_MAX_ITEMS
+    raw = json.dumps(packed["i"], separators=(",", ":"))
+    if len(raw) > FAIL_DETAIL_COMPRESS_BYTES:
+        packed["z"] = base64.b64encode(zlib.compress(raw.encode("utf-8"), 6)).decode("ascii")
+        del packed["i"]
+    return packed
+
+
+def _unpack_failures(packed: dict, phones: list) -> list:
+    """还原为 [{"phone", "reason"}]（兼容旧数据：detail 里直接存的 failed 列表）"""
+    if not isinstance(packed, dict):
+        return []
+    if packed.get("v") != 1:
+        items = []
+        for item in packed.get("failed") or []:
+            if isinstance(item, dict):
+                items.append({"phone": item.get('phone', item.get('number', '')), "reason": item.get('reason', item.get('error', '未知错误'))})
+            else:
+                items.append({"phone": str(item), "reason": '未知错误'})
+        return items
+    reasons = packed.get("r") or []
+    groups = packed.get("i")
+    if groups is None and packed.get("z"):
+        groups = json.loads(zlib.decompress(base64.b64decode(packed["z"])).decode("utf-8"))
+    phones = phones or []
+    items = []
+    for k, idxs in enumerate(groups or []):
+        for i in idxs:
+            items.append({"phone": phones[i] if 0 <= i < len(phones) else None, "reason": reasons[k] if k < len(reasons) else None})
+    for phone, k in packed.get("x") or []:
+        items.append({"phone": phone, "reason": reasons[k] if k < len(reasons) else None})
+    return items
+
+
+def _shard_price(g_rates: dict, u_rates: dict) -> Tuple[float, float]:
+    """单价优先级：用户费率 > 全局费率 > CREDIT_PER_SUCCESS"""
+    g_rates = g_rates or {}
+    u_rates = u_rates or {}
+    price_success = float(os.environ.get("CREDIT_PER_SUCCESS", "1"))
+    if g_rates.get("send") is not None:
+        price_success = float(g_rates["send"])
+    if u_rates.get("send") is not None:
+        price_success = float(u_rates["send"])
+    price_fail = 0.0
+    if g_rates.get("fail") is not None:
+        price_fail = float(g_rates["fail"])
+    if u_rates.get("fail") is not None:
+        price_fail = float(u_rates["fail"])
+    return price_success, price_fail
+
+
+def _result_write_batch(batch: list) -> dict:
+    """一个事务写入整批结果：多行插入 reports、按用户合并扣费、按任务合并计数，返回提交后推送所需的数据"""
+    # 批内同一分片重复上报只处理第一条
+    uniq = {}
+    for rec in batch:
+        rec["deducted"] = False
+        if rec["shard_id"] not in uniq:
+            uniq[rec["shard_id"]] = rec
+    shard_ids = list(uniq.keys())
+
+    conn = db()
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        # 只有带失败明细的分片才取 phones（用于把失败号码换成下标）
+        failed_ids = [sid_ for sid_, rec in uniq.items() if rec["fail"] > 0 and isinstance(rec["detail"], dict) and rec["detail"].get("failed")]
+        cur.execute("""SELECT s.shard_id, s.task_id, jsonb_array_length(s.phones) AS phone_count, t.price_success, t.price_fail,
+                              CASE WHEN s.shard_id = ANY(%s) THEN s.phones END AS phones
+                       FROM shards s LEFT JOIN tasks t ON t.task_id = s.task_id WHERE s.shard_id = ANY(%s)""", (failed_ids, shard_ids))
+        shard_info = {row["shard_id"]: row for row in cur.fetchall()}
+        candidates = list(uniq.values())
+
+        # 单价取自任务创建时的快照；旧任务（无快照）才回退到当前全局/用户费率
+        g_rates = {}
+        if any((shard_info.get(rec["shard_id"]) or {}).get("price_success") is None for rec in candidates):
+            cur.execute("SELECT rates FROM admin_configs WHERE admin_id='server_manager'")
+            g_row = cur.fetchone()
+            g_rates = (g_row or {}).get("rates") or {}
+        # 余额与用户费率同一条 FOR UPDATE 查询（按 user_id 排序加锁，避免死锁）
+        user_ids = sorted({rec["uid"] for rec in candidates})
+        users = {}
+        if user_ids:
+            cur.execute("SELECT user_id, credits, rates, jsonb_array_length(COALESCE(usage,'[]'::jsonb)) AS usage_len FROM user_data WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE", (user_ids,))
+            users = {row["user_id"]: row for row in cur.fetchall()}
+        cur2 = conn.cursor()
+        for uid in user_ids:
+            if uid not in users:
+                cur2.execute("INSERT INTO user_data(user_id, credits, usage) VALUES(%s,%s,%s)", (uid, 0, json.dumps([])))
+                users[uid] = {"user_id": uid, "credits": 0, "rates": None, "usage_len": 0}
+
+        report_rows = []
+        for rec in candidates:
+            info = shard_info.get(rec["shard_id"]) or {}
+            if info.get("price_success") is not None:
+                price_success, price_fail = float(info["price_success"]), float(info.get("price_fail") or 0)
+            else:
+                price_success, price_fail = _shard_price(g_rates, users[rec["uid"]].get("rates"))
+            rec["credits"] = (float(rec["success"]) * price_success) + (float(rec["fail"]) * price_fail)
+            # reports.detail 只存 trace_id + 压缩后的失败明细，不再保存 Worker 原始报文
+            detail = rec["detail"] if isinstance(rec["detail"], dict) else {}
+            stored = {"trace_id": rec["trace_id"]}
+            failures = _pack_failures(detail.get("failed"), info.get("phones")) if rec["fail"] > 0 else None
+            if failures:
+                stored["failures"] = failures
+            report_rows.append((rec["shard_id"], rec["sid"], rec["uid"], rec["success"], rec["fail"], rec["success"] + rec["fail"], rec["credits"], json.dumps(stored, separators=(",", ":"))))
+
+        # 幂等：reports.shard_id 唯一索引，冲突说明已结算过（重启后 Worker 重发/并发重复），不再扣费
+        inserted = set()
+        if report_rows:
+            rows = execute_values(cur, "INSERT INTO reports(shard_id,server_id,user_id,success,fail,sent,credits,detail) VALUES %s ON CONFLICT DO NOTHING RETURNING shard_id", report_rows, page_size=len(report_rows), fetch=True)
+            inserted = {row["shard_id"] for row in rows}
+        fresh = [rec for rec in candidates if rec["shard_id"] in inserted]
+
+        server_ids = list({rec["sid"] for rec in fresh if rec["sid"]})
+        server_names = {}
+        if server_ids:
+            cur.execute("SELECT server_id, server_name FROM servers WHERE server_id = ANY(%s)", (server_ids,))
+            server_names = {row["server_id"]: row.get("server_name") or row["server_id"] for row in cur.fetchall()}
+
+        balances = {uid: float(users[uid].get("credits") or 0) for uid in user_ids}
+        new_usage = {uid: [] for uid in user_ids}
+        task_sums = {}
+        shard_rows = []
+        for rec in fresh:
+            uid = rec["uid"]
+            suc, fail = rec["success"], rec["fail"]
+            sent = suc + fail
+            info = shard_info.get(rec["shard_id"]) or {}
+            credits = rec["credits"]
+            old_c = balances[uid]
+            new_c = max(0.0, old_c - credits)
+            balances[uid] = new_c
+            rec["deducted"] = True
+            # 统一 usage 记录结构：给前端提供 action 字段（充值/消费/统计）
+            # 保留原字段（sid/shard/success/...）避免老前端断裂
+            new_usage[uid].append({
+                "action": "deduct",
+                "sid": rec["sid"],
+                "shard": rec["shard_id"],
+                "success": suc,
+                "fail": fail,
+                "sent": sent,
+                "credits": credits,
+                "amount": credits,
+                "old_credits": old_c,
+                "new_credits": new_c,
+                "ts": now_iso(),
+            })
+            shard_rows.append((rec["shard_id"], json.dumps({"success": suc, "fail": fail, "sent": sent})))
+            if info:
+                t = task_sums.setdefault(info["task_id"], {"success": 0, "fail": 0, "sent": 0, "credits": 0.0})
+                t["success"] += suc
+                t["fail"] += fail
+                t["sent"] += sent
+                t["credits"] += credits
+
+        if shard_rows:
+            execute_values(cur2, "UPDATE shards AS s SET status='done', result=v.result::jsonb, updated=NOW() FROM (VALUES %s) AS v(shard_id, result) WHERE s.shard_id=v.shard_id", shard_rows, page_size=len(shard_rows))
+        dup_ids = [sid_ for sid_ in shard_ids if sid_ not in inserted]
+        if dup_ids:
+            cur2.execute("UPDATE shards SET status='done', updated=NOW() WHERE shard_id = ANY(%s) AND status <> 'done'", (dup_ids,))
+        for uid in user_ids:
+            if new_usage[uid]:
+                cur2.execute("UPDATE user_data SET credits=%s, usage=COALESCE(usage,'[]'::jsonb) || %s::jsonb WHERE user_id=%s", (balances[uid], json.dumps(new_usage[uid]), uid))
+        if task_sums:
+            execute_values(cur2, """UPDATE tasks AS t SET success_count=COALESCE(t.success_count,0)+v.s, fail_count=COALESCE(t.fail_count,0)+v.f, sent_count=COALESCE(t.sent_count,0)+v.n, updated=NOW()
+                                    FROM (VALUES %s) AS v(task_id, s, f, n) WHERE t.task_id=v.task_id""",
+                           [(tid, t["success"], t["fail"], t["sent"]) for tid, t in task_sums.items()])
+
+        # 按任务一次性统计分片状态，判断是否完成
+        task_ids = list({info["task_id"] for info in shard_info.values()})
+        shard_counts = {}
+        completed = set()
+        task_rows = {}
+        if task_ids:
+            cur.execute("SELECT task_id, COUNT(*) FILTER (WHERE status='pending') AS pending, COUNT(*) FILTER (WHERE status='running') AS running, COUNT(*) FILTER (WHERE status='done') AS done, COUNT(*) AS total FROM shards WHERE task_id = ANY(%s) GROUP BY task_id", (task_ids,))
+            shard_counts = {row["task_id"]: row for row in cur.fetchall()}
+            finished = [tid for tid, row in shard_counts.items() if int(row["total"]) > 0 and int(row["done"]) >= int(row["total"])]
+            if finished:
+                # 已取消的任务不会因为取消前派出的分片回报而变成 done
+                cur.execute("UPDATE tasks SET status='done', updated=NOW() WHERE task_id = ANY(%s) AND status NOT IN ('done','cancelled') RETURNING task_id", (finished,))
+                completed = {row["task_id"] for row in cur.fetchall()}
+            cur.execute("SELECT task_id, user_id, status, COALESCE(success_count,0) AS success, COALESCE(fail_count,0) AS fail, COALESCE(sent_count,0) AS sent FROM tasks WHERE task_id = ANY(%s)", (task_ids,))
+            task_rows = {row["task_id"]: row for row in cur.fetchall()}
+
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        raise
+    finally:
+        conn.close()
+
+    # usage 增量：seq 为追加后的记录总数（第 n 条记录的序号为 n），前端据此发现缺口
+    usage_delta = {}
+    for uid in user_ids:
+        if new_usage[uid]:
+            from_seq = int(users[uid].get("usage_len") or 0)
+            usage_delta[uid] = {"entries": new_usage[uid], "from_seq": from_seq, "seq": from_seq + len(new_usage[uid])}
+    return {
+        "shard_info": shard_info, "server_names": server_names, "balances": balances, "usage_delta": usage_delta,
+        "task_sums": task_sums, "shard_counts": shard_counts, "task_rows": task_rows, "completed": completed,
+    }
+
+
+def _result_after_commit(batch: list, outcome: dict) -> None:
+    """提交后：回 ack、结算冻结积分、推送任务进度/余额、清理已完成任务的内存追踪"""
+    LOCATION = "[API][report_shard_result]"
+    shard_info = outcome["shard_info"]
+    for rec in batch:
+        if rec["deducted"]:
+            info = shard_info.get(rec["shard_id"]) or {}
+            server_name = outcome["server_names"].get(rec["sid"], rec["sid"])
+            # 失败号码明细不再逐行打印，按需查询 /api/shard/<shard_id>/failures
+            print(f"(Done) {server_name:8} : {rec['shard_id'][:8]}  ({info.get('phone_count', 0)})  成功: {rec['success']:2} | 失败: {rec['fail']:2} | 消耗: {rec['credits']:6.1f}积分")
+        _trace("report_shard_result.db.commit", trace_id=rec["trace_id"], shard_id=rec["shard_id"], task_id=(shard_info.get(rec["shard_id"]) or {}).get("task_id"))
+        _result_done(rec, {"ok": True, "deducted": rec["deducted"]})
+
+    for task_id, t in outcome["task_sums"].items():
+        # 取消时预占已整体释放，迟到的结果不再扣预占
+        if (outcome["task_rows"].get(task_id) or {}).get("status") == "cancelled":
+            continue
+        _credit_hold_consume(task_id, t["credits"])
+    for task_id in outcome["completed"]:
+        _credit_hold_release(task_id)
+
+    trace_ids = {}
+    for rec in batch:
+        info = shard_info.get(rec["shard_id"])
+        if info and rec["trace_id"]:
+            trace_ids[info["task_id"]] = rec["trace_id"]
+    for task_id, counts in outcome["shard_counts"].items():
+        row = outcome["task_rows"].get(task_id) or {}
+        task_completed = task_id in outcome["completed"]
+        done_shards = int(counts.get("done", 0))
+        total_shards = int(counts.get("total", 0))
+        total_success = int(row.get("success", 0))
+        total_fail = int(row.get("fail", 0))
+        if task_completed:
+            print(f"{LOCATION} ✅ 任务完成 | Shard: {done_shards}/{total_shards} | 成功: {total_success} | 失败: {total_fail} | 总计: {int(row.get('sent', 0))}")
+        else:
+            print(f"{LOCATION} 📊 统计 | Shard: {done_shards}/{total_shards} | 成功: {total_success} | 失败: {total_fail}")
+        update_data = {"task_id": task_id, "status": row.get("status") or "running", "trace_id": trace_ids.get(task_id), "shards": {"pending": int(counts.get("pending", 0)), "running": int(counts.get("running", 0)), "done": done_shards, "total": total_shards}, "result": {"success": total_success, "fail": total_fail, "sent": int(row.get("sent", 0))}, "credits": outcome["balances"].get(row.get("user_id")), "completed": task_completed}
+        try:
+            broadcast_task_update(task_id, update_data)
+            _trace("report_shard_result.broadcast_task_update.ok", trace_id=trace_ids.get(task_id), task_id=task_id, done=done_shards, total=total_shards)
+        except Exception as e:
+            logger.debug(f"{LOCATION} ❌ 推送任务更新失败: {e}")
+            _trace("report_shard_result.broadcast_task_update.fail", trace_id=trace_ids.get(task_id), task_id=task_id, error=str(e))
+
+    # 推送 usage 增量（只发新记录 + 余额 + 序号，前端发现序号缺口时再拉 /api/user/<id>/usage）
+    for uid, delta in outcome["usage_delta"].items():
+        new_c = outcome["balances"].get(uid)
+        try:
+            broadcast_user_update(uid, 'usage_update', {**delta, 'credits': new_c, 'balance': new_c})
+        except Exception as e:
+            logger.warning(f"推送 usage 更新失败: {e}")
+
+    # 任务完成后清理内存追踪器
+    for task_id in outcome["completed"]:
+        with _task_tracker_lock:
+            finished = _task_tracker.pop(task_id, None)
+            # 正常完成时索引已随每个分片回报清空，只有追踪器与数据库不一致时才需要扫描清理
+            if not finished or finished["completed_shards"] < finished["total_shards"]:
+                _shard_index_drop_task(task_id)
+        if finished:
+            _sched_observe_completion(finished)
+            print(f"{LOCATION} ✓ 已从内存追踪器中清理任务 {task_id}")
+# endregion
+
+# region [STARTUP RECOVERY]
+# 启动恢复：进程重启后内存里的任务追踪器/调度队列/积分预占都是空的。
+# 从 tasks/shards 重建追踪器，把超过宽限期仍是 running 的分片（原Worker大概率已丢失）放回 pending，
+# 然后把所有进行中的任务重新交给调度器。多进程部署时同一次部署只由第一个拿到标记的进程执行一次：
+# 标记在恢复成功后保留 RECOVERY_MARKER_TTL 秒，之后启动的进程不再重复入队（分片派发前还会在库里认领，重复入队也不会重复发送）
+RECOVERY_GRACE_SECONDS = int(os.environ.get("RECOVERY_GRACE_SECONDS", "120"))
+RECOVERY_MARKER_TTL = int(os.environ.get("RECOVERY_MARKER_TTL", "600"))
+RECOVERY_DEPLOY_ID = os.environ.get("DEPLOY_ID") or os.environ.get("HEROKU_RELEASE_VERSION") or "default"
+
+_recovery_report = {}
+
+
+def _startup_recovery() -> dict:
+    global _recovery_report
+    LOCATION = "[API][_startup_recovery]"
+    started = time.time()
+    report = {"started_at": now_iso(), "tasks": 0, "requeued_shards": 0, "queued_shards": 0, "skipped": False}
+    marker = f"startup_recovery:{RECOVERY_DEPLOY_ID}"
+    if not redis_manager.acquire_lock(marker, timeout=RECOVERY_MARKER_TTL):
+        report["skipped"] = True
+        _recovery_report = report
+        print(f"{LOCATION} ⏭ 本次部署已由其他进程执行（或正在执行）启动恢复，跳过")
+        return report
+    try:
+        conn = db()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        # 所有未结束的任务（含暂停/定时）都要重建追踪器、分片索引和积分预占，否则恢复/放行后结果无法结算
+        cur.execute("SELECT task_id, user_id, status, message, total, price_success, send_window IS NOT NULL AS windowed, EXTRACT(EPOCH FROM created) AS created_ts FROM tasks WHERE status NOT IN ('done','cancelled')")
+        tasks = cur.fetchall()
+        task_ids = [t["task_id"] for t in tasks]
+        if task_ids:
+            # 1. 宽限期外仍为 running 的分片视为孤儿，放回 pending 等待重新派发
+            cur.execute("""
+                UPDATE shards SET status='pending', locked_at=NULL, updated=NOW(), attempts = attempts + 1
+                WHERE task_id = ANY(%s) AND status='running'
+                  AND (locked_at IS NULL OR locked_at < NOW() - (%s * interval '1 second'))
+            """, (task_ids, RECOVERY_GRACE_SECONDS))
+            report["requeued_shards"] = cur.rowcount
+            conn.commit()
+
+            # 2. 分片统计 + 已完成分片结果，用于重建追踪器和积分预占
+            cur.execute("""
+                SELECT task_id, COUNT(*) AS total_shards,
+                       COALESCE(SUM(jsonb_array_length(phones)) FILTER (WHERE status NOT IN ('done','cancelled')), 0) AS remaining_numbers
+                FROM shards WHERE task_id = ANY(%s) GROUP BY task_id
+            """, (task_ids,))
+            shard_stats = {r["task_id"]: r for r in cur.fetchall()}
+            cur.execute("""
+                SELECT s.task_id, s.shard_id, COALESCE(r.success, 0) AS success, COALESCE(r.fail, 0) AS fail
+                FROM shards s LEFT JOIN reports r ON r.shard_id = s.shard_id
+                WHERE s.task_id = ANY(%s) AND s.status='done'
+            """, (task_ids,))
+            done_results = {}
+            for r in cur.fetchall():
+                done_results.setdefault(r["task_id"], {})[r["shard_id"]] = {"success": int(r["success"]), "fail": int(r["fail"])}
+            cur.execute("SELECT shard_id, task_id FROM shards WHERE task_id = ANY(%s) AND status IN ('pending','running')", (task_ids,))
+            open_shards = cur.fetchall()
+            with _task_tracker_lock:
+                for r in open_shards:
+                    _shard_task_index.setdefault(r["shard_id"], r["task_id"])
+
+            # 有单价快照的任务直接用快照；旧任务按用户当前费率估算
+            prices = {}
+            legacy_users = {t["user_id"] for t in tasks if t.get("price_success") is None}
+            if legacy_users:
+                g_rates = _get_global_rates(conn)
+                for uid in legacy_users:
+                    prices[uid] = _shard_price(g_rates, _get_user_rates(conn, uid))[0]
+        conn.close()
+
+        to_queue = []
+        for t in tasks:
+            task_id = t["task_id"]
+            stats = shard_stats.get(task_id)
+            if not stats:
+                continue  # 分片尚未创建（创建过程中崩溃），无法恢复
+            results = done_results.get(task_id, {})
+            with _task_tracker_lock:
+                if task_id not in _task_tracker:
+                    _task_tracker[task_id] = {
+                        "user_id": t["user_id"],
+                        "total_shards": int(stats["total_shards"]),
+                        "completed_shards": len(results),
+                        "shard_results": results,
+                        "created_at": float(t["created_ts"] or time.time()),
+                        "trace_id": None,
+                        "message": t["message"],
+                        "total_numbers": int(t.get("total") or 0),
+                    }
+            # 预占已在 Redis 中的直接沿用；内存模式重启后按剩余号码 × 冻结单价重算
+            if not redis_manager.credit_hold_exists(task_id):
+                price = float(t["price_success"]) if t.get("price_success") is not None else prices[t["user_id"]]
+                _credit_hold_place(task_id, t["user_id"], float(stats["remaining_numbers"]) * price)
+            report["tasks"] += 1
+            # 暂停的任务等 task_resume；定时/带发送时段的任务由定时器按当前时段决定是否放行
+            if t["status"] in ("pending", "running") and not t.get("windowed"):
+                to_queue.append(t)
+
+        # 3. 先装载定时器：停机期间发送时段已关闭的任务在这里转为 scheduled，不会被派发
+        _task_timers_reload()
+        for t in to_queue:
+            result = _assign_and_push_shards(t["task_id"], t["user_id"], t["message"])
+            report["queued_shards"] += result.get("queued", 0)
+    except Exception as e:
+        report["error"] = str(e)
+        logger.error(f"{LOCATION} 启动恢复失败: {e}")
+        # 失败时撤掉标记，让下一个启动的进程重试
+        redis_manager.release_lock(marker)
+
+    report["duration_seconds"] = round(time.time() - started, 3)
+    _recovery_report = report
+    _perf_observe("startup.recovery_seconds", report["duration_seconds"])
+    _perf_incr("startup.recovered_tasks", report["tasks"])
+    print(f"{LOCATION} ✓ 启动恢复完成 | 任务: {report['tasks']} | 孤儿分片: {report['requeued_shards']} | 入队: {report['queued_shards']} | 耗时: {report['duration_seconds']}s")
+    return report
+
+
+# 模块加载时在后台执行（gevent 主循环启动后运行，不阻塞导入）
+spawn(_startup_recovery)
+# endregion
+
+# region [SUPER ADMIN]
+
+
+@app.route("/api/super-admin/worker/<server_id>/info", methods=["GET", "OPTIONS"])
+def super_admin_worker_info(server_id: str):
+    """获取worker详细信息"""
     if request.method == "OPTIONS":
         return jsonify({"ok": True})
     
@@ -5564,7 +7891,8 @@ def super_admin_worker_info(server_id: str):
             "port": server_row.get("port"),
             "api_url": server_row.get("server_url"),
             "status": server_row.get("status"),
-            "meta": meta
+            "meta": meta,
+            "score": _worker_score_snapshot(server_id)
         }
         
         return jsonify({"success": True, "info": result})
@@ -5590,17 +7918,8 @@ def super_admin_worker_control(server_id: str):
     if not action:
         return jsonify({"success": False, "message": "缺少action参数"}), 400
     
-    # 查找对应的worker WebSocket连接
-    worker_ws = None
-    with _worker_lock:
-        if server_id in _worker_clients:
-            worker_ws = _worker_clients[server_id].get("ws")
-    
-    if not worker_ws:
-        return jsonify({"success": False, "message": "服务器未连接"}), 404
-    
     try:
-        # 通过WebSocket发送控制命令
+        # 通过WebSocket发送控制命令（Worker 连在其他 API 进程时由该进程代发并回 ack）
         command_id = secrets.token_urlsafe(8)  # 生成命令ID用于追踪
         command = {
             "type": "super_admin_command",
@@ -5608,7 +7927,11 @@ def super_admin_worker_control(server_id: str):
             "params": params,
             "command_id": command_id
         }
-        worker_ws.send(json.dumps(command))
+        ok, reason = _worker_send(server_id, command)
+        if not ok:
+            if reason == "not_connected":
+                return jsonify({"success": False, "message": "服务器未连接"}), 404
+            return jsonify({"success": False, "message": f"命令发送失败: {reason}", "command_id": command_id}), 502
         
         # 命令已发送，worker会异步执行并通过WebSocket推送日志
         # 这里立即返回成功，前端通过WebSocket接收实时日志
@@ -7,6 +7,7 @@ import json
 import time
 import threading
 import logging
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Set, Union
 from datetime import datetime, timedelta
 
@@ -15,6 +16,41 @@ from redis import Redis
 
 logger = logging.getLogger(__name__)
 
+# 令牌桶（允许欠账）：令牌 >= min(请求量, 容量) 即放行并扣除全部请求量，大请求之后的等待时间按欠账自然拉长
+_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1])
+local ts = tonumber(data[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local need = math.min(amount, capacity)
+local allowed = 0
+local wait = 0
+if amount <= 0 or tokens >= need then
+    tokens = math.min(capacity, tokens - amount)
+    allowed = 1
+else
+    wait = (need - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2 + 60)
+return {allowed, tostring(wait)}
+"""
+
+_COMPARE_DELETE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
 
 class RedisManager:
     """Redis状态管理器（支持内存降级）"""
@@ -42,6 +78,29 @@ class RedisManager:
         self.use_redis = bool(self.redis_url)
         self.client = None
 
+        # ===== 内存后备存储（Redis 不可用时也必须存在）=====
+        self._memory_store = {
+            "online_workers": set(),
+            "worker_data": {},
+            "worker_load": {},
+            "frontend_subs": {},
+            "task_subs": {},
+            "locks": {},
+            "worker_score": {},
+            "buckets": {},
+            "task_progress": OrderedDict(),  # task_id -> (过期时间, 进度)，按最近写入排序做 LRU
+            "worker_owner": {},  # server_id -> (进程ID, 过期时间)
+            "seq": {},  # 序列号名称 -> (当前值, 过期时间/None)
+            "credit_holds": {},  # task_id -> {"user_id", "amount"}
+        }
+        self._task_progress_max = int(os.environ.get("TASK_PROGRESS_MAX", "5000"))
+
+        # ===== 重连控制 =====
+        self._reconnect_attempts = 0
+        self._max_reconnect_attempts = 5
+        self._last_reconnect_time = 0
+        self._reconnect_cooldown = 15
+
         if not self.use_redis:
             logger.warning("⚠️ REDIS_URL 未设置，使用内存模式")
             return
@@ -67,21 +126,6 @@ class RedisManager:
             self.use_redis = False
             self.client = None
 
-        # ===== 内存后备存储 =====
-        self._memory_store = {
-            "online_workers": set(),
-            "worker_data": {},
-            "worker_load": {},
-            "frontend_subs": {},
-            "task_subs": {},
-            "locks": {},
-        }
-
-        # ===== 重连控制 =====
-        self._reconnect_attempts = 0
-        self._max_reconnect_attempts = 5
-        self._last_reconnect_time = 0
-        self._reconnect_cooldown = 15
 
 
     def _reconnect(self) -> bool:
@@ -455,6 +499,275 @@ class RedisManager:
             with self._memory_lock:
                 return self._memory_store["worker_load"].get(server_id, {}).get("load", 0)
     
+    def get_worker_loads(self, server_ids: List[str]) -> Dict[str, int]:
+        """批量获取Worker负载（所有API进程推送的在途分片总数）"""
+        if not server_ids:
+            return {}
+        if self.use_redis and self.client:
+            try:
+                values = self.client.mget([f"worker:{sid}:load" for sid in server_ids])
+                return {sid: int(v) if v else 0 for sid, v in zip(server_ids, values)}
+            except Exception as e:
+                logger.warning(f"Redis批量获取负载失败: {e}")
+                return {}
+        else:
+            # 内存模式
+            with self._memory_lock:
+                return {sid: self._memory_store["worker_load"].get(sid, {}).get("load", 0) for sid in server_ids}
+    
+    # ==================== Worker 归属（多进程路由） ====================
+    
+    def set_worker_owner(self, server_id: str, owner: str, ttl: int = 60) -> bool:
+        """记录持有该Worker WebSocket的API进程（心跳续期）"""
+        if self.use_redis and self.client:
+            try:
+                self.client.set(f"worker_owner:{server_id}", owner, ex=ttl)
+                return True
+            except Exception as e:
+                logger.warning(f"Redis记录Worker归属失败: {e}")
+                return False
+        else:
+            # 内存模式
+            with self._memory_lock:
+                self._memory_store["worker_owner"][server_id] = (owner, time.time() + ttl)
+            return True
+    
+    def clear_worker_owner(self, server_id: str, owner: str) -> bool:
+        """只有归属仍是 owner 时才删除（Worker 可能已重连到其他进程）"""
+        if self.use_redis and self.client:
+            try:
+                return bool(self.client.eval(_COMPARE_DELETE_LUA, 1, f"worker_owner:{server_id}", owner))
+            except Exception as e:
+                logger.warning(f"Redis清除Worker归属失败: {e}")
+                return False
+        else:
+            # 内存模式
+            with self._memory_lock:
+                if self._memory_store["worker_owner"].get(server_id, (None, 0))[0] == owner:
+                    self._memory_store["worker_owner"].pop(server_id, None)
+                    return True
+            return False
+    
+    def get_worker_owners(self, server_ids: List[str]) -> Dict[str, str]:
+        """批量查询Worker归属进程，未知的不返回"""
+        if not server_ids:
+            return {}
+        if self.use_redis and self.client:
+            try:
+                values = self.client.mget([f"worker_owner:{sid}" for sid in server_ids])
+                return {sid: v for sid, v in zip(server_ids, values) if v}
+            except Exception as e:
+                logger.warning(f"Redis查询Worker归属失败: {e}")
+                return {}
+        else:
+            # 内存模式
+            now = time.time()
+            with self._memory_lock:
+                owners = self._memory_store["worker_owner"]
+                return {sid: owners[sid][0] for sid in server_ids if sid in owners and owners[sid][1] > now}
+    
+    # ==================== 序列号 ====================
+    
+    def next_seq(self, name: str, ttl: int = None, fallback: bool = True) -> Optional[int]:
+        """递增并返回序列号（多个 API 进程共享同一计数）；ttl 用于按主题的临时序列，空闲后自动过期。
+        fallback=False 时 Redis 异常返回 None，而不是改用本进程计数（避免与其他进程的版本号倒退/冲突）"""
+        if self.use_redis and self.client:
+            try:
+                if ttl:
+                    pipe = self.client.pipeline()
+                    pipe.incr(f"seq:{name}")
+                    pipe.expire(f"seq:{name}", ttl)
+                    return int(pipe.execute()[0])
+                return int(self.client.incr(f"seq:{name}"))
+            except Exception as e:
+                logger.warning(f"Redis递增序列号失败: {e}")
+                if not fallback:
+                    return None
+        # 内存模式（或 Redis 异常时）：与 Redis 一样按 ttl 过期，过期后从 1 重新编号
+        now = time.time()
+        with self._memory_lock:
+            value = self._memory_seq_value(name, now) + 1
+            self._memory_store["seq"][name] = (value, now + ttl if ttl else None)
+            return value
+    
+    def _memory_seq_value(self, name: str, now: float) -> int:
+        """读取内存序列号（调用方持有 _memory_lock），已过期的视为 0"""
+        value, expire = self._memory_store["seq"].get(name, (0, None))
+        if expire is not None and now > expire:
+            self._memory_store["seq"].pop(name, None)
+            return 0
+        return value
+    
+    def get_seq(self, name: str, fallback: bool = True) -> Optional[int]:
+        """读取当前序列号（fallback=False 时 Redis 异常返回 None）"""
+        if self.use_redis and self.client:
+            try:
+                value = self.client.get(f"seq:{name}")
+                return int(value) if value else 0
+            except Exception as e:
+                logger.warning(f"Redis读取序列号失败: {e}")
+                if not fallback:
+                    return None
+        with self._memory_lock:
+            return self._memory_seq_value(name, time.time())
+    
+    # ==================== 评分管理 ====================
+    
+    def set_worker_score(self, server_id: str, score: Dict[str, Any], ttl: int = 86400) -> bool:
+        """保存Worker评分（跨进程/重启共享）"""
+        if self.use_redis and self.client:
+            try:
+                self.client.set(f"worker:{server_id}:score", json.dumps(score), ex=ttl)
+                return True
+            except Exception as e:
+                logger.warning(f"Redis保存评分失败: {e}")
+                return False
+        else:
+            # 内存模式
+            with self._memory_lock:
+                self._memory_store["worker_score"][server_id] = dict(score)
+            return True
+    
+    def get_worker_score(self, server_id: str) -> Optional[Dict[str, Any]]:
+        """获取Worker评分"""
+        if self.use_redis and self.client:
+            try:
+                data = self.client.get(f"worker:{server_id}:score")
+                return json.loads(data) if data else None
+            except Exception as e:
+                logger.warning(f"Redis获取评分失败: {e}")
+                return None
+        else:
+            # 内存模式
+            with self._memory_lock:
+                data = self._memory_store["worker_score"].get(server_id)
+                return dict(data) if data else None
+    
+    # ==================== 发布/订阅 ====================
+    
+    def publish(self, channel: str, data: Dict[str, Any]) -> int:
+        """跨进程广播消息，返回收到的订阅者数量（内存模式只有本进程，返回0）"""
+        if self.use_redis and self.client:
+            try:
+                return int(self.client.publish(channel, json.dumps(data)))
+            except Exception as e:
+                logger.warning(f"Redis发布消息失败: {e}")
+        return 0
+    
+    def subscribe(self, *channels: str):
+        """订阅频道，返回 pubsub 对象（调用方轮询 get_message）；内存模式返回 None"""
+        if self.use_redis and self.client:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(*channels)
+                return pubsub
+            except Exception as e:
+                logger.warning(f"Redis订阅失败: {e}")
+        return None
+    
+    # ==================== 令牌桶限速 ====================
+    
+    def take_tokens(self, key: str, rate_per_sec: float, capacity: float, amount: float) -> tuple:
+        """从令牌桶取 amount 个令牌（amount<0 表示归还），返回 (是否放行, 需等待秒数)"""
+        if rate_per_sec <= 0:
+            return True, 0.0
+        capacity = max(1.0, float(capacity))
+        now = time.time()
+        if self.use_redis and self.client:
+            try:
+                allowed, wait = self.client.eval(_TOKEN_BUCKET_LUA, 1, f"bucket:{key}", rate_per_sec, capacity, amount, now)
+                return bool(int(allowed)), float(wait)
+            except Exception as e:
+                logger.warning(f"Redis令牌桶失败，改用内存: {e}")
+        # 内存模式（或 Redis 异常时）
+        with self._memory_lock:
+            tokens, ts = self._memory_store["buckets"].get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate_per_sec)
+            need = min(amount, capacity)
+            if amount <= 0 or tokens >= need:
+                self._memory_store["buckets"][key] = (min(capacity, tokens - amount), now)
+                return True, 0.0
+            self._memory_store["buckets"][key] = (tokens, now)
+            return False, (need - tokens) / rate_per_sec
+    
+    # ==================== 积分预占 ====================
+    # Redis 布局：credit_holds:<user_id> 哈希（task_id -> 剩余预占额），credit_hold_owner 哈希（task_id -> user_id）
+    # 多个 API 进程共享同一份预占，进程重启后也不会丢失；扣减可能减到负数，读取时按 0 处理
+    
+    def credit_hold_place(self, task_id: str, user_id: str, amount: float) -> bool:
+        """设置任务的积分预占额（覆盖旧值）"""
+        amount = max(0.0, float(amount))
+        if self.use_redis and self.client:
+            try:
+                pipe = self.client.pipeline()
+                pipe.hset("credit_hold_owner", task_id, user_id)
+                pipe.hset(f"credit_holds:{user_id}", task_id, amount)
+                pipe.execute()
+                return True
+            except Exception as e:
+                logger.warning(f"Redis写入积分预占失败，改用内存: {e}")
+        with self._memory_lock:
+            self._memory_store["credit_holds"][task_id] = {"user_id": user_id, "amount": amount}
+        return True
+    
+    def credit_hold_consume(self, task_id: str, amount: float) -> None:
+        """分片结算后扣减预占额"""
+        if self.use_redis and self.client:
+            try:
+                user_id = self.client.hget("credit_hold_owner", task_id)
+                if user_id:
+                    self.client.hincrbyfloat(f"credit_holds:{user_id}", task_id, -float(amount))
+                    return
+            except Exception as e:
+                logger.warning(f"Redis扣减积分预占失败，改用内存: {e}")
+        with self._memory_lock:
+            hold = self._memory_store["credit_holds"].get(task_id)
+            if hold:
+                hold["amount"] = max(0.0, hold["amount"] - float(amount))
+    
+    def credit_hold_release(self, task_id: str) -> float:
+        """释放任务的预占，返回释放前的剩余额"""
+        released = 0.0
+        if self.use_redis and self.client:
+            try:
+                user_id = self.client.hget("credit_hold_owner", task_id)
+                if user_id:
+                    pipe = self.client.pipeline()
+                    pipe.hget(f"credit_holds:{user_id}", task_id)
+                    pipe.hdel(f"credit_holds:{user_id}", task_id)
+                    pipe.hdel("credit_hold_owner", task_id)
+                    value = pipe.execute()[0]
+                    released = max(0.0, float(value or 0))
+            except Exception as e:
+                logger.warning(f"Redis释放积分预占失败: {e}")
+        with self._memory_lock:
+            hold = self._memory_store["credit_holds"].pop(task_id, None)
+        if hold:
+            released = max(released, hold["amount"])
+        return released
+    
+    def credit_held(self, user_id: str) -> float:
+        """用户所有未结束任务的预占总额"""
+        held = 0.0
+        if self.use_redis and self.client:
+            try:
+                held = sum(max(0.0, float(v)) for v in self.client.hvals(f"credit_holds:{user_id}"))
+            except Exception as e:
+                logger.warning(f"Redis读取积分预占失败: {e}")
+        with self._memory_lock:
+            held += sum(h["amount"] for h in self._memory_store["credit_holds"].values() if h["user_id"] == user_id)
+        return held
+    
+    def credit_hold_exists(self, task_id: str) -> bool:
+        if self.use_redis and self.client:
+            try:
+                if self.client.hexists("credit_hold_owner", task_id):
+                    return True
+            except Exception as e:
+                logger.warning(f"Redis查询积分预占失败: {e}")
+        with self._memory_lock:
+            return task_id in self._memory_store["credit_holds"]
+    
     def get_best_worker(self, exclude: List[str] = None) -> Optional[str]:
         """获取最佳Worker（负载最轻的）"""
         online_workers = self.get_online_workers(only_ready=True)
@@ -591,6 +904,21 @@ class RedisManager:
                     self._memory_store["locks"].pop(lock_key, None)
                 
                 cleaned["expired_locks"] = len(expired_locks)
+                
+                # 清理1小时未使用的令牌桶
+                expired_buckets = [k for k, (_, ts) in self._memory_store["buckets"].items() if current_time - ts > 3600]
+                for bucket_key in expired_buckets:
+                    self._memory_store["buckets"].pop(bucket_key, None)
+                
+                # 清理过期的任务进度
+                expired_progress = [k for k, (expire, _) in self._memory_store["task_progress"].items() if current_time > expire]
+                for task_id in expired_progress:
+                    self._memory_store["task_progress"].pop(task_id, None)
+                
+                # 清理过期的序列号（按任务/用户主题的序列带 ttl）
+                expired_seq = [k for k, (_, expire) in self._memory_store["seq"].items() if expire is not None and current_time > expire]
+                for name in expired_seq:
+                    self._memory_store["seq"].pop(name, None)
         
         return cleaned
     
@@ -606,8 +934,14 @@ class RedisManager:
             except Exception as e:
                 logger.error(f"Redis缓存任务进度失败: {e}")
                 return False
-        # 内存模式暂不实现
-        return False
+        # 内存模式：TTL + LRU（超过 TASK_PROGRESS_MAX 条淘汰最久未写入的）
+        with self._memory_lock:
+            store = self._memory_store["task_progress"]
+            store.pop(task_id, None)
+            store[task_id] = (time.time() + ttl, dict(progress))
+            while len(store) > self._task_progress_max:
+                store.popitem(last=False)
+        return True
     
     def get_task_progress(self, task_id: str) -> Optional[Dict[str, Any]]:
         """获取任务进度缓存"""
@@ -619,7 +953,14 @@ class RedisManager:
             except Exception as e:
                 logger.error(f"Redis获取任务进度失败: {e}")
                 return None
-        return None
+        with self._memory_lock:
+            hit = self._memory_store["task_progress"].get(task_id)
+            if not hit:
+                return None
+            if time.time() > hit[0]:
+                self._memory_store["task_progress"].pop(task_id, None)
+                return None
+            return dict(hit[1])
     
     # ==================== 统计信息 ====================
     
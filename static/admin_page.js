@@ -2189,15 +2189,15 @@ function connectToBackendWS(_serverIgnored) {
 
             // 使用 setTimeout 确保 WebSocket 状态完全同步
             setTimeout(() => {
-                // 订阅用户更新
+                // 订阅用户更新（重连时带 since，只补发断线期间漏掉的推送）
                 if (currentUserId) {
-                    sendWSCommand('subscribe_user', { user_id: currentUserId });
+                    sendWSCommand('subscribe_user', { user_id: currentUserId, since: wsTopicSeq['user:' + currentUserId] });
                 }
 
                 // 🔥 关键修复：断线重连后，必须重新订阅正在进行的任务，否则前端会永久卡死
                 if (typeof isSending !== 'undefined' && isSending && typeof currentTaskId !== 'undefined' && currentTaskId) {
                     // console.log(`[WebSocket] 重连恢复，重新订阅任务 ${currentTaskId}`);
-                    sendWSCommand('subscribe_task', { task_id: currentTaskId });
+                    sendWSCommand('subscribe_task', { task_id: currentTaskId, since: wsTopicSeq['task:' + currentTaskId] });
                 }
 
                 showMessage('已连接到实时推送服务', 'success');
@@ -2219,6 +2219,15 @@ function connectToBackendWS(_serverIgnored) {
                 const msg = JSON.parse(event.data);
                 const msgType = msg.type;
 
+                // 按主题去重：续传补发与实时推送可能重叠，seq 不大于已处理的直接丢弃（快照重置基线）
+                const topic = _wsTopicOf(msg);
+                if (topic && typeof msg.seq === 'number') {
+                    if (!msg.is_snapshot && msg.seq <= (wsTopicSeq[topic] || 0)) {
+                        return;
+                    }
+                    wsTopicSeq[topic] = msg.seq;
+                }
+
                 // console.log('[WebSocket] 收到消息:', msgType, msg);
 
                 // 处理不同类型的消息
@@ -2232,6 +2241,12 @@ function connectToBackendWS(_serverIgnored) {
                     // console.log('✓ 任务订阅成功:', msg.data || msg);
                 } else if (msgType === 'user_subscribed') {
                     // console.log('✓ 用户订阅成功');
+                    if (typeof msg.seq === 'number' && !msg.resumed) {
+                        wsTopicSeq['user:' + msg.user_id] = msg.seq;
+                    }
+                    if (msg.resync && typeof resyncUserState === 'function') {
+                        resyncUserState();
+                    }
                 } else if (msgType === 'unsubscribed') {
                     // console.log('[WebSocket] 取消订阅:', msg);
                 } else if (msgType === 'pong') {
@@ -2241,48 +2256,13 @@ function connectToBackendWS(_serverIgnored) {
                 } else if (msgType === 'super_admin_response') {
                     // 处理超级管理员命令响应
                     handleSuperAdminResponse(msg);
-                } else if (msgType === 'servers_list' || msgType === 'servers_list_update' || msgType === 'server_update') {
-                    // 🔥 处理服务器列表更新（从API推送）
+                } else if (msgType === 'servers_list' || msgType === 'servers_list_update' || msgType === 'servers_delta' || msgType === 'server_update') {
+                    // 🔥 处理服务器列表更新（从API推送）：连接时收快照，之后只收增量
                     // console.log('✓ 收到服务器列表更新:', msgType);
                     if ((msgType === 'servers_list' || msgType === 'servers_list_update') && msg.servers) {
-                        // 更新服务器列表
-                        serverData.connected = [];
-                        serverData.disconnected = [];
-                        if (Array.isArray(msg.servers)) {
-                            msg.servers.forEach(server => {
-                                const serverItem = {
-                                    name: server.server_name || server.server_id,
-                                    url: server.server_url || '',
-                                    server_id: server.server_id,
-                                    status: (server.status || '').toLowerCase(),
-                                    assigned_user_id: server.assigned_user_id || null,
-                                    last_seen: server.last_seen
-                                };
-
-                                // 🔥 严格时间校验：即使状态是 connected，也要看心跳时间是否在 60 秒内
-                                const now = Date.now();
-                                const lastSeenTime = serverItem.last_seen ? new Date(serverItem.last_seen).getTime() : 0;
-                                const isRecentlyActive = (now - lastSeenTime) < 60000; // 60秒以内
-
-                                if (serverItem.status === 'connected' && isRecentlyActive) {
-                                    serverData.connected.push(serverItem);
-                                } else {
-                                    // 任何超过 60 秒没动的，或者状态不是 connected 的，一律进断开列表
-                                    serverItem.status = 'disconnected';
-                                    serverData.disconnected.push(serverItem);
-                                }
-                            });
-                        }
-                        if (typeof updateServerDisplay === 'function') {
-                            updateServerDisplay();
-                        }
-                        // 🚀 关键修复：收到列表后，立刻尝试连接分配给我的服务器
-                        if (typeof connectToAssignedServers === 'function') {
-                            connectToAssignedServers();
-                        }
-                        if (typeof connectToAvailableServers === 'function') {
-                            connectToAvailableServers();
-                        }
+                        applyServersSnapshot(msg);
+                    } else if (msgType === 'servers_delta') {
+                        applyServersDelta(msg);
                     } else if (msgType === 'server_update') {
                         // 单个服务器更新，重新加载完整列表
                         if (typeof loadServersFromAPI === 'function') {
@@ -2338,6 +2318,92 @@ function connectToBackendWS(_serverIgnored) {
     }
 }
 
+// 每个推送主题（task:<id> / user:<id>）已处理的最大 seq，重连订阅时作为 since 发给服务端
+const wsTopicSeq = {};
+
+function _wsTopicOf(msg) {
+    if (msg.type === 'task_update') {
+        const taskId = msg.task_id || (msg.data && msg.data.task_id);
+        return taskId ? 'task:' + taskId : null;
+    }
+    if (msg.user_id && msg.type !== 'user_subscribed') {
+        return 'user:' + msg.user_id;
+    }
+    return null;
+}
+
+// 服务器列表版本号：快照带 version，之后的 servers_delta 必须连续，否则重新请求快照
+let serversListVersion = null;
+let serversSnapshotPending = false;
+
+function _placeServerItem(server) {
+    const serverItem = {
+        name: server.server_name || server.server_id,
+        url: server.server_url || '',
+        server_id: server.server_id,
+        status: (server.status || '').toLowerCase(),
+        assigned_user_id: server.assigned_user_id || null,
+        last_seen: server.last_seen
+    };
+
+    // 🔥 严格时间校验：即使状态是 connected，也要看心跳时间是否在 60 秒内
+    const now = Date.now();
+    const lastSeenTime = serverItem.last_seen ? new Date(serverItem.last_seen).getTime() : 0;
+    const isRecentlyActive = (now - lastSeenTime) < 60000; // 60秒以内
+
+    if (serverItem.status === 'connected' && isRecentlyActive) {
+        serverData.connected.push(serverItem);
+    } else {
+        // 任何超过 60 秒没动的，或者状态不是 connected 的，一律进断开列表
+        serverItem.status = 'disconnected';
+        serverData.disconnected.push(serverItem);
+    }
+}
+
+function _refreshServerViews() {
+    if (typeof updateServerDisplay === 'function') {
+        updateServerDisplay();
+    }
+    // 🚀 关键修复：收到列表后，立刻尝试连接分配给我的服务器
+    if (typeof connectToAssignedServers === 'function') {
+        connectToAssignedServers();
+    }
+    if (typeof connectToAvailableServers === 'function') {
+        connectToAvailableServers();
+    }
+}
+
+function applyServersSnapshot(msg) {
+    serverData.connected = [];
+    serverData.disconnected = [];
+    if (Array.isArray(msg.servers)) {
+        msg.servers.forEach(_placeServerItem);
+    }
+    serversListVersion = typeof msg.version === 'number' ? msg.version : null;
+    serversSnapshotPending = false;
+    _refreshServerViews();
+}
+
+function applyServersDelta(msg) {
+    if (serversListVersion !== null && msg.version <= serversListVersion) {
+        return; // 快照已包含（多进程推送可能乱序到达）
+    }
+    if (serversListVersion === null || msg.version !== serversListVersion + 1) {
+        // 版本不连续：中间有增量丢失，请求一次完整快照
+        serversListVersion = null;
+        if (!serversSnapshotPending) {
+            serversSnapshotPending = sendWSCommand('get_servers', {});
+        }
+        return;
+    }
+    const changed = new Set((msg.servers || []).map(s => s.server_id).concat(msg.removed || []));
+    serverData.connected = serverData.connected.filter(s => !changed.has(s.server_id));
+    serverData.disconnected = serverData.disconnected.filter(s => !changed.has(s.server_id));
+    (msg.servers || []).forEach(_placeServerItem);
+    serversListVersion = msg.version;
+    _refreshServerViews();
+}
+
 function sendWSCommand(action, data = {}) {
     if (!activeWs || activeWs.readyState !== WebSocket.OPEN) {
         // console.warn('[WebSocket] 未连接，无法发送命令:', action);
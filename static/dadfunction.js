@@ -18,6 +18,11 @@ function handleServerMessage(data, serverId = null) {
         return;
     }
 
+    if (data.type === 'usage_update' && data.data && data.data.seq !== undefined) {
+        applyUsageDelta(data.data);
+        return;
+    }
+
     if (data.type === 'usage_update' || data.type === 'usage_records_update') {
         if (data.records || data.usage_records) {
             localStorage.setItem('user_usage_records', JSON.stringify(data.records || data.usage_records));
@@ -383,6 +388,78 @@ function addStatusMessage(message, type = 'info') {
     }
 }
 
+// usage_update 增量推送：{entries, from_seq, seq, credits}
+// 本地序号与 from_seq 对上就直接追加；对不上（漏推送/其他途径记账）时才拉取缺失的一页
+const USAGE_RECORDS_LIMIT = 200;
+let _usageSyncing = false;
+
+function applyUsageDelta(delta) {
+    const balance = delta.balance !== undefined ? delta.balance : delta.credits;
+    if (balance !== undefined && balance !== null) {
+        localStorage.setItem('user_balance', balance);
+        if (typeof updateUserInfoDisplay === 'function') {
+            updateUserInfoDisplay(balance);
+        }
+    }
+    const localSeq = parseInt(localStorage.getItem('user_usage_seq') || '', 10);
+    if (!Number.isNaN(localSeq) && localSeq === delta.from_seq) {
+        _storeUsageRecords(_loadUsageRecords().concat(delta.entries || []), delta.seq);
+        return;
+    }
+    if (!Number.isNaN(localSeq) && localSeq >= delta.seq) return; // 重复或过期的推送
+    fetchUsagePage(Number.isNaN(localSeq) ? null : localSeq);
+}
+
+function _loadUsageRecords() {
+    try {
+        const records = JSON.parse(localStorage.getItem('user_usage_records') || '[]');
+        return Array.isArray(records) ? records : [];
+    } catch {
+        return [];
+    }
+}
+
+function _storeUsageRecords(records, seq) {
+    const tail = records.slice(-USAGE_RECORDS_LIMIT);
+    localStorage.setItem('user_usage_records', JSON.stringify(tail));
+    localStorage.setItem('user_usage_seq', String(seq));
+    if (typeof updateUsageRecordsDisplay === 'function') {
+        updateUsageRecordsDisplay(tail);
+    }
+}
+
+async function fetchUsagePage(sinceSeq) {
+    const userId = localStorage.getItem('user_id');
+    if (!userId || _usageSyncing) return;
+    _usageSyncing = true;
+    try {
+        const qs = sinceSeq === null ? `limit=${USAGE_RECORDS_LIMIT}` : `since=${sinceSeq}&limit=${USAGE_RECORDS_LIMIT}`;
+        const resp = await fetch(`${API_BASE_URL}/user/${encodeURIComponent(userId)}/usage?${qs}`, {
+            headers: { 'Authorization': `Bearer ${_authToken()}` }
+        });
+        const page = await resp.json();
+        if (!resp.ok || !page.success) return;
+        if (page.credits !== undefined && page.credits !== null) {
+            localStorage.setItem('user_balance', page.credits);
+            if (typeof updateUserInfoDisplay === 'function') {
+                updateUserInfoDisplay(page.credits);
+            }
+        }
+        const base = page.reset ? [] : _loadUsageRecords();
+        _storeUsageRecords(base.concat(page.entries || []), page.seq);
+    } catch (e) {
+        console.warn('fetchUsagePage failed:', e);
+    } finally {
+        _usageSyncing = false;
+    }
+}
+
+// 用户推送重连时缓冲已覆盖不到漏掉的帧：按本地用量序号补拉一页，同时刷新余额
+function resyncUserState() {
+    const localSeq = parseInt(localStorage.getItem('user_usage_seq') || '', 10);
+    fetchUsagePage(Number.isNaN(localSeq) ? null : localSeq);
+}
+
 //#endregion
 //#region 发送短信API交互功能模块（零轮询：WebSocket 实时推送）
 // 零轮询架构：create(生成任务) -> API 立即推送到 Worker -> WebSocket 实时接收进度
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# api.py 在导入时做 gevent monkey patch 并尝试初始化数据库；测试只用纯内存函数，不需要真实数据库
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost:1/unused")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,11 @@
+import pytest
+
+import api
+
+
+@pytest.mark.parametrize("rate", [-1, "-5", 1.5, "abc", True, [10]])
+def test_create_task_rejects_invalid_rate_per_min(rate):
+    client = api.app.test_client()
+    resp = client.post("/api/task/create", json={"user_id": "u1", "message": "hi", "numbers": ["+1"], "rate_per_min": rate})
+    assert resp.status_code == 400
+    assert resp.get_json()["message"] == "rate_per_min must be a non-negative int"
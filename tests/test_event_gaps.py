@@ -0,0 +1,49 @@
+import api
+from redis_manager import redis_manager
+
+
+def test_task_event_since_detects_ring_overflow(monkeypatch):
+    monkeypatch.setattr(api, "TASK_EVENT_BACKLOG", 4)
+    monkeypatch.setattr(api, "_task_events", {})
+    for seq in range(1, 11):
+        api._task_event_publish("gap-task", {"status": "running", "sent": seq}, seq)
+
+    events, gap, seq = api._task_event_since("gap-task", 8)
+    assert [e[0] for e in events] == [9, 10] and not gap and seq == 10
+    events, gap, seq = api._task_event_since("gap-task", 6)
+    assert [e[0] for e in events] == [7, 8, 9, 10] and not gap
+    events, gap, seq = api._task_event_since("gap-task", 5)
+    assert [e[0] for e in events] == [7, 8, 9, 10] and gap
+    assert api._task_event_since("gap-task", 10) == ([], False, 10)
+    assert api._task_event_since("unknown-task", 3) == ([], False, 0)
+
+
+def test_task_event_since_detects_missing_seq(monkeypatch):
+    monkeypatch.setattr(api, "_task_events", {})
+    for seq in (1, 2, 4):  # 3 在其他进程编号后没有送到本进程
+        api._task_event_publish("hole-task", {"status": "running"}, seq)
+    events, gap, _ = api._task_event_since("hole-task", 1)
+    assert [e[0] for e in events] == [2, 4] and gap
+
+
+def test_topic_since_detects_gaps(monkeypatch):
+    monkeypatch.setattr(api, "FRONTEND_EVENT_BACKLOG", 3)
+    monkeypatch.setattr(api, "_topic_events", {})
+    for seq in range(1, 7):
+        api._topic_record("task:t1", seq, f"frame-{seq}")
+    api._topic_record("task:t1", 2, "late")  # 乱序到达的旧帧不入缓冲
+
+    frames, gap, seq = api._topic_since("task:t1", 3)
+    assert frames == [(4, "frame-4"), (5, "frame-5"), (6, "frame-6")] and not gap and seq == 6
+    frames, gap, _ = api._topic_since("task:t1", 2)
+    assert len(frames) == 3 and gap
+    assert api._topic_since("task:t1", 6) == ([], False, 6)
+
+
+def test_topic_since_without_local_ring_uses_global_seq(monkeypatch):
+    monkeypatch.setattr(api, "_topic_events", {})
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    for _ in range(3):
+        redis_manager.next_seq("topic:user:gap-user")
+    assert api._topic_since("user:gap-user", 3) == ([], False, 3)
+    assert api._topic_since("user:gap-user", 1) == ([], True, 3)
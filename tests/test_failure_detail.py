@@ -0,0 +1,47 @@
+import api
+
+PHONES = [f"+1555000{i:04d}" for i in range(50)]
+
+
+def test_pack_unpack_round_trip():
+    failed = [
+        {"phone": PHONES[3], "reason": "blocked"},
+        {"number": PHONES[7], "error": "timeout"},
+        {"phone": PHONES[1], "reason": "blocked"},
+        {"phone": "+19999999999", "reason": "timeout"},  # 不在分片里的号码
+        PHONES[10],  # 旧格式：只有号码
+    ]
+    packed = api._pack_failures(failed, PHONES)
+    assert packed["n"] == 5
+    assert packed["r"] == ["blocked", "timeout", "未知错误"]
+    assert packed["i"] == [[1, 3], [7], [10]]
+    assert packed["x"] == [["+19999999999", 1]]
+    items = api._unpack_failures(packed, PHONES)
+    assert sorted((i["phone"], i["reason"]) for i in items) == sorted([
+        (PHONES[3], "blocked"), (PHONES[7], "timeout"), (PHONES[1], "blocked"), ("+19999999999", "timeout"), (PHONES[10], "未知错误"),
+    ])
+
+
+def test_pack_compresses_large_index_lists(monkeypatch):
+    monkeypatch.setattr(api, "FAIL_DETAIL_COMPRESS_BYTES", 16)
+    failed = [{"phone": p, "reason": "blocked"} for p in PHONES]
+    packed = api._pack_failures(failed, PHONES)
+    assert "i" not in packed and packed["z"]
+    assert [i["phone"] for i in api._unpack_failures(packed, PHONES)] == PHONES
+
+
+def test_pack_truncates(monkeypatch):
+    monkeypatch.setattr(api, "FAIL_DETAIL_MAX_ITEMS", 10)
+    failed = [{"phone": p, "reason": "blocked"} for p in PHONES]
+    packed = api._pack_failures(failed, PHONES)
+    assert packed["n"] == 50
+    assert packed["truncated"] == 40
+    assert [i["phone"] for i in api._unpack_failures(packed, PHONES)] == PHONES[:10]
+
+
+def test_pack_empty_and_legacy():
+    assert api._pack_failures([], PHONES) is None
+    assert api._pack_failures(None, PHONES) is None
+    assert api._unpack_failures(None, PHONES) == []
+    legacy = {"failed": [{"number": "+1", "error": "x"}, "+2"]}
+    assert api._unpack_failures(legacy, PHONES) == [{"phone": "+1", "reason": "x"}, {"phone": "+2", "reason": "未知错误"}]
@@ -0,0 +1,78 @@
+import json
+import time
+
+import pytest
+
+import api
+
+
+def _client():
+    return {"queue": api.deque(), "wakeup": api.Event()}
+
+
+def _put(client, payload, key=None, critical=False):
+    with api._frontend_lock:
+        return api._frontend_queue_put(client, payload, key, critical)
+
+
+def _payloads(client):
+    return [item[1] for item in client["queue"]]
+
+
+def test_coalesce_moves_latest_to_tail():
+    client = _client()
+    _put(client, "balance-1", key=("balance_update",))
+    _put(client, "usage-2")
+    _put(client, "balance-3", key=("balance_update",))
+    assert _payloads(client) == ["usage-2", "balance-3"]
+
+
+def test_coalesce_keeps_critical_flag():
+    client = _client()
+    _put(client, "done", key=("task_update", "T1"), critical=True)
+    _put(client, "later", key=("task_update", "T1"))
+    assert client["queue"][0][2] is True
+
+
+def test_full_queue_drops_oldest_non_critical(monkeypatch):
+    monkeypatch.setattr(api, "FRONTEND_SEND_QUEUE_MAX", 3)
+    client = _client()
+    _put(client, "c0", critical=True)
+    _put(client, "n1")
+    _put(client, "n2")
+    assert _put(client, "n3") is True
+    assert _payloads(client) == ["c0", "n2", "n3"]
+
+
+def test_full_queue_of_critical_asks_for_eviction(monkeypatch):
+    monkeypatch.setattr(api, "FRONTEND_SEND_QUEUE_MAX", 2)
+    client = _client()
+    _put(client, "c0", critical=True)
+    _put(client, "c1", critical=True)
+    assert _put(client, "n2") is False
+
+
+def test_stale_head_asks_for_eviction(monkeypatch):
+    monkeypatch.setattr(api, "FRONTEND_SLOW_EVICT_SECONDS", 5)
+    client = _client()
+    _put(client, "old")
+    client["queue"][0][3] = time.time() - 10
+    assert _put(client, "new") is False
+
+
+
+def test_mixed_sequenced_frames_stay_in_seq_order():
+    # 同一用户主题下：余额（带 key，会合并）与用量增量（不合并）交错，发送顺序必须保持 seq 递增
+    client = _client()
+    frames = [
+        ("balance_update", 3, ("balance_update",)),
+        ("usage_update", 4, None),
+        ("balance_update", 5, ("balance_update",)),
+        ("usage_update", 6, None),
+        ("balance_update", 7, ("balance_update",)),
+    ]
+    for kind, seq, key in frames:
+        _put(client, json.dumps({"type": kind, "user_id": "u", "seq": seq}), key=key)
+    seqs = [json.loads(p)["seq"] for p in _payloads(client)]
+    assert seqs == sorted(seqs)
+    assert seqs == [4, 6, 7]
@@ -0,0 +1,56 @@
+import time
+
+from redis_manager import redis_manager
+
+
+def test_memory_seq_increments_and_expires(monkeypatch):
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    name = "topic:task:test-expire"
+    assert redis_manager.next_seq(name, ttl=60) == 1
+    assert redis_manager.next_seq(name, ttl=60) == 2
+    assert redis_manager.get_seq(name) == 2
+
+    value, _ = redis_manager._memory_store["seq"][name]
+    redis_manager._memory_store["seq"][name] = (value, time.time() - 1)
+    redis_manager.cleanup_expired()
+    assert name not in redis_manager._memory_store["seq"]
+    assert redis_manager.get_seq(name) == 0
+
+
+def test_memory_seq_without_ttl_is_kept(monkeypatch):
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    name = "servers_list_test"
+    redis_manager.next_seq(name)
+    redis_manager.cleanup_expired()
+    assert redis_manager.get_seq(name) == 1
+
+
+class _BrokenRedis:
+    def incr(self, *args, **kwargs):
+        raise ConnectionError("redis down")
+
+    def get(self, *args, **kwargs):
+        raise ConnectionError("redis down")
+
+
+def test_seq_without_fallback_reports_redis_error(monkeypatch):
+    monkeypatch.setattr(redis_manager, "use_redis", True)
+    monkeypatch.setattr(redis_manager, "client", _BrokenRedis())
+    assert redis_manager.next_seq("servers_list_down", fallback=False) is None
+    assert redis_manager.get_seq("servers_list_down", fallback=False) is None
+    # 默认仍退回内存计数
+    assert redis_manager.next_seq("servers_list_down") == 1
+
+
+def test_memory_credit_holds(monkeypatch):
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    redis_manager.credit_hold_place("hold-a", "hold-user", 10)
+    redis_manager.credit_hold_place("hold-b", "hold-user", 5)
+    redis_manager.credit_hold_consume("hold-a", 4)
+    redis_manager.credit_hold_consume("hold-b", 8)
+    assert redis_manager.credit_held("hold-user") == 6.0
+    assert redis_manager.credit_hold_exists("hold-a")
+    assert redis_manager.credit_hold_release("hold-a") == 6.0
+    assert redis_manager.credit_hold_release("hold-b") == 0.0
+    assert not redis_manager.credit_hold_exists("hold-a")
+    assert redis_manager.credit_held("hold-user") == 0.0
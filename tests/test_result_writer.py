@@ -0,0 +1,75 @@
+import time
+
+import api
+
+
+def test_results_are_group_committed(monkeypatch):
+    """1000 条结果几乎同时到达时合并成少量事务（每次 _result_write_batch 调用 = 一次提交）"""
+    batches = []
+
+    def write_batch(batch):
+        batches.append(len(batch))
+        time.sleep(0.002)  # 模拟一次事务提交的耗时
+        for rec in batch:
+            rec["deducted"] = True
+        return {}
+
+    def after_commit(batch, outcome):
+        for rec in batch:
+            api._result_done(rec, {"ok": True, "deducted": rec["deducted"]})
+
+    monkeypatch.setattr(api, "_result_write_batch", write_batch)
+    monkeypatch.setattr(api, "_result_after_commit", after_commit)
+    monkeypatch.setattr(api, "RESULT_BATCH_MAX", 200)
+    monkeypatch.setattr(api, "_tracker_on_result", lambda *a: None)
+
+    acks = []
+    for i in range(1000):
+        api._result_ingest(f"bench-{i}", "", "u1", 2, 0, {}, acks.append)
+    deadline = time.time() + 10
+    while len(acks) < 1000 and time.time() < deadline:
+        time.sleep(0.01)
+
+    print(f"results=1000 commits={len(batches)} batch_sizes={batches}")
+    assert len(acks) == 1000
+    assert all(a["ok"] and a["deducted"] for a in acks)
+    assert sum(batches) == 1000
+    assert len(batches) == 5
+
+
+def test_late_results_do_not_touch_cancelled_task_holds(monkeypatch):
+    updates = []
+    monkeypatch.setattr(api, "broadcast_task_update", lambda task_id, data: updates.append(data))
+    monkeypatch.setattr(api, "broadcast_user_update", lambda *a, **k: None)
+    api._credit_hold_place("late-cancelled", "u1", 0)
+    api._credit_hold_place("late-running", "u1", 20)
+    outcome = {
+        "shard_info": {}, "server_names": {}, "balances": {}, "usage_delta": {}, "completed": set(),
+        "task_sums": {"late-cancelled": {"credits": 5.0}, "late-running": {"credits": 5.0}},
+        "shard_counts": {"late-cancelled": {"done": 1, "total": 2}},
+        "task_rows": {"late-cancelled": {"status": "cancelled", "user_id": "u1"}, "late-running": {"status": "running", "user_id": "u1"}},
+    }
+    api._result_after_commit([], outcome)
+
+    assert api._credit_hold_release("late-running") == 15.0
+    assert api._credit_hold_release("late-cancelled") == 0.0
+    assert updates[0]["status"] == "cancelled" and updates[0]["completed"] is False
+
+
+def test_blocking_ack_does_not_stall_next_batch(monkeypatch):
+    monkeypatch.setattr(api, "_result_write_batch", lambda batch: {})
+    monkeypatch.setattr(api, "_result_after_commit", lambda batch, outcome: [api._result_done(rec, {"ok": True}) for rec in batch])
+    monkeypatch.setattr(api, "_tracker_on_result", lambda *a: None)
+
+    def stalled_ack(result):
+        time.sleep(5)  # 半开的 Worker 连接
+
+    acks = []
+    api._result_ingest("stall-1", "", "u1", 1, 0, {}, stalled_ack)
+    time.sleep(0.05)
+    started = time.time()
+    api._result_ingest("stall-2", "", "u1", 1, 0, {}, acks.append)
+    while not acks and time.time() - started < 2:
+        time.sleep(0.01)
+    assert acks == [{"ok": True}]
+    assert time.time() - started < 1
@@ -0,0 +1,81 @@
+from collections import deque
+
+import api
+from redis_manager import redis_manager
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, sql, args=None):
+        self.conn.sql.append(sql)
+        self.row = ("s1",) if "RETURNING shard_id" in sql and self.conn.claimable else None
+        self.rowcount = 1
+
+    def fetchone(self):
+        return self.row
+
+
+class _Conn:
+    def __init__(self, claimable):
+        self.claimable = claimable
+        self.sql = []
+
+    def cursor(self, cursor_factory=None):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _job(monkeypatch, claimable):
+    conn = _Conn(claimable)
+    monkeypatch.setattr(api, "db", lambda: conn)
+    monkeypatch.setattr(api, "_sched_kick", lambda: None)
+    monkeypatch.setattr(api, "_sched_users", {"u1": {"vtime": 0.0, "inflight": 1, "tasks": deque(["t1"])}})
+    monkeypatch.setattr(api, "_sched_tasks", {})
+    monkeypatch.setattr(api, "_sched_worker_load", {"w1": 1})
+    monkeypatch.setattr(api, "_sched_token_lease", {"user:u1": 0})
+    job = {"shard_id": "s1", "task_id": "t1", "user_id": "u1", "worker_id": "w1", "phones": ["1"] * 5, "phone_count": 5,
+           "message": "hi", "trace_id": None, "mark_running": True, "started_at": 0.0, "tokens": ["user:u1"]}
+    monkeypatch.setattr(api, "_sched_inflight", {"s1": job})
+    return job, conn
+
+
+def test_push_skipped_when_another_process_claimed_the_shard(monkeypatch):
+    job, conn = _job(monkeypatch, claimable=False)
+    pushed = []
+    monkeypatch.setattr(api, "_push_shard_to_worker", lambda *a: pushed.append(a) or True)
+
+    assert api._sched_push(job) is False
+    assert pushed == []
+    assert "s1" not in api._sched_inflight
+    assert api._sched_worker_load["w1"] == 0
+    assert api._sched_token_lease["user:u1"] == 5
+    # 没认领到就不改任务状态，也不放回队列
+    assert not any("UPDATE tasks" in q for q in conn.sql)
+    assert api._sched_tasks == {}
+
+
+def test_push_after_claim_and_unclaim_on_failure(monkeypatch):
+    job, conn = _job(monkeypatch, claimable=True)
+    monkeypatch.setattr(api, "_push_shard_to_worker", lambda *a: False)
+
+    assert api._sched_push(job) is False
+    assert "RETURNING shard_id" in conn.sql[0]
+    assert any("status='pending'" in q and "status='running' AND server_id" in q for q in conn.sql)
+    assert [s["shard_id"] for s in api._sched_tasks["t1"]["queue"]] == ["s1"]
+
+
+def test_claim_marks_task_running_in_progress_cache(monkeypatch):
+    job, conn = _job(monkeypatch, claimable=True)
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    redis_manager.cache_task_progress("t1", {"task_id": "t1", "status": "pending", "shards": {"pending": 1, "total": 1}})
+
+    assert api._sched_claim(job) is True
+    assert redis_manager.get_task_progress("t1")["status"] == "running"
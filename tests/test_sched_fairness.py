@@ -0,0 +1,80 @@
+import heapq
+
+import api
+
+WORKERS = 4
+SHARD_SECONDS_PER_NUMBER = 0.02
+
+
+def _workload():
+    """(提交时间, 用户, 任务, 分片数, 每分片号码数)：一个大任务先占满队列，随后 10 个用户各提交一个小任务"""
+    jobs = [(0.0, "big", "big-task", 200, 50)]
+    for i in range(10):
+        jobs.append((1.0 + i * 2.0, f"small-{i}", f"small-task-{i}", 2, 50))
+    return jobs
+
+
+def _simulate(monkeypatch, policy):
+    """用虚拟时钟驱动真实的 _sched_pick / _sched_release_locked，返回每个任务的完成耗时"""
+    monkeypatch.setattr(api, "SCHED_POLICY", policy)
+    monkeypatch.setattr(api, "WORKER_MAX_INFLIGHT", 1)
+    monkeypatch.setattr(api, "_sched_users", {})
+    monkeypatch.setattr(api, "_sched_tasks", {})
+    monkeypatch.setattr(api, "_sched_inflight", {})
+    monkeypatch.setattr(api, "_sched_hedges", {})
+    monkeypatch.setattr(api, "_sched_worker_load", {})
+    monkeypatch.setattr(api, "_sched_vclock", 0.0)
+    monkeypatch.setattr(api, "_sched_user_policy", lambda uid, admin_id=None: (1.0, 0, 0))
+    monkeypatch.setattr(api, "_sched_kick", lambda: None)
+
+    workers = [f"w{i}" for i in range(WORKERS)]
+    scores = {w: 1.0 for w in workers}
+    arrivals = sorted(_workload())
+    submitted, remaining, finished = {}, {}, {}
+    events = []  # (完成时间, shard_id, worker_id, task_id)
+    now = 0.0
+    while arrivals or events:
+        while arrivals and arrivals[0][0] <= now:
+            at, user_id, task_id, shard_count, size = arrivals.pop(0)
+            shards = [{"shard_id": f"{task_id}-{n}", "phones": ["1"] * size} for n in range(shard_count)]
+            api._sched_enqueue(task_id, user_id, "hi", None, shards)
+            api._sched_tasks[task_id]["created_at"] = at
+            submitted[task_id], remaining[task_id] = at, shard_count
+        free_slots = {w: 1 - api._sched_worker_load.get(w, 0) for w in workers}
+        eligible = {uid: set(workers) for uid in api._sched_users}
+        with api._sched_lock:
+            while True:
+                job = api._sched_pick(free_slots, eligible, scores)
+                if job is None:
+                    break
+                heapq.heappush(events, (now + job["phone_count"] * SHARD_SECONDS_PER_NUMBER, job["shard_id"], job["worker_id"], job["task_id"]))
+        next_arrival = arrivals[0][0] if arrivals else float("inf")
+        if events and events[0][0] <= next_arrival:
+            now, shard_id, worker_id, task_id = heapq.heappop(events)
+            with api._sched_lock:
+                api._sched_release_locked(shard_id, worker_id)
+            remaining[task_id] -= 1
+            if not remaining[task_id]:
+                finished[task_id] = now - submitted[task_id]
+        else:
+            now = next_arrival
+    return finished
+
+
+def _p(values, pct):
+    return api._percentile(sorted(values), pct)
+
+
+def test_wfq_cuts_small_task_completion_tail(monkeypatch):
+    """可复现的 fifo / wfq 对比：同一负载下小任务完成耗时的 p50/p95（python -m pytest tests/test_sched_fairness.py -s 查看数值）"""
+    results = {}
+    for policy in ("fifo", "wfq"):
+        finished = _simulate(monkeypatch, policy)
+        small = [v for k, v in finished.items() if k.startswith("small")]
+        results[policy] = {"small_p50": _p(small, 50), "small_p95": _p(small, 95), "big": finished["big-task"]}
+        print(f"{policy:4} small p50={results[policy]['small_p50']:.1f}s p95={results[policy]['small_p95']:.1f}s big={results[policy]['big']:.1f}s")
+
+    assert results["wfq"]["small_p95"] < results["fifo"]["small_p95"] / 5
+    # 调度不浪费 Worker：大任务最晚在全部工作量跑完时结束
+    total_seconds = sum(count * size * SHARD_SECONDS_PER_NUMBER for _, _, _, count, size in _workload())
+    assert results["wfq"]["big"] <= total_seconds / WORKERS + 1e-6
@@ -0,0 +1,59 @@
+from collections import deque
+
+import api
+from redis_manager import redis_manager
+
+
+def _setup(monkeypatch, rate_per_min):
+    monkeypatch.setattr(api, "_sched_users", {"u1": {"vtime": 0.0, "inflight": 0, "tasks": deque(["t1"]), "weight": 1.0, "max_inflight": 0, "rate_per_min": rate_per_min}})
+    monkeypatch.setattr(api, "_sched_tasks", {"t1": {"user_id": "u1", "message": "hi", "trace_id": None, "created_at": 1.0, "started": False,
+                                                   "queue": deque({"shard_id": f"s{i}", "phones": ["1"] * 10, "phone_count": 10} for i in range(5))}})
+    monkeypatch.setattr(api, "_sched_inflight", {})
+    monkeypatch.setattr(api, "_sched_worker_load", {})
+    monkeypatch.setattr(api, "_sched_throttled", {})
+    monkeypatch.setattr(api, "_sched_token_lease", {})
+    monkeypatch.setattr(api, "_sched_token_wants", {})
+    monkeypatch.setattr(api, "_ready_workers", lambda: ["w1"])
+    monkeypatch.setattr(api, "_eligible_workers", lambda uid, admin_id, ready: set(ready))
+    monkeypatch.setattr(api, "_worker_scores_for", lambda ready: {w: 1.0 for w in ready})
+    monkeypatch.setattr(api, "_worker_global_loads", lambda ready: {})
+    monkeypatch.setattr(api, "WORKER_MAX_INFLIGHT", 10)
+    pushed = []
+    monkeypatch.setattr(api, "spawn", lambda fn, job: pushed.append(job["shard_id"]))
+    return pushed
+
+
+def test_token_bucket_is_not_called_under_sched_lock(monkeypatch):
+    monkeypatch.setattr(redis_manager, "use_redis", False)
+    redis_manager._memory_store["buckets"].clear()
+    pushed = _setup(monkeypatch, rate_per_min=1200)  # 20/s，容量 200
+    calls = []
+
+    def take_tokens(key, rate, capacity, amount):
+        calls.append((key, amount))
+        assert not api._sched_lock.locked()
+        return True, 0.0
+
+    monkeypatch.setattr(redis_manager, "take_tokens", take_tokens)
+    monkeypatch.setattr(api, "RATE_LEASE_SECONDS", 2)  # 每次租 40 个令牌 = 4 个分片
+
+    assert api._dispatch_round() == 4
+    assert pushed == ["s0", "s1", "s2", "s3"]
+    # 第二遍挑选后又为剩下的分片补租了一次，下一轮直接用本地租约
+    assert calls == [("user:u1", 40.0), ("user:u1", 40.0)]
+    assert api._dispatch_round() == 1
+    assert pushed[-1] == "s4"
+    assert len(calls) == 2
+    assert api._sched_token_lease["user:u1"] == 30
+
+
+def test_token_refill_denied_throttles_key(monkeypatch):
+    pushed = _setup(monkeypatch, rate_per_min=60)
+    monkeypatch.setattr(redis_manager, "take_tokens", lambda key, rate, capacity, amount: (False, 5.0))
+
+    assert api._dispatch_round() == 0
+    assert pushed == []
+    assert "user:u1" in api._sched_throttled
+    # 节流期内不再登记补租
+    assert api._dispatch_round() == 0
+    assert api._sched_token_wants == {}
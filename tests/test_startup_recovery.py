@@ -0,0 +1,90 @@
+import api
+from redis_manager import redis_manager
+
+
+class _Cursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, args=None):
+        self.conn.sql.append(sql)
+        self.rows = []
+        if "FROM tasks WHERE status NOT IN" in sql:
+            self.rows = [
+                {"task_id": t, "user_id": "u1", "status": s, "message": "hi", "total": 10, "price_success": 2, "created_ts": 1.0, "windowed": t.startswith("W-")}
+                for t, s in self.conn.tasks.items()
+            ]
+        elif "GROUP BY task_id" in sql:
+            self.rows = [{"task_id": t, "total_shards": 2, "remaining_numbers": 5} for t in self.conn.tasks]
+        elif "status IN ('pending','running')" in sql and "FROM shards" in sql:
+            self.rows = [{"shard_id": f"{t}-s2", "task_id": t} for t in self.conn.tasks]
+
+    def fetchall(self):
+        return self.rows
+
+
+class _Conn:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.sql = []
+
+    def cursor(self, cursor_factory=None):
+        return _Cursor(self)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_recovery_rebuilds_paused_and_scheduled_without_queueing(monkeypatch):
+    tasks = {"T-run": "running", "T-paused": "paused", "T-sched": "scheduled"}
+    pushed = []
+    monkeypatch.setattr(api, "db", lambda: _Conn(tasks))
+    monkeypatch.setattr(api, "_assign_and_push_shards", lambda task_id, *a: pushed.append(task_id) or {"queued": 1})
+    monkeypatch.setattr(api, "_task_timers_reload", lambda: 0)
+    for task_id in tasks:
+        api._task_tracker.pop(task_id, None)
+        api._credit_hold_release(task_id)
+    redis_manager.release_lock(f"startup_recovery:{api.RECOVERY_DEPLOY_ID}")
+
+    report = api._startup_recovery()
+
+    assert report["tasks"] == 3
+    assert pushed == ["T-run"]
+    for task_id in tasks:
+        assert api._task_tracker[task_id]["total_shards"] == 2
+        assert api._shard_task_index[f"{task_id}-s2"] == task_id
+        assert api._credit_hold_release(task_id) == 10.0
+
+
+def test_recovery_runs_once_per_deployment(monkeypatch):
+    pushed = []
+    monkeypatch.setattr(api, "db", lambda: _Conn({"T-once": "pending"}))
+    monkeypatch.setattr(api, "_assign_and_push_shards", lambda task_id, *a: pushed.append(task_id) or {"queued": 1})
+    monkeypatch.setattr(api, "_task_timers_reload", lambda: 0)
+    redis_manager.release_lock(f"startup_recovery:{api.RECOVERY_DEPLOY_ID}")
+
+    assert not api._startup_recovery()["skipped"]
+    # 同一部署中后启动的进程不再重复入队
+    assert api._startup_recovery()["skipped"]
+    assert pushed == ["T-once"]
+    api._credit_hold_release("T-once")
+
+
+def test_recovery_reloads_timers_before_queueing_and_leaves_windowed_tasks_to_them(monkeypatch):
+    tasks = {"T-plain": "running", "W-window": "running"}
+    calls = []
+    monkeypatch.setattr(api, "db", lambda: _Conn(tasks))
+    monkeypatch.setattr(api, "_assign_and_push_shards", lambda task_id, *a: calls.append(task_id) or {"queued": 1})
+    monkeypatch.setattr(api, "_task_timers_reload", lambda: calls.append("timers") or 1)
+    redis_manager.release_lock(f"startup_recovery:{api.RECOVERY_DEPLOY_ID}")
+
+    api._startup_recovery()
+
+    assert calls == ["timers", "T-plain"]
+    for task_id in tasks:
+        api._credit_hold_release(task_id)
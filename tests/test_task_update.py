@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+import api
+
+
+def _frames_per_second(monkeypatch, interval_ms, updates=200, spacing=0.005):
+    frames = []
+    monkeypatch.setattr(api, "TASK_UPDATE_INTERVAL_MS", interval_ms)
+    monkeypatch.setattr(api, "_task_progress_store", lambda task_id, data: {})
+    monkeypatch.setattr(api, "_task_update_emit", lambda task_id, data, progress: frames.append(dict(data)))
+    task_id = f"rate-{interval_ms}"
+    started = time.time()
+    for i in range(updates):
+        api.broadcast_task_update(task_id, {"task_id": task_id, "status": "running", "sent": i + 1})
+        time.sleep(spacing)
+    api.broadcast_task_update(task_id, {"task_id": task_id, "status": "done", "completed": True})
+    elapsed = time.time() - started
+    time.sleep(interval_ms / 1000.0 + 0.05)
+    return frames, len(frames) / elapsed
+
+
+def test_coalescing_cuts_frame_rate(monkeypatch):
+    """同一任务 ~200 次/秒的进度更新：关闭合并时每次一帧，250ms 窗口下每秒约 4 帧，最终状态总是送达"""
+    before, before_rate = _frames_per_second(monkeypatch, 0)
+    after, after_rate = _frames_per_second(monkeypatch, 250)
+    print(f"task_update frames/s: off={before_rate:.1f} ({len(before)} frames) 250ms={after_rate:.1f} ({len(after)} frames)")
+    assert len(before) == 201
+    assert len(after) <= 10
+    assert after[-1]["completed"] is True
+    # 合并不会丢掉最新进度
+    assert max(f.get("sent", 0) for f in after) == 200
+
+
+@pytest.mark.parametrize("data", [
+    {"status": "done"}, {"status": "cancelled"}, {"status": "paused"}, {"status": "completed"}, {"completed": True},
+])
+def test_final_states_are_critical(monkeypatch, data):
+    sent = []
+    monkeypatch.setitem(api._task_subscribers, "final-task", {"c1"})
+    monkeypatch.setattr(api, "_frontend_send", lambda ids, payload, key=None, critical=False: sent.append(critical) or len(ids))
+    api._deliver_task_update("final-task", dict(data, task_id="final-task"), {}, None)
+    assert sent == [True]
+
+
+def test_progress_frames_are_not_critical(monkeypatch):
+    sent = []
+    monkeypatch.setitem(api._task_subscribers, "progress-task", {"c1"})
+    monkeypatch.setattr(api, "_frontend_send", lambda ids, payload, key=None, critical=False: sent.append(critical) or len(ids))
+    api._deliver_task_update("progress-task", {"task_id": "progress-task", "status": "running", "sent": 3}, {}, None)
+    assert sent == [False]
+
+
+def test_last_push_times_are_pruned(monkeypatch):
+    monkeypatch.setattr(api, "TASK_UPDATE_INTERVAL_MS", 250)
+    monkeypatch.setattr(api, "_task_progress_store", lambda task_id, data: {})
+    monkeypatch.setattr(api, "_task_update_emit", lambda *a: None)
+    monkeypatch.setattr(api, "_task_update_last", {f"old-{i}": time.time() - 10 for i in range(100)})
+    monkeypatch.setattr(api, "_task_update_prune_at", 0.0)
+    api.broadcast_task_update("fresh", {"task_id": "fresh", "status": "running"})
+    assert list(api._task_update_last) == ["fresh"]